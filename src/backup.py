@@ -22,10 +22,23 @@ import re
 import json
 import pickle
 import copy
+import collections
+import functools
 import pprint
 import logging
 
-from node import NFolder, NFile, NRootFolder
+from node import NFolder, NFile, NRootFolder, unicode_name
+from workers import WorkerPool, wait_all, background
+from cache import RemoteTreeCache, new_generation
+from packing import Packer
+from compression import Compressor
+from chunkstore import ChunkStore, SHARED_STORE, target_store
+from journal import UploadJournal
+from remotestate import RemoteState
+from listing import RemoteListing, rebuild_index
+from metrics import Metrics, InstrumentedClient, phase
+from profiling import Profiler
+from transport import RetryingClient, AdaptiveLimit
 
 CONFIG_SEARCH_PATHS = [os.path.dirname(os.path.realpath(__file__)), "/etc/dropbox_backups.d", ".", "./conf", "/etc", "/root/scripts/backups"]
 
@@ -52,11 +65,92 @@ def parse_target(target):
         raise Exception("Dropbox source/target isn't written correctly")
     return matches.group(1), matches.group(2)
 
-def diff_trees_r(local, remote, max_recurse_depth=-1):
-    """Find differences between two sets of file trees recursively"""
+def same_stats(local, remote):
+    """True if two nodes have the same size, mtime, mode and ownership"""
+    return local.size  == remote.size and \
+           local.mtime == remote.mtime and \
+           local.mode == remote.mode and \
+           local.gid == remote.gid and \
+           local.uid == remote.uid
+
+
+def same_listing(diff_child, remote):
+    """True if a diffed node would be listed in its folder's metadata just as remote is"""
+    if diff_child is remote:
+        return True
+    if diff_child is None or not isinstance(diff_child, NFolder) or not isinstance(remote, NFolder):
+        return False
+    # A folder's children are in its own metadata; its parent's only has its stats
+    return diff_child.uploaded and same_stats(diff_child, remote) and diff_child.symlink_target == remote.symlink_target
+
+
+def tree_is_dirty(node):
+    """True if any folder in a diffed tree has metadata to rewrite"""
+    stack = [node]
+    while stack:
+        folder = stack.pop()
+        if folder.dirty:
+            return True
+        stack.extend(c for c in folder.children if isinstance(c, NFolder))
+    return False
+
+
+def diff_file_by_hash(local, remote, source_base):
+    """Pick the node to keep for a file that exists locally and remotely, by content"""
+    try:
+        local.compute_hash(source_base)
+    except (IOError, OSError) as e:
+        logging.warning("Could not hash '{}'; it will be uploaded".format(local.generate_full_path(source_base)))
+        logging.warning(e)
+        return local
+
+    if remote.hash is None:
+        # Backed up before we hashed; trust the stats this once, and record the hash
+        if same_stats(local, remote):
+            local.reuse_remote_content(remote)
+        return local
+    if local.size != remote.size or local.hash != remote.hash:
+        return local
+    if same_stats(local, remote):
+        return remote
+    # Only the stats differ; the content is already there, so just rewrite the metadata
+    local.reuse_remote_content(remote)
+    return local
+
+
+def hash_new_nodes(node, source_base):
+    """Hash a local node that's about to be uploaded, and anything beneath it"""
+    if isinstance(node, NFolder):
+        for child in node.children:
+            hash_new_nodes(child, source_base)
+    elif not node.symlink_target:
+        try:
+            node.compute_hash(source_base)
+        except (IOError, OSError) as e:
+            logging.warning("Could not hash '{}'".format(node.generate_full_path(source_base)))
+            logging.warning(e)
+
+
+def _emptied(folder):
+    """A copy of a folder that's already backed up and empty, so has no metadata to rewrite"""
+    emptied = copy.copy(folder)
+    emptied.children = []
+    emptied.uploaded = True
+    emptied.dirty = False
+    return emptied
+
+
+def diff_trees_r(local, remote, max_recurse_depth=-1, compare_hash=False, source_base=None):
+    """Find differences between two sets of file trees recursively
+
+    With compare_hash, files that exist on both sides are compared by
+    content hash (hashing the local file) rather than by stats.
+    """
     logging.debug("diff_trees_r: Recurse depth {}".format(max_recurse_depth))
     diff_node = copy.copy(local)
     diff_node.children = []
+    # Whether anything our metadata lists has changed
+    dirty = False
 
     if diff_node.size == remote.size and diff_node.mtime == remote.mtime:
         # We've already been uploaded
@@ -82,24 +176,28 @@ def diff_trees_r(local, remote, max_recurse_depth=-1):
 
             diff_child = l_nodes[l_pointer]
             # Right, now compare if node is the same type and has matching class type
-            if l_nodes[l_pointer].size  == r_nodes[r_pointer].size and \
-               l_nodes[l_pointer].mtime == r_nodes[r_pointer].mtime and \
-               l_nodes[l_pointer].mode == r_nodes[r_pointer].mode and \
-               l_nodes[l_pointer].gid == r_nodes[r_pointer].gid and \
-               l_nodes[l_pointer].uid == r_nodes[r_pointer].uid:
+            if compare_hash and not isinstance(l_nodes[l_pointer], NFolder) and not isinstance(r_nodes[r_pointer], NFolder) and \
+               not l_nodes[l_pointer].symlink_target and not r_nodes[r_pointer].symlink_target:
+                diff_child = diff_file_by_hash(l_nodes[l_pointer], r_nodes[r_pointer], source_base)
+            elif same_stats(l_nodes[l_pointer], r_nodes[r_pointer]):
                 # Node is not different! Use already uploaded one
                 diff_child = r_nodes[r_pointer]
             
             # Node is the same
             if isinstance(l_nodes[l_pointer], NFolder) and isinstance(r_nodes[r_pointer], NFolder):
                 if max_recurse_depth != 0:
-                    diff_child = diff_trees_r(l_nodes[l_pointer], r_nodes[r_pointer], max_recurse_depth-1)
+                    diff_child = diff_trees_r(l_nodes[l_pointer], r_nodes[r_pointer], max_recurse_depth-1, compare_hash, source_base)
+                if diff_child is None:
+                    # Empty on both sides, so there's nothing beneath it to upload; it stays listed
+                    diff_child = _emptied(l_nodes[l_pointer])
             elif isinstance(l_nodes[l_pointer], NFolder) or isinstance(r_nodes[r_pointer], NFolder):
                 # Uh oh, but one of these is
                 logging.warning("One of l_nodes[l_pointer] ({}) or r_nodes[r_pointer] ({}) is not an NFolder, but one is".format(l_nodes[l_pointer], r_nodes[r_pointer]))
 
             if diff_child:
                 diff_node.children.append(diff_child)
+            if not same_listing(diff_child, r_nodes[r_pointer]):
+                dirty = True
 
             # Move up the file pointers
             l_pointer = l_pointer + 1
@@ -108,12 +206,15 @@ def diff_trees_r(local, remote, max_recurse_depth=-1):
             
         elif l_name < r_name:
             # File exists locally but not remotely. We must sync it!
+            if compare_hash:
+                hash_new_nodes(l_nodes[l_pointer], source_base)
             diff_node.children.append(l_nodes[l_pointer])
+            dirty = True
             l_pointer = l_pointer + 1
 
         elif l_name > r_name:
             # File exists remotely but no longer exists locally.
-            # We have no deletion logic for now
+            # We have no deletion logic for now, so it stays listed as it was
             child = r_nodes[r_pointer]
             child.todelete = True
             diff_node.children.append(child)
@@ -133,6 +234,9 @@ def diff_trees_r(local, remote, max_recurse_depth=-1):
 
     # If there were any local nodes remaining, ensure they're processed
     # We can't mark remote children for deletion yet
+    if compare_hash:
+        for child in l_nodes[l_pointer:]:
+            hash_new_nodes(child, source_base)
     diff_node.children.extend(l_nodes[l_pointer:])
 
     # If there were any remote nodes remaining, ensure they're processed
@@ -142,15 +246,16 @@ def diff_trees_r(local, remote, max_recurse_depth=-1):
         child.todelete = True
     diff_node.children.extend(right_children)
 
+    diff_node.dirty = dirty or l_pointer < len(l_nodes)
     return diff_node if len(diff_node.children) > 0 else None
 
 
-def diff_trees(local_root_node, remote_root_node, max_recurse_depth=-1):
+def diff_trees(local_root_node, remote_root_node, max_recurse_depth=-1, compare_hash=False, source_base=None):
     """Find differences between two sets of file trees"""
     # Walk the trees
     # We always want to overwrite remote with the local root
     if max_recurse_depth != 0:
-        diff_child = diff_trees_r(local_root_node, remote_root_node)
+        diff_child = diff_trees_r(local_root_node, remote_root_node, compare_hash=compare_hash, source_base=source_base)
     
     if not diff_child:
         # We always need to return a node
@@ -160,8 +265,320 @@ def diff_trees(local_root_node, remote_root_node, max_recurse_depth=-1):
     return diff_child
 
 
-def backup(args, client):
-    """Backup files to Dropbox"""
+# Actions yielded by stream_diff
+UPLOAD = "upload"
+DELETE = "delete"
+FOLDER = "folder"
+
+
+def _name_key(node):
+    # Names may be bytes or unicode; compare them as unicode
+    return unicode_name(node.name)
+
+
+def _load_remote_folder(remote, client, target, target_folder):
+    """Returns the children listed in a remote folder's metadata, without keeping them"""
+    full_remote_path = remote.generate_remote_path(target, target_folder)
+    children = remote.load_remote_children(remote.fetch_remote_metadata(client, full_remote_path), full_remote_path)
+    remote.children = []
+    return children
+
+
+def _prefetch_ahead(to_fetch, prefetches, pool, client, target, target_folder):
+    """Start fetching the metadata of remote folders from to_fetch until as many are on the way as the pool has workers"""
+    while to_fetch and len(prefetches) < pool.jobs:
+        r_node = to_fetch.popleft()
+        prefetches[_name_key(r_node)] = pool.submit(_load_remote_folder, r_node, client, target, target_folder)
+
+
+def stream_diff(local, remote, source_base, client, target, target_folder, compare_hash=False, include_hidden=False, pool=None, prefetched=None, remote_state=None):
+    """Diff the local tree against the backup one folder at a time
+
+    Yields (action, node, remote node) tuples:
+    - UPLOAD for each new or changed local node, with the remote node it
+      replaces, if any
+    - DELETE for each remote node that no longer exists locally
+    - FOLDER once everything beneath a folder has been yielded, with the
+      folder's children set to what its metadata should list
+
+    Only the folders from the root down to the current one are held, so
+    memory is bounded by depth times the widest folder rather than by the
+    size of the tree, as long as the caller lets go of each folder's
+    children once it has acted on its FOLDER, as stream_upload does.
+
+    local and remote are the roots to start from; remote may be None if
+    nothing is backed up there yet.
+
+    With a WorkerPool, the remote metadata of the next few subfolders (as
+    many as the pool has workers) is fetched on the pool ahead of getting to
+    them, so it's usually there by the time we do. Fetching only a few ahead
+    keeps the listings waiting to be used from growing with the width of
+    the tree.
+
+    Each remote listing is given to remote_state, if there is one, which
+    stream_upload lets go of once the folder is finished.
+    """
+    local._walk_local_dir(local.generate_full_path(source_base), 0, include_hidden)
+    remote_children = []
+    if remote is not None and prefetched is not None:
+        remote_children = prefetched.wait() or []
+    elif remote is not None:
+        remote_children = _load_remote_folder(remote, client, target, target_folder)
+    if remote is not None and remote_state is not None:
+        remote_state.add_listing(local.generate_path(), remote_children)
+    if local.parent is None and remote is not None and remote.uploaded:
+        # The root's metadata is there, so the root folder is too
+        local.uploaded = True
+        if remote_state is not None:
+            remote_state.root_found()
+
+    l_nodes = sorted(local.children, key=_name_key)
+    r_nodes = sorted(remote_children, key=_name_key)
+
+    # Remote subfolders we'll want the metadata of, in the order we'll get to them
+    to_fetch = collections.deque()
+    prefetches = {}
+    if pool is not None:
+        local_folders = set(_name_key(n) for n in l_nodes if isinstance(n, NFolder) and not n.symlink_target)
+        to_fetch.extend(r_node for r_node in r_nodes
+                        if isinstance(r_node, NFolder) and not r_node.symlink_target and _name_key(r_node) in local_folders)
+    merged = []
+    # Whether anything our metadata lists has changed
+    dirty = remote is None
+    l_pointer = 0
+    r_pointer = 0
+
+    _prefetch_ahead(to_fetch, prefetches, pool, client, target, target_folder)
+    while l_pointer < len(l_nodes) or r_pointer < len(r_nodes):
+        l_node = l_nodes[l_pointer] if l_pointer < len(l_nodes) else None
+        r_node = r_nodes[r_pointer] if r_pointer < len(r_nodes) else None
+        if l_node is not None and r_node is not None and _name_key(l_node) != _name_key(r_node):
+            if _name_key(l_node) < _name_key(r_node):
+                r_node = None
+            else:
+                l_node = None
+
+        if l_node is None:
+            # File exists remotely but no longer exists locally.
+            # We have no deletion logic for now, so it stays listed as it was
+            r_node.todelete = True
+            merged.append(r_node)
+            yield DELETE, r_node, None
+            r_pointer = r_pointer + 1
+            continue
+
+        l_pointer = l_pointer + 1
+        if r_node is not None:
+            r_pointer = r_pointer + 1
+            if isinstance(l_node, NFolder) != isinstance(r_node, NFolder):
+                logging.warning("One of {} or {} is not an NFolder, but one is".format(l_node, r_node))
+                r_node = None
+
+        if isinstance(l_node, NFolder) and not l_node.symlink_target:
+            if r_node is not None and not r_node.symlink_target:
+                # Already in the backup, so there's no need to create it
+                l_node.uploaded = True
+            else:
+                r_node = None
+            prefetch = prefetches.pop(_name_key(l_node), None)
+            # Keep the next ones coming while we work through this one
+            _prefetch_ahead(to_fetch, prefetches, pool, client, target, target_folder)
+            for action in stream_diff(l_node, r_node, source_base, client, target, target_folder, compare_hash, include_hidden, pool, prefetch if r_node is not None else None, remote_state):
+                yield action
+            merged.append(l_node)
+            if r_node is None or not same_listing(l_node, r_node):
+                dirty = True
+            continue
+
+        kept = l_node
+        if r_node is not None:
+            if compare_hash and not isinstance(l_node, NFolder) and not l_node.symlink_target and not r_node.symlink_target:
+                kept = diff_file_by_hash(l_node, r_node, source_base)
+            elif same_stats(l_node, r_node):
+                # Node is not different! Use already uploaded one
+                kept = r_node
+        elif compare_hash:
+            hash_new_nodes(l_node, source_base)
+        merged.append(kept)
+        if kept is not r_node:
+            dirty = True
+        if not kept.uploaded:
+            yield UPLOAD, kept, r_node
+
+    local.children = merged
+    local.dirty = dirty
+    yield FOLDER, local, remote
+
+
+def stream_upload(actions, source_base, client, target, target_folder, pool=None, journal=None, chunk_size=None, packer=None, compressor=None, chunk_store=None, remote_state=None, metrics=None):
+    """Carry out the actions from stream_diff
+
+    Uploads run on the pool if there is one. A folder's metadata is only
+    written once its uploads have finished, but we don't wait for them;
+    we carry on handing out uploads, and write finished folders' metadata
+    in the order the folders were finished, so the root still goes last.
+
+    Returns False if any folder's metadata could not be written. Files
+    uploaded, failed and skipped are counted in metrics, if given.
+    """
+    complete = True
+    # Whether any folder so far has metadata to write
+    any_dirty = False
+    # Uploads still running on the pool, by the folder they're in
+    running = {}
+    # Folders waiting on their uploads before their metadata can be written
+    finished = collections.deque()
+    # Files being uploaded, by the folder they're in; only kept if we're counting them
+    uploading = {}
+    options = {
+        "overwrite_mode": True,
+        "max_recurse_depth": 0,
+        "journal": journal,
+        "chunk_size": chunk_size,
+        "packer": packer,
+        "compressor": compressor,
+        "chunk_store": chunk_store,
+        "remote_state": remote_state,
+    }
+
+    def let_go(folder, attempted):
+        if metrics is not None:
+            record_files(metrics, attempted, len([c for c in folder.children if is_file(c) and not c.todelete]))
+        # Its parent's metadata only lists the folder itself
+        folder.children = []
+
+    def write_finished(block):
+        written = True
+        while finished and (block or all(t.done() for t in finished[0][1])):
+            folder, tasks = finished.popleft()
+            wait_all(tasks)
+            if folder.upload(source_base, client, target, target_folder, **options) is False:
+                written = False
+            if packer is not None:
+                # The metadata write may be waiting on packs, and needs the children until then
+                packer.when_packed(folder, functools.partial(let_go, folder, uploading.pop(folder, [])))
+            else:
+                let_go(folder, uploading.pop(folder, []))
+            if remote_state is not None:
+                remote_state.forget(folder.generate_path())
+        return written
+
+    for action, node, remote in actions:
+        if action == UPLOAD:
+            if chunk_store and remote is not None:
+                # The old version of a file shares most of its blocks with the new
+                chunk_store.remember(remote, target)
+            if metrics is not None and is_file(node):
+                uploading.setdefault(node.parent, []).append(node)
+            if pool is not None and not isinstance(node, NFolder):
+                running.setdefault(node.parent, []).append(pool.submit(node.upload, source_base, client, target, target_folder, **options))
+            else:
+                node.upload(source_base, client, target, target_folder, **options)
+        elif action == DELETE:
+            logging.debug("'{}' no longer exists locally".format(node.generate_path()))
+        elif action == FOLDER:
+            if node.parent is None and any_dirty:
+                # The root goes last; rewrite it if anything changed, to record a new generation
+                node.dirty = True
+            any_dirty = any_dirty or node.dirty
+            finished.append((node, running.pop(node, [])))
+        complete = write_finished(False) and complete
+    return write_finished(True) and complete
+
+
+def is_file(node):
+    """True for anything backed up as a file, which includes symlinks to folders"""
+    return not isinstance(node, NFolder) or bool(node.symlink_target)
+
+
+def files_in(node):
+    """Every file beneath a folder"""
+    stack = [node]
+    while stack:
+        for child in stack.pop().children:
+            if is_file(child):
+                yield child
+            else:
+                stack.append(child)
+
+
+def record_files(metrics, attempted, listed):
+    """Count attempted uploads by whether they made it, and the rest of listed files as skipped
+
+    Packed files only make it once their pack does, so count after the packer is closed.
+    """
+    uploaded = len([n for n in attempted if n.uploaded or n.pack])
+    metrics.record_files(uploaded=uploaded, failed=len(attempted) - uploaded, skipped=listed - len(attempted))
+
+
+def get_remote_tree(client, target, target_folder, pool=None, cache=None):
+    """Load the remote tree, from the local cache if it's still current"""
+    remote_node_tree = NRootFolder()
+    root_metadata = None
+    if cache:
+        # One request tells us whether anyone has written to the backup since we cached it
+        root_metadata = remote_node_tree.fetch_remote_metadata(client, remote_node_tree.generate_remote_path(target, target_folder))
+        cached_tree = cache.load(root_metadata.get("generation"))
+        if cached_tree:
+            logging.info("Using locally cached list of remote files")
+            return cached_tree
+
+    # The walk starts from the root metadata we already have, if we do
+    remote_node_tree.walk_remote_tree(client, target, target_folder, pool=pool, root_metadata=root_metadata)
+    return remote_node_tree
+
+
+def detect_renames(diff_root, target, target_folder):
+    """Point new local files at identical files that have gone from the backup
+
+    A removed remote file matches a new local one with the same size and
+    content hash, or the same inode, size and mtime. Matches are copied
+    within Dropbox rather than uploaded. Copied, not moved, as the removed
+    files stay listed in the metadata until we have deletion logic.
+    """
+    by_hash = {}
+    by_inode = {}
+    new_files = []
+
+    def collect(node, removed):
+        for child in node.children:
+            gone = removed or child.todelete
+            if child.symlink_target:
+                continue
+            elif isinstance(child, NFolder):
+                collect(child, gone)
+            elif gone:
+                if child.uploaded and child.size:
+                    if child.hash:
+                        by_hash[(child.size, child.hash)] = child
+                    if child.ino:
+                        by_inode[(child.ino, child.size, child.mtime)] = child
+            elif not child.uploaded and child.size:
+                new_files.append(child)
+    collect(diff_root, False)
+
+    matched = 0
+    for new_file in new_files:
+        source = None
+        if new_file.hash:
+            source = by_hash.get((new_file.size, new_file.hash))
+        if source is None and new_file.ino:
+            source = by_inode.get((new_file.ino, new_file.size, new_file.mtime))
+        if source is not None and (source.pack or source.chunks):
+            # Already sitting in a pack or the block store, so there's nothing to copy
+            new_file.reuse_remote_content(source)
+            matched = matched + 1
+        elif source is not None:
+            new_file.copy_source = source.generate_remote_path(target, target_folder)
+            new_file.hash = new_file.hash or source.hash
+            new_file.compression = source.compression
+            matched = matched + 1
+    logging.info("Found {} renamed files that can be copied in Dropbox".format(matched))
+    return matched
+
+
+def backup(args, client, metrics=None, profiler=None):
+    """Backup files to Dropbox, recording each phase in metrics and profiling it with profiler, if given"""
     if not os.path.exists(args.source):
         raise Exception("Source directory does not exist")
 
@@ -180,48 +597,223 @@ def backup(args, client):
         if e.status != 403:
             raise
 
-    logging.info("Getting a list of already backed up remote files")
-    remote_node_tree = NRootFolder()
-    remote_node_tree.walk_remote_tree_r(client, target, target_folder)
-
-    #pprint.pprint(remote_node_tree.encodable())
-
-    # Generate the local metadata index
-    logging.info("Getting a list of local files")
-    local_node_tree = NRootFolder()
-    local_node_tree.walk_local_tree_r(args.source)
-
-    logging.info("Generating list of which specific files to backup")
-    nodes_to_upload = diff_trees(local_node_tree, remote_node_tree)
-    
-    # Now do the upload
-    nodes_to_upload.upload(args.source, client, target, target_folder, overwrite_mode = True)
-
-
-
-def restore(args, client):
-    """Restore files from a Dropbox backup"""
+    # Local state lives beside the credentials
+    config_dir = os.path.dirname(get_active_config_path("dropbox_backup_credentials"))
+    cache = RemoteTreeCache(config_dir, target, target_folder) if args.cache else None
+    journal = UploadJournal(os.path.join(config_dir, "dropbox_backup_upload_journal"))
+
+    pool = WorkerPool(args.jobs) if args.jobs > 1 else None
+    packer = Packer(client, target, args.pack_threshold * 1024, args.pack_size * 1024 * 1024) if args.pack_threshold > 0 else None
+    compressor = Compressor(args.compress_min_size * 1024, args.compress_level) if args.compress else None
+    chunk_store = None
+    if args.shared_store:
+        # Every file's data goes in the store, unless a threshold says otherwise
+        chunk_store = ChunkStore(client, SHARED_STORE, args.delta_threshold * 1024 * 1024, args.block_size * 1024 * 1024, list_prefixes=True)
+    elif args.delta_threshold > 0:
+        chunk_store = ChunkStore(client, target_store(target), args.delta_threshold * 1024 * 1024, args.block_size * 1024 * 1024)
+    try:
+        if args.stream:
+            logging.info("Backing up one folder at a time")
+            if args.detect_renames or args.scan_processes > 1:
+                logging.warning("--detect-renames and --scan-processes need the whole tree, so are ignored with --stream")
+            local_node_tree = NRootFolder()
+            # The root metadata is written last, so the new generation only lands if we get that far
+            local_node_tree.generation = new_generation()
+            # Scanning runs on its own thread and pool, ahead of the uploads but never by more than the queue
+            scan_pool = WorkerPool(args.jobs) if args.jobs > 1 else None
+            try:
+                remote_state = RemoteState()
+                # Walking, diffing and uploading all overlap, so they're one phase
+                with phase(metrics, "stream", profiler):
+                    actions = stream_diff(local_node_tree, NRootFolder(), args.source, client, target, target_folder, compare_hash=args.compare == "hash", include_hidden=args.include_hidden, pool=scan_pool, remote_state=remote_state)
+                    complete = stream_upload(background(actions, args.queue_size), args.source, client, target, target_folder, pool=pool, journal=journal, chunk_size=args.chunk_size * 1024 * 1024, packer=packer, compressor=compressor, chunk_store=chunk_store, remote_state=remote_state, metrics=metrics)
+            finally:
+                if scan_pool:
+                    scan_pool.close()
+            # We never hold the whole tree, so there's nothing to cache
+            nodes_to_upload = None
+        else:
+            logging.info("Getting a list of already backed up remote files")
+            with phase(metrics, "remote_walk", profiler):
+                remote_node_tree = get_remote_tree(client, target, target_folder, pool, cache)
+                if chunk_store:
+                    chunk_store.seed(remote_node_tree, target)
+            # What's already there, so uploads don't each have to ask Dropbox
+            remote_state = RemoteState(remote_node_tree)
+
+            #pprint.pprint(remote_node_tree.encodable())
+
+            # Generate the local metadata index
+            logging.info("Getting a list of local files")
+            local_node_tree = NRootFolder()
+            with phase(metrics, "local_walk", profiler):
+                if args.scan_processes > 1:
+                    local_node_tree.walk_local_tree_sharded(args.source, args.scan_processes, include_hidden=args.include_hidden)
+                else:
+                    local_node_tree.walk_local_tree_r(args.source, include_hidden=args.include_hidden)
+
+            logging.info("Generating list of which specific files to backup")
+            with phase(metrics, "diff", profiler):
+                nodes_to_upload = diff_trees(local_node_tree, remote_node_tree, compare_hash=args.compare == "hash", source_base=args.source)
+
+                if args.detect_renames:
+                    detect_renames(nodes_to_upload, target, target_folder)
+
+            # Now do the upload
+            if tree_is_dirty(nodes_to_upload) or not remote_node_tree.generation:
+                # The root metadata is written last, so the new generation only lands if we get that far
+                nodes_to_upload.dirty = True
+                nodes_to_upload.generation = new_generation()
+            else:
+                logging.info("Nothing has changed since the last backup")
+                nodes_to_upload.generation = remote_node_tree.generation
+            if metrics is not None:
+                # Once uploaded we can't tell these from the ones that already were
+                attempted = [n for n in files_in(nodes_to_upload) if not n.uploaded and not n.todelete]
+            with phase(metrics, "upload", profiler):
+                complete = nodes_to_upload.upload(args.source, client, target, target_folder, overwrite_mode = True, pool=pool, journal=journal, chunk_size=args.chunk_size * 1024 * 1024, packer=packer, compressor=compressor, chunk_store=chunk_store, remote_state=remote_state)
+
+        if packer:
+            # Upload the last partly filled pack, and the metadata waiting on it
+            with phase(metrics, "upload", profiler):
+                complete = packer.close() and complete
+        if metrics is not None and nodes_to_upload is not None:
+            record_files(metrics, attempted, sum(1 for n in files_in(local_node_tree)))
+
+        if cache:
+            if complete and nodes_to_upload is not None:
+                cache.store(nodes_to_upload)
+            else:
+                # Some folder metadata didn't make it, or we streamed it, so only a full walk can be trusted next time
+                cache.clear()
+    finally:
+        if pool:
+            pool.close()
+    return complete
+
+
+def restore(args, client, metrics=None, profiler=None):
+    """Restore files from a Dropbox backup, recording each phase in metrics and profiling it with profiler, if given"""
     if not os.path.exists(args.destination):
         raise Exception("Restore directory does not exist")
 
     source, source_folder = parse_target(args.source)
 
-    nodes_to_restore = NRootFolder()
-    nodes_to_restore.walk_remote_tree_r(client, source, source_folder)
+    pool = WorkerPool(args.jobs) if args.jobs > 1 else None
+    try:
+        nodes_to_restore = NRootFolder()
+        with phase(metrics, "remote_walk", profiler):
+            nodes_to_restore.walk_remote_tree(client, source, source_folder, pool=pool)
 
-    # @TODO: Some logic to prevent overwriting the local tree unless we want to...
-    print "Restoring these files and folders:"
-    pprint.pprint(nodes_to_restore.encodable())
+        # @TODO: Some logic to prevent overwriting the local tree unless we want to...
+        print "Restoring these files and folders:"
+        pprint.pprint(nodes_to_restore.encodable())
 
-    nodes_to_restore.restore(args.destination, client, source, source_folder, overwrite_mode=True)
+        with phase(metrics, "restore", profiler):
+            nodes_to_restore.restore(args.destination, client, source, source_folder, overwrite_mode=True, pool=pool)
+    finally:
+        if pool:
+            pool.close()
 
 
-def rebuild(args, client):
-    """Rebuild the file/folder index in a Dropbox backup"""
+def rebuild(args, client, metrics=None, profiler=None):
+    """Rebuild the file/folder index in a Dropbox backup, recording each phase in metrics and profiling it with profiler, if given"""
     target, target_folder = parse_target(args.target)
 
-    remote_node_tree = NRootFolder()
-    remote_node_tree.rewrite_index_without_assumption_tree_r(client, target, target_folder)
+    # The listing and its cursor live beside the credentials, so the next rebuild only lists what changed
+    listing = RemoteListing(os.path.dirname(get_active_config_path("dropbox_backup_credentials")), target, target_folder)
+    if not args.full:
+        listing.load()
+
+    pool = WorkerPool(args.jobs) if args.jobs > 1 else None
+    try:
+        logging.info("Listing the backup")
+        with phase(metrics, "listing", profiler):
+            listing.update(client)
+        with phase(metrics, "rebuild", profiler):
+            remote_node_tree, complete = rebuild_index(client, listing, pool)
+        listing.save()
+        if not complete:
+            logging.error("Some of the index could not be rewritten; run rebuild again")
+    finally:
+        if pool:
+            pool.close()
+    return complete
+
+
+def backup_parser():
+    """Command line arguments of the backup command"""
+    parser = argparse.ArgumentParser(description='Backup files to Dropbox')
+    parser.add_argument('command', help="Command to run")
+    parser.add_argument('source', help="Source folder")
+    parser.add_argument('destination', help="Dropbox target (In the form <backup-root-name>:/subfolder)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of parallel Dropbox requests when walking and uploading (Default 1)")
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="Walk the whole remote backup rather than using the local cache of it")
+    parser.add_argument('--include-hidden', action='store_true', help="Also back up hidden files and folders (names starting with '.')")
+    parser.add_argument('--scan-processes', type=int, default=1, help="Number of processes used to scan the source folder (Default 1)")
+    parser.add_argument('--compare', choices=['stat', 'hash'], default='stat', help="Decide whether a file changed by its size/mtime/mode/owner, or by hashing its content (Default stat)")
+    parser.add_argument('--stream', action='store_true', help="Compare and upload one folder at a time rather than loading both whole trees first, to bound memory use on very large trees")
+    parser.add_argument('--queue-size', type=int, default=1000, help="With --stream, how many changes the scan may find before it waits for uploads to catch up (Default 1000)")
+    parser.add_argument('--detect-renames', action='store_true', help="Copy renamed or moved files within Dropbox instead of uploading them again")
+    parser.add_argument('--chunk-size', type=int, default=NFile.CHUNK_SIZE / (1024 * 1024), help="Size in MB of each chunk when uploading large files (Default {})".format(NFile.CHUNK_SIZE / (1024 * 1024)))
+    parser.add_argument('--pack-threshold', type=int, default=0, help="Pack files smaller than this many KB together instead of uploading them one by one (Default 0, off)")
+    parser.add_argument('--pack-size', type=int, default=8, help="Size in MB of each pack of small files (Default 8)")
+    parser.add_argument('--compress', action='store_true', help="Compress files before uploading them, skipping formats that are already compressed")
+    parser.add_argument('--compress-min-size', type=int, default=64, help="Only compress files of at least this many KB (Default 64)")
+    parser.add_argument('--compress-level', type=int, choices=range(1, 10), default=6, metavar='{1-9}', help="zlib compression level (Default 6)")
+    parser.add_argument('--delta-threshold', type=int, default=0, help="Store files of at least this many MB as blocks, so only changed blocks are uploaded (Default 0, off)")
+    parser.add_argument('--shared-store', action='store_true', help="Store file data as blocks in a store shared by every target, so identical data is only uploaded once")
+    parser.add_argument('--block-size', type=int, default=4, help="Size in MB of each block of a file stored as blocks (Default 4)")
+    add_retry_arguments(parser)
+    add_report_arguments(parser)
+    return parser
+
+
+def add_retry_arguments(parser):
+    """Command line arguments for retrying failed Dropbox requests, shared by every command that talks to a backup"""
+    parser.add_argument('--retries', type=int, default=5, help="Times to retry a Dropbox request that was throttled, failed on Dropbox's side or lost its connection, backing off between tries (Default 5, 0 to never retry)")
+
+
+def add_report_arguments(parser):
+    """Command line arguments for reporting on a run, shared by every command that talks to a backup"""
+    parser.add_argument('--report', metavar='FILE', help="Write a JSON report of the run to FILE: time spent in each phase, Dropbox requests and bytes, and files uploaded, failed and skipped")
+    parser.add_argument('--prometheus', metavar='FILE', help="Write the same report to FILE in the Prometheus text format, for node_exporter's textfile collector")
+    parser.add_argument('--profile', metavar='DIR', help="Profile each phase of the run separately, writing their stats to DIR")
+    parser.add_argument('--profile-sample', type=int, metavar='MS', help="With --profile, sample every thread's stack every MS milliseconds rather than tracing every call, for long runs")
+
+
+def run_command(command, args, client, target):
+    """Run one of backup, restore or rebuild, writing a report or profile of it if asked to
+
+    Requests that fail for reasons that pass are retried, and the number
+    in flight adapts to what Dropbox will take, up to --jobs.
+    """
+    metrics = None
+    if args.report or args.prometheus:
+        metrics = Metrics(command.__name__, target)
+        # Beneath the retries, so every try is recorded
+        client = InstrumentedClient(client, metrics)
+    if args.retries > 0:
+        # A streamed backup scans on a pool of its own, alongside the uploads
+        most = args.jobs * 2 if getattr(args, "stream", False) else args.jobs
+        client = RetryingClient(client, args.retries, limit=AdaptiveLimit(most))
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile, command.__name__, args.profile_sample / 1000.0 if args.profile_sample else None)
+    success = False
+    try:
+        result = command(args, client, metrics=metrics, profiler=profiler)
+        success = result is not False
+        return result
+    finally:
+        if profiler:
+            profiler.close()
+        if metrics:
+            metrics.finish(success)
+            if args.report:
+                metrics.write_json(args.report)
+            if args.prometheus:
+                metrics.write_prometheus(args.prometheus)
 
 
 def connect():
@@ -305,12 +897,9 @@ def main():
         
         if command == "backup":
             logging.info("Preparing to backup files")
-            parser = argparse.ArgumentParser(description='Backup files to Dropbox')
-            parser.add_argument('command', help="Command to run")
-            parser.add_argument('source', help="Source folder")
-            parser.add_argument('destination', help="Dropbox target (In the form <backup-root-name>:/subfolder)")
+            parser = backup_parser()
             args = parser.parse_args([command].extend(remainder_args))
-            backup(args, client)
+            run_command(backup, args, client, args.destination)
 
         elif command == "restore":
             logging.info("Preparing to restore files")
@@ -318,16 +907,23 @@ def main():
             parser.add_argument('command', help="Command to run")
             parser.add_argument('source', help="Dropbox source (In the form <backup-root-name>:/subfolder)")
             parser.add_argument('destination', help="Destination folder")
+            parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of parallel Dropbox requests when walking the backup and restoring files (Default 1)")
+            add_retry_arguments(parser)
+            add_report_arguments(parser)
             args = parser.parse_args([command].extend(remainder_args))
-            restore(args, client)
+            run_command(restore, args, client, args.source)
 
         elif command == "rebuild":
             logging.info("Rebuilding the backup index")
             parser = argparse.ArgumentParser(description='Rebuild the backup index in Dropbox, in case the initial backup fails, files have been deleted from Dropbox, or the index is corrupted')
             parser.add_argument('command', help="Command to run")
             parser.add_argument('target', help="Target to rebuild (In the form <backup-root-name>:/subfolder)")
+            parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of parallel Dropbox requests when reading and rewriting the index (Default 1)")
+            parser.add_argument('--full', action='store_true', help="List the whole backup again rather than only what changed since the last rebuild")
+            add_retry_arguments(parser)
+            add_report_arguments(parser)
             args = parser.parse_args([command].extend(remainder_args))
-            rebuild(args, client)
+            run_command(rebuild, args, client, args.target)
 
         else:
             raise Exception("Please specify a valid command")
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.backup_test
+    ~~~~~~~~~~~~~~
+
+    Tests the backup application
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import backup
+from node import NRootFolder, NFile
+from hashing import hash_file
+from remotestate import RemoteState
+from workers import WorkerPool, background
+from node_test import _StoreClient
+
+
+class TestDiffTrees(unittest.TestCase):
+    """Test diff_trees"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        for name in ["touched", "edited", "same"]:
+            self._write(name, "original", 100)
+
+        # Back the files up as they are now
+        self.remote = NRootFolder()
+        self.remote.walk_local_tree_r(self.source)
+        for child in self.remote.children:
+            child.compute_hash(self.source)
+            child.uploaded = True
+
+        self._write("touched", "original", 200)
+        # Same size, and the mtime put back afterwards
+        self._write("edited", "ORIGINAL", 100)
+
+    def _write(self, name, content, mtime):
+        path = os.path.join(self.source, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def _diff(self, compare_hash):
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        diff = backup.diff_trees(local, self.remote, compare_hash=compare_hash, source_base=self.source)
+        return {c.name: c for c in diff.children}
+
+    def test_stat_compare(self):
+        """By default, only changed stats mean a file is uploaded"""
+        diff = self._diff(False)
+        self.assertFalse(diff["touched"].uploaded)
+        self.assertTrue(diff["edited"].uploaded)
+        self.assertTrue(diff["same"].uploaded)
+
+    def test_hash_compare(self):
+        """Comparing hashes catches edits and skips re-uploading touched files"""
+        diff = self._diff(True)
+        self.assertTrue(diff["touched"].uploaded)
+        self.assertEqual(diff["touched"].mtime, 200)
+        self.assertFalse(diff["edited"].uploaded)
+        self.assertEqual(diff["edited"].hash, hash_file(os.path.join(self.source, "edited")))
+        self.assertTrue(diff["same"].uploaded)
+
+    def test_hash_compare_adopts_unhashed_backup(self):
+        """Files backed up without a hash aren't uploaded again just to get one"""
+        for child in self.remote.children:
+            child.hash = None
+        diff = self._diff(True)
+        self.assertTrue(diff["same"].uploaded)
+        self.assertEqual(diff["same"].encodable()["stats"]["hash"], hash_file(os.path.join(self.source, "same")))
+
+class _CopyClient(object):
+    """Records copies and uploads"""
+
+    def __init__(self):
+        self.copies = []
+        self.puts = []
+
+    def metadata(self, path, list=True):
+        return {"is_dir": True}
+
+    def file_create_folder(self, path):
+        pass
+
+    def file_copy(self, from_path, to_path):
+        self.copies.append((from_path, to_path))
+
+    def put_file(self, path, file_obj, overwrite=False):
+        self.puts.append(path)
+
+
+class TestDetectRenames(unittest.TestCase):
+    """Test detect_renames"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        os.makedirs(os.path.join(self.source, "old"))
+        for name in ["moved", "copied", "unrelated"]:
+            with open(os.path.join(self.source, "old", name), "w") as f:
+                f.write(name)
+
+        self.remote = NRootFolder()
+        self.remote.walk_local_tree_r(self.source)
+        self.remote.children[0].uploaded = True
+        for child in self.remote.children[0].children:
+            child.compute_hash(self.source)
+            child.uploaded = True
+
+        # Reorganise: move one file by rename, the other by copy + delete
+        os.rename(os.path.join(self.source, "old"), os.path.join(self.source, "new"))
+        shutil.copy2(os.path.join(self.source, "new", "copied"), os.path.join(self.source, "copied"))
+        os.unlink(os.path.join(self.source, "new", "copied"))
+        with open(os.path.join(self.source, "new", "unrelated"), "w") as f:
+            f.write("different")
+
+    def _diff(self, compare_hash):
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        diff = backup.diff_trees(local, self.remote, compare_hash=compare_hash, source_base=self.source)
+        backup.detect_renames(diff, "t", "/x")
+        return diff
+
+    def test_renames_by_hash(self):
+        """Moved content is found by hash, wherever it went"""
+        diff = self._diff(True)
+        children = {c.name: c for c in diff.children}
+        moved = {c.name: c for c in children["new"].children}
+        self.assertEqual(moved["moved"].copy_source, "/t/data/x/old/moved")
+        self.assertEqual(children["copied"].copy_source, "/t/data/x/old/copied")
+        self.assertIsNone(moved["unrelated"].copy_source)
+
+        client = _CopyClient()
+        diff.upload(self.source, client, "t", "/x")
+        self.assertIn(("/t/data/x/old/moved", "/t/data/x/new/moved"), client.copies)
+        self.assertNotIn("/t/data/x/new/moved", client.puts)
+        self.assertIn("/t/data/x/new/unrelated", client.puts)
+
+    def test_renames_by_inode(self):
+        """Without hashes, a renamed file is found by inode"""
+        diff = self._diff(False)
+        children = {c.name: c for c in diff.children}
+        moved = {c.name: c for c in children["new"].children}
+        self.assertEqual(moved["moved"].copy_source, "/t/data/x/old/moved")
+        # A copy is a new inode
+        self.assertIsNone(children["copied"].copy_source)
+
+
+class TestDirtyTracking(unittest.TestCase):
+    """Test that only changed folders have their metadata rewritten"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        for folder in ["a", "b"]:
+            os.makedirs(os.path.join(self.source, folder, "deeper"))
+            for name in ["x", os.path.join("deeper", "y")]:
+                with open(os.path.join(self.source, folder, name), "w") as f:
+                    f.write(name)
+        self.client = _StoreClient()
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        local.upload(self.source, self.client, "t", "/")
+
+    def _count_probes(self):
+        """Record every path looked up or created in Dropbox"""
+        probes = []
+        metadata = self.client.metadata
+        def probe(path, list=True, file_limit=None):
+            if not list:
+                probes.append(path)
+            return metadata(path, list, file_limit)
+        self.client.metadata = probe
+        self.client.file_create_folder = probes.append
+        return probes
+
+    def _backup(self, use_remote_state=False):
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        remote = NRootFolder()
+        remote.walk_remote_tree_r(self.client, "t", "/")
+        diff = backup.diff_trees(local, remote)
+        remote_state = RemoteState(remote) if use_remote_state else None
+        del self.client.puts[:]
+        with WorkerPool(2) as pool:
+            self.assertTrue(diff.upload(self.source, self.client, "t", "/", pool=pool, remote_state=remote_state))
+        return diff, sorted(self.client.puts)
+
+    def test_nothing_changed(self):
+        """A backup with no changes writes nothing"""
+        diff, puts = self._backup()
+        self.assertFalse(backup.tree_is_dirty(diff))
+        self.assertEqual(puts, [])
+
+    def test_only_changed_folders_are_rewritten(self):
+        """Only the folders holding changes get new metadata"""
+        with open(os.path.join(self.source, "a", "deeper", "z"), "w") as f:
+            f.write("new")
+        os.unlink(os.path.join(self.source, "b", "x"))
+        diff, puts = self._backup()
+        self.assertTrue(backup.tree_is_dirty(diff))
+        # Parents are rewritten too, as the changes alter their children's mtimes. b still lists
+        # the deleted x, as we don't propagate deletions, so its listing hasn't changed
+        self.assertEqual(puts, ["/t/data/.dropboxbackupmeta", "/t/data/a/.dropboxbackupmeta", "/t/data/a/deeper/.dropboxbackupmeta",
+                                "/t/data/a/deeper/z"])
+
+    def test_empty_folder_stays_listed(self):
+        """An empty folder is backed up once, then left alone by backups with no changes"""
+        os.makedirs(os.path.join(self.source, "a", "empty"))
+        self._backup()
+        for i in range(2):
+            diff, puts = self._backup()
+            self.assertFalse(backup.tree_is_dirty(diff))
+            self.assertEqual(puts, [])
+        listed = json.loads(self.client.files["/t/data/a/.dropboxbackupmeta"])["children"]
+        self.assertIn("empty", [c["name"] for c in listed])
+
+    def test_deleted_files_dont_rewrite_every_run(self):
+        """Once a deletion has been backed up, later backups with no changes write nothing"""
+        os.unlink(os.path.join(self.source, "b", "deeper", "y"))
+        self._backup()
+        diff, puts = self._backup()
+        self.assertFalse(backup.tree_is_dirty(diff))
+        self.assertEqual(puts, [])
+
+        del self.client.puts[:]
+        stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, self.client, "t", "/")
+        self.assertTrue(backup.stream_upload(stream, self.source, self.client, "t", "/"))
+        self.assertEqual(self.client.puts, [])
+
+    def test_remote_state_saves_probes(self):
+        """Only nodes the remote tree knows nothing about are looked up in Dropbox"""
+        os.makedirs(os.path.join(self.source, "c"))
+        for name in [os.path.join("a", "z"), os.path.join("c", "w")]:
+            with open(os.path.join(self.source, name), "w") as f:
+                f.write(name)
+        probes = self._count_probes()
+        self._backup(use_remote_state=True)
+        # c isn't in the root's metadata yet, and the folders that changed are created again
+        self.assertEqual(sorted(probes), ["/t/data//c", "/t/data/a", "/t/data/c"])
+        self.assertEqual(self.client.files["/t/data/c/w"], "c/w")
+
+    def test_nothing_changed_makes_no_probes(self):
+        """A backup with no changes doesn't ask Dropbox about anything, the root included"""
+        probes = self._count_probes()
+        self._backup(use_remote_state=True)
+        self.assertEqual(probes, [])
+
+        remote_state = RemoteState()
+        stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, self.client, "t", "/", remote_state=remote_state)
+        self.assertTrue(backup.stream_upload(stream, self.source, self.client, "t", "/", remote_state=remote_state))
+        self.assertEqual(probes, [])
+
+    def test_stream_nothing_changed(self):
+        """A streamed backup with no changes writes nothing either"""
+        del self.client.puts[:]
+        stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, self.client, "t", "/")
+        self.assertTrue(backup.stream_upload(stream, self.source, self.client, "t", "/"))
+        self.assertEqual(self.client.puts, [])
+
+
+class _WatchedPool(object):
+    """Passes tasks to a WorkerPool, counting the most submitted at once that nobody has waited for yet"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.jobs = pool.jobs
+        self.waiting = 0
+        self.most_waiting = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.waiting = self.waiting + 1
+        self.most_waiting = max(self.most_waiting, self.waiting)
+        return _WatchedTask(self.pool.submit(fn, *args, **kwargs), self)
+
+
+class _WatchedTask(object):
+    def __init__(self, task, pool):
+        self.task = task
+        self.pool = pool
+
+    def wait(self):
+        self.pool.waiting = self.pool.waiting - 1
+        return self.task.wait()
+
+
+class TestStreamDiff(unittest.TestCase):
+    """Test stream_diff and stream_upload"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        os.makedirs(os.path.join(self.source, "a", "b"))
+        for name in ["keep", "changes", os.path.join("a", "x"), os.path.join("a", "b", "y")]:
+            with open(os.path.join(self.source, name), "w") as f:
+                f.write(name)
+
+        # Two identical backups to compare the two ways of updating them
+        self.clients = [_StoreClient(), _StoreClient()]
+        for client in self.clients:
+            local = NRootFolder()
+            local.walk_local_tree_r(self.source)
+            local.upload(self.source, client, "t", "/")
+
+        with open(os.path.join(self.source, "changes"), "w") as f:
+            f.write("changed content")
+        os.unlink(os.path.join(self.source, "a", "b", "y"))
+        with open(os.path.join(self.source, "a", "new"), "w") as f:
+            f.write("new")
+
+    def _metadata(self, client):
+        def normalise(meta):
+            meta.pop("generation", None)
+            meta["children"] = sorted(meta.get("children", []), key=lambda c: c["name"])
+            return meta
+        return {path: normalise(json.loads(data)) for path, data in client.files.items() if path.endswith(".dropboxbackupmeta")}
+
+    def _whole_tree_backup(self, client):
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        remote = NRootFolder()
+        remote.walk_remote_tree_r(client, "t", "/")
+        backup.diff_trees(local, remote).upload(self.source, client, "t", "/")
+
+    def test_stream_matches_whole_tree_backup(self):
+        """Streaming yields just the changes, and leaves the same metadata as diffing whole trees"""
+        whole, streamed = self.clients
+        self._whole_tree_backup(whole)
+
+        actions = []
+        def record(actions_in):
+            for action in actions_in:
+                actions.append((action[0], action[1].generate_path()))
+                yield action
+        with WorkerPool(2) as pool:
+            stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, streamed, "t", "/")
+            self.assertTrue(backup.stream_upload(record(stream), self.source, streamed, "t", "/", pool=pool))
+
+        self.assertEqual(sorted(a for a in actions if a[0] != backup.FOLDER),
+                         [(backup.DELETE, "a/b/y"), (backup.UPLOAD, "a/new"), (backup.UPLOAD, "changes")])
+        # Folders finish children first, and the root last
+        folders = [path for action, path in actions if action == backup.FOLDER]
+        self.assertEqual(folders, ["a/b", "a", ""])
+        self.assertEqual(self._metadata(streamed), self._metadata(whole))
+        self.assertEqual(streamed.files["/t/data/changes"], "changed content")
+
+    def test_pipelined_stream_matches_whole_tree_backup(self):
+        """Scanning on its own thread and prefetching remote folders changes nothing but speed"""
+        whole, streamed = self.clients
+        self._whole_tree_backup(whole)
+
+        with WorkerPool(2) as scan_pool:
+            with WorkerPool(2) as pool:
+                remote_state = RemoteState()
+                stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, streamed, "t", "/", pool=scan_pool, remote_state=remote_state)
+                self.assertTrue(backup.stream_upload(background(stream, 1), self.source, streamed, "t", "/", pool=pool, remote_state=remote_state))
+        # Each folder's listing is let go of once it's finished
+        self.assertEqual(remote_state.listings, {})
+        self.assertEqual(self._metadata(streamed), self._metadata(whole))
+
+    def test_prefetching_is_bounded(self):
+        """Only as many remote folders are fetched ahead as there are workers, however wide the tree"""
+        whole, streamed = self.clients
+        for i in range(10):
+            os.makedirs(os.path.join(self.source, "wide", str(i)))
+            with open(os.path.join(self.source, "wide", str(i), "f"), "w") as f:
+                f.write("f")
+        self._whole_tree_backup(whole)
+        self._whole_tree_backup(streamed)
+
+        with WorkerPool(2) as pool:
+            watched = _WatchedPool(pool)
+            stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, streamed, "t", "/", pool=watched)
+            self.assertEqual([a for a, n, r in stream if a != backup.FOLDER], [backup.DELETE])
+        self.assertEqual(watched.waiting, 0)
+        # A window for each level we're down, rather than all ten of wide's at once
+        self.assertLessEqual(watched.most_waiting, 2 * 2)
+
+    def test_stream_lists_new_folders(self):
+        """A folder created by a streamed backup is listed by its parent, so the next one skips it"""
+        whole, streamed = self.clients
+        os.makedirs(os.path.join(self.source, "a", "c"))
+        with open(os.path.join(self.source, "a", "c", "z"), "w") as f:
+            f.write("z")
+        self._whole_tree_backup(whole)
+
+        # Walking runs ahead of uploading, as it does in a backup
+        stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, streamed, "t", "/")
+        self.assertTrue(backup.stream_upload(background(stream, 4), self.source, streamed, "t", "/"))
+        self.assertEqual(self._metadata(streamed), self._metadata(whole))
+        stream = backup.stream_diff(NRootFolder(), NRootFolder(), self.source, streamed, "t", "/")
+        self.assertEqual([(a, n.generate_path()) for a, n, r in stream if a != backup.FOLDER], [(backup.DELETE, "a/b/y")])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.benchmark
+    ~~~~~~~~~~~~~~
+
+    Benchmarks for the backup pipeline, run as
+    `python benchmark.py <benchmark>`
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import backup
+from compression import Compressor, COMPRESS_BLOCK_SIZE
+from fakeclient import FakeDropboxClient
+from node import NRootFolder, NFolder, NFile
+from workers import WorkerPool
+
+
+def _text_sample(size):
+    """Log-like text, roughly as compressible as real logs and SQL dumps"""
+    lines = []
+    length = 0
+    i = 0
+    while length < size:
+        line = "2015-06-{:02d} 12:{:02d}:{:02d} INFO request id={} path=/api/items/{} status=200 took={}ms\n".format(
+            i % 28 + 1, i % 60, (i * 7) % 60, i * 7919 % 100003, i % 977, i % 250)
+        lines.append(line)
+        length = length + len(line)
+        i = i + 1
+    return "".join(lines)[:size]
+
+
+def _write_samples(folder, size):
+    samples = {
+        "text": _text_sample(size),
+        "random": os.urandom(size),
+    }
+    paths = {}
+    for name, data in samples.items():
+        paths[name] = os.path.join(folder, name)
+        with open(paths[name], "wb") as f:
+            f.write(data)
+    return paths
+
+
+def benchmark_compression(size, bandwidth, level):
+    """Time the compression stage on and off for compressible and incompressible data
+
+    The stage only pays off if the time spent compressing is less than the
+    time saved sending fewer bytes, so each run is reported with the time it
+    would take over an uplink of `bandwidth` MB/s.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        paths = _write_samples(folder, size)
+        compressor = Compressor(level=level)
+        print "{:<8} {:<5} {:>10} {:>10} {:>12} {:>12}".format("data", "stage", "MB/s", "ratio", "sent MB", "upload s")
+        for name in sorted(paths):
+            for enabled in [False, True]:
+                started = time.time()
+                with open(paths[name], "rb") as file_h:
+                    if enabled:
+                        compressed = compressor.compress(file_h)
+                    else:
+                        compressed = None
+                        while file_h.read(COMPRESS_BLOCK_SIZE):
+                            pass
+                if compressed:
+                    compressed_h, sent = compressed
+                    compressed_h.close()
+                else:
+                    # Not worth it, or not tried; the file goes up as-is
+                    sent = size
+                elapsed = max(time.time() - started, 1e-6)
+
+                print "{:<8} {:<5} {:>10.1f} {:>10.2f} {:>12.1f} {:>12.1f}".format(
+                    name, "on" if enabled else "off",
+                    size / elapsed / (1024 * 1024),
+                    float(size) / sent,
+                    float(sent) / (1024 * 1024),
+                    elapsed + float(sent) / (bandwidth * 1024 * 1024))
+    finally:
+        shutil.rmtree(folder)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def build_tree(nodes, fanout):
+    """Build an in-memory tree of about `nodes` nodes, `fanout` files to a folder"""
+    stats = {"uid": 1000, "gid": 1000, "mode": 0o100644, "mtime": 1434000000, "ctime": 1434000000, "size": 4096}
+    root = NRootFolder()
+    folders = [root]
+    made = 1
+    i = 0
+    while made < nodes:
+        parent = folders[i]
+        i = i + 1
+        for j in range(fanout):
+            if made >= nodes:
+                break
+            if j < max(1, fanout // 10):
+                # A tenth of each folder is subfolders, so the tree is deep as well as wide
+                folder = NFolder(parent, "dir{}".format(j), stats)
+                parent.children.append(folder)
+                folders.append(folder)
+            else:
+                parent.children.append(NFile(parent, "file{}.txt".format(j), stats))
+            made = made + 1
+        if i >= len(folders):
+            break
+    return root, made
+
+
+def benchmark_tree(nodes, fanout):
+    """Memory and time used by a tree of `nodes` nodes, and by generating every path in it"""
+    rss_before = _peak_rss_mb()
+    started = time.time()
+    root, made = build_tree(nodes, fanout)
+    built = time.time() - started
+    rss_after = _peak_rss_mb()
+
+    started = time.time()
+    stack = [root]
+    while stack:
+        n = stack.pop()
+        n.generate_path()
+        if isinstance(n, NFolder):
+            stack.extend(n.children)
+    paths = time.time() - started
+
+    print "nodes:            {}".format(made)
+    print "build:            {:.1f}s".format(built)
+    print "generate paths:   {:.1f}s".format(paths)
+    print "peak RSS growth:  {:.0f} MB ({:.0f} bytes a node)".format(rss_after - rss_before, (rss_after - rss_before) * 1024 * 1024 / made)
+
+
+# File sizes for generate_source, as (weight, smallest, largest) in bytes
+SIZE_DISTRIBUTIONS = {
+    "small": [(1, 0, 16 * 1024)],
+    "mixed": [(90, 0, 16 * 1024), (9, 16 * 1024, 1024 * 1024), (1, 1024 * 1024, 8 * 1024 * 1024)],
+    "large": [(1, 1024 * 1024, 16 * 1024 * 1024)],
+}
+
+
+def _pick_size(rng, distribution):
+    weights = SIZE_DISTRIBUTIONS[distribution]
+    choice = rng.uniform(0, sum(w for w, _, _ in weights))
+    for weight, smallest, largest in weights:
+        if choice < weight:
+            break
+        choice = choice - weight
+    return rng.randint(smallest, largest)
+
+
+def generate_source(folder, depth, fanout, files, distribution="mixed", symlinks=0.05, seed=0):
+    """Write a deterministic tree of files to folder
+
+    Each folder down to `depth` has `fanout` subfolders and `files` entries,
+    about `symlinks` of them symlinks to a sibling, the rest files sized from
+    SIZE_DISTRIBUTIONS. The same arguments always give the same tree.
+
+    Returns the number of files, folders and symlinks, and the bytes written.
+    """
+    rng = random.Random(seed)
+    # Content is cut from one random block, so it's cheap but doesn't compress
+    noise = "".join(chr(rng.getrandbits(8)) for _ in range(1024 * 1024))
+    counts = {"files": 0, "folders": 0, "symlinks": 0, "bytes": 0}
+    stack = [(folder, 0)]
+    while stack:
+        path, level = stack.pop()
+        for i in range(files):
+            name = "file{}.dat".format(i)
+            if i and rng.random() < symlinks:
+                os.symlink("file0.dat", os.path.join(path, name))
+                counts["symlinks"] = counts["symlinks"] + 1
+                continue
+            size = _pick_size(rng, distribution)
+            with open(os.path.join(path, name), "wb") as f:
+                written = 0
+                while written < size:
+                    start = rng.randint(0, len(noise) - 1)
+                    block = noise[start:start + size - written]
+                    f.write(block)
+                    written = written + len(block)
+            counts["files"] = counts["files"] + 1
+            counts["bytes"] = counts["bytes"] + size
+        if level < depth:
+            for i in range(fanout):
+                subfolder = os.path.join(path, "dir{}".format(i))
+                os.mkdir(subfolder)
+                counts["folders"] = counts["folders"] + 1
+                stack.append((subfolder, level + 1))
+    return counts
+
+
+def _change_source(folder, fraction, seed=0):
+    """Append to a fraction of the files in folder, as a day's edits might"""
+    rng = random.Random(seed)
+    changed = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path) and rng.random() < fraction:
+                with open(path, "ab") as f:
+                    f.write("changed")
+                changed = changed + 1
+    return changed
+
+
+class _Stages(object):
+    """Times each stage, with the requests it made and the peak RSS after it"""
+
+    def __init__(self, client):
+        self.client = client
+        self.results = {}
+        self.order = []
+
+    def run(self, name, items, fn):
+        requests = dict(self.client.requests)
+        started = time.time()
+        result = fn()
+        elapsed = max(time.time() - started, 1e-6)
+        made = dict((method, count - requests.get(method, 0)) for method, count in self.client.requests.items() if count - requests.get(method, 0))
+        self.results[name] = {
+            "seconds": round(elapsed, 3),
+            "items_per_second": round(items / elapsed, 1),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "requests": sum(made.values()),
+            "requests_by_method": made,
+        }
+        self.order.append(name)
+        return result
+
+
+def benchmark_suite(depth, fanout, files, distribution, symlinks, seed, jobs, latency, bandwidth, change):
+    """Time each stage of a backup of a synthetic tree against an offline client"""
+    work = tempfile.mkdtemp()
+    saved_config = backup.CONFIG_SEARCH_PATHS
+    try:
+        source = os.path.join(work, "source")
+        os.mkdir(source)
+        counts = generate_source(source, depth, fanout, files, distribution, symlinks, seed)
+        nodes = counts["files"] + counts["folders"] + counts["symlinks"] + 1
+        client = FakeDropboxClient(os.path.join(work, "dropbox"), latency=latency, bandwidth=bandwidth, seed=seed)
+        # backup() keeps its cache and journal beside the credentials; keep them out of the tree
+        backup.CONFIG_SEARCH_PATHS = [work]
+        stages = _Stages(client)
+
+        local = NRootFolder()
+        stages.run("walk_local", nodes, lambda: local.walk_local_tree_r(source))
+        pool = WorkerPool(jobs) if jobs > 1 else None
+        try:
+            stages.run("upload", nodes, lambda: local.upload(source, client, "bench", "/", pool=pool))
+        finally:
+            if pool:
+                pool.close()
+
+        remote = NRootFolder()
+        stages.run("walk_remote", nodes, lambda: remote.walk_remote_tree_r(client, "bench", "/"))
+        stages.run("encode", nodes, lambda: json.dumps(remote.encodable()))
+
+        _change_source(source, change, seed)
+        changed = NRootFolder()
+        changed.walk_local_tree_r(source)
+        stages.run("diff", nodes, lambda: backup.diff_trees(changed, remote))
+
+        args = backup.backup_parser().parse_args(["backup", source, "bench:/", "--jobs", str(jobs), "--no-cache"])
+        stages.run("backup", nodes, lambda: backup.backup(args, client))
+    finally:
+        backup.CONFIG_SEARCH_PATHS = saved_config
+        shutil.rmtree(work)
+
+    return {
+        "tree": {"depth": depth, "fanout": fanout, "files": files, "distribution": distribution, "symlinks": symlinks, "seed": seed, "nodes": nodes, "bytes": counts["bytes"]},
+        "network": {"jobs": jobs, "latency": latency, "bandwidth": bandwidth},
+        "stages": [dict(stage=name, **stages.results[name]) for name in stages.order],
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Stages that got slower by more than `tolerance`, or made more requests, than in baseline"""
+    before = dict((stage["stage"], stage) for stage in baseline["stages"])
+    regressions = []
+    for stage in report["stages"]:
+        old = before.get(stage["stage"])
+        if old is None:
+            continue
+        if stage["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append("{}: {:.3f}s, was {:.3f}s".format(stage["stage"], stage["seconds"], old["seconds"]))
+        if stage["requests"] > old["requests"]:
+            regressions.append("{}: {} requests, was {}".format(stage["stage"], stage["requests"], old["requests"]))
+    return regressions
+
+
+def _print_suite(report):
+    print "nodes: {nodes}, data: {mb:.1f} MB".format(nodes=report["tree"]["nodes"], mb=report["tree"]["bytes"] / (1024.0 * 1024))
+    print "{:<12} {:>10} {:>14} {:>10} {:>14}".format("stage", "seconds", "nodes/s", "requests", "peak RSS MB")
+    for stage in report["stages"]:
+        print "{:<12} {:>10.3f} {:>14.1f} {:>10} {:>14.1f}".format(stage["stage"], stage["seconds"], stage["items_per_second"], stage["requests"], stage["peak_rss_mb"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for dropback")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    compression = subparsers.add_parser("compression", help="Throughput with the compression stage on and off")
+    compression.add_argument("--size", type=int, default=64, help="Size in MB of each sample file (Default 64)")
+    compression.add_argument("--bandwidth", type=float, default=2, help="Uplink speed in MB/s used to estimate upload time (Default 2)")
+    compression.add_argument("--level", type=int, default=6, help="zlib compression level (Default 6)")
+
+    tree = subparsers.add_parser("tree", help="Memory and time used by a large node tree")
+    tree.add_argument("--nodes", type=int, default=1000000, help="Number of nodes in the tree (Default 1000000)")
+    tree.add_argument("--fanout", type=int, default=50, help="Entries in each folder (Default 50)")
+
+    suite = subparsers.add_parser("suite", help="Time each stage of backing up a synthetic tree to an offline Dropbox")
+    suite.add_argument("--depth", type=int, default=3, help="Levels of folders below the root (Default 3)")
+    suite.add_argument("--fanout", type=int, default=4, help="Subfolders in each folder (Default 4)")
+    suite.add_argument("--files", type=int, default=20, help="Files in each folder (Default 20)")
+    suite.add_argument("--sizes", choices=sorted(SIZE_DISTRIBUTIONS), default="small", help="File size distribution (Default small)")
+    suite.add_argument("--symlinks", type=float, default=0.05, help="Fraction of files that are symlinks (Default 0.05)")
+    suite.add_argument("--seed", type=int, default=0, help="Seed for the generated tree (Default 0)")
+    suite.add_argument("--jobs", type=int, default=1, help="Parallel requests (Default 1)")
+    suite.add_argument("--latency", type=float, default=0, help="Seconds added to every request (Default 0)")
+    suite.add_argument("--bandwidth", type=float, default=0, help="Link speed in MB/s, 0 for unlimited (Default 0)")
+    suite.add_argument("--change", type=float, default=0.1, help="Fraction of files changed before the second backup (Default 0.1)")
+    suite.add_argument("--json", help="Also write the results to this file")
+    suite.add_argument("--baseline", help="Compare against results saved with --json, and fail on regressions")
+    suite.add_argument("--tolerance", type=float, default=0.2, help="How much slower than the baseline a stage may get (Default 0.2)")
+
+    args = parser.parse_args()
+    if args.benchmark == "compression":
+        benchmark_compression(args.size * 1024 * 1024, args.bandwidth, args.level)
+    elif args.benchmark == "tree":
+        benchmark_tree(args.nodes, args.fanout)
+    elif args.benchmark == "suite":
+        logging.basicConfig(level=logging.WARNING)
+        report = benchmark_suite(args.depth, args.fanout, args.files, args.sizes, args.symlinks, args.seed, args.jobs,
+                                 args.latency, args.bandwidth * 1024 * 1024, args.change)
+        _print_suite(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+            for regression in regressions:
+                print "REGRESSION {}".format(regression)
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
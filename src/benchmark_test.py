@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.benchmark_test
+    ~~~~~~~~~~~~~~
+
+    Tests the parts of the benchmark suite its results depend on
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+from benchmark import generate_source, compare_to_baseline
+
+
+def _report(seconds, requests):
+    return {"stages": [{"stage": "walk_local", "seconds": seconds, "requests": 0},
+                       {"stage": "backup", "seconds": 1.0, "requests": requests}]}
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test generate_source and compare_to_baseline"""
+
+    def _generate(self, seed):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        counts = generate_source(folder, 2, 2, 5, "small", 0.2, seed)
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                relative = os.path.relpath(path, folder)
+                if os.path.islink(path):
+                    tree[relative] = "-> " + os.readlink(path)
+                else:
+                    with open(path, "rb") as f:
+                        tree[relative] = f.read()
+        return counts, tree
+
+    def test_generated_tree_is_deterministic(self):
+        """The same seed always writes the same tree, and another seed a different one"""
+        counts, tree = self._generate(3)
+        self.assertEqual(self._generate(3), (counts, tree))
+        self.assertEqual(counts["folders"], 2 + 4)
+        self.assertEqual(counts["files"] + counts["symlinks"], 5 * 7)
+        self.assertEqual(counts["bytes"], sum(len(data) for data in tree.values() if not data.startswith("-> ")))
+        self.assertNotEqual(self._generate(4)[1], tree)
+
+    def test_regressions_beyond_tolerance_fail(self):
+        """A stage slower by more than the tolerance, or making more requests, is a regression"""
+        baseline = _report(1.0, 10)
+        self.assertEqual(compare_to_baseline(_report(1.1, 10), baseline, 0.2), [])
+        self.assertEqual(compare_to_baseline(_report(0.5, 8), baseline, 0.2), [])
+        self.assertEqual(compare_to_baseline(_report(1.3, 10), baseline, 0.2), ["walk_local: 1.300s, was 1.000s"])
+        self.assertEqual(compare_to_baseline(_report(1.0, 11), baseline, 0.2), ["backup: 11 requests, was 10"])
+
+    def test_new_stages_are_not_compared(self):
+        """Stages the baseline doesn't have can't have regressed"""
+        baseline = {"stages": [{"stage": "backup", "seconds": 1.0, "requests": 10}]}
+        self.assertEqual(compare_to_baseline(_report(5.0, 10), baseline, 0.2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.cache
+    ~~~~~~~~~~~~~~
+
+    Keeps a local copy of the remote tree written by the last backup, so the
+    next backup doesn't have to download every folder's metadata again
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import logging
+import os
+import gzip
+import json
+import uuid
+import hashlib
+import traceback
+
+from node import NRootFolder
+
+
+def new_generation():
+    """Generate a fresh generation stamp for the root metadata"""
+    return uuid.uuid4().hex
+
+
+class RemoteTreeCache(object):
+    """A gzipped JSON copy of one backup target's remote tree"""
+    # Bump this if the cache layout changes; old caches are then ignored
+    VERSION = 1
+
+    def __init__(self, cache_dir, target, target_folder):
+        self.target = target
+        self.target_folder = target_folder
+        key = hashlib.sha1("{}:{}".format(target, target_folder)).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, "dropbox_backup_cache_{}.json.gz".format(key))
+
+    def load(self, generation):
+        """Returns the cached tree if it was stored at `generation`, else None"""
+        if not generation or not os.path.exists(self.path):
+            return None
+        try:
+            with gzip.open(self.path, "rb") as cache_h:
+                cached = json.load(cache_h)
+        except Exception as e:
+            logging.warning("Could not read remote tree cache '{}'".format(self.path))
+            logging.warning(e)
+            return None
+
+        if cached.get("version") != self.VERSION or \
+           cached.get("target") != self.target or \
+           cached.get("target_folder") != self.target_folder or \
+           cached.get("generation") != generation:
+            logging.info("Remote tree cache is out of date")
+            return None
+
+        root = NRootFolder()
+        try:
+            root.load_encodable_tree(cached["tree"])
+        except Exception as e:
+            logging.warning("Could not load remote tree cache '{}'".format(self.path))
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+            return None
+        root.generation = generation
+        return root
+
+    def store(self, root):
+        """Save the uploaded parts of root, which must carry a generation"""
+        cached = {
+            "version": self.VERSION,
+            "target": self.target,
+            "target_folder": self.target_folder,
+            "generation": root.generation,
+            "tree": root.encodable(only_uploaded=True),
+        }
+        # Write then rename, so a crash can't leave a half written cache behind
+        temp_path = "{}.tmp".format(self.path)
+        try:
+            with gzip.open(temp_path, "wb") as cache_h:
+                json.dump(cached, cache_h, separators=(",", ":"))
+            os.rename(temp_path, self.path)
+        except Exception as e:
+            logging.warning("Could not write remote tree cache '{}'".format(self.path))
+            logging.warning(e)
+
+    def clear(self):
+        """Forget the cached tree"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.cache_test
+    ~~~~~~~~~~~~~~
+
+    Tests the local remote tree cache
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import json
+import shutil
+import tempfile
+from backup import get_remote_tree
+from cache import RemoteTreeCache
+from node import NRootFolder, NFolder, NFile
+from node_test import _StoreClient
+
+STATS = {"uid": 1, "gid": 1, "mode": 0o644, "mtime": 2, "ctime": 2, "size": 3}
+
+
+class TestRemoteTreeCache(unittest.TestCase):
+    """Test RemoteTreeCache class"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = RemoteTreeCache(self.cache_dir, "t", "/x")
+
+        self.root = NRootFolder()
+        folder = NFolder(self.root, "a", STATS)
+        folder.uploaded = True
+        link = NFile(folder, "link", STATS)
+        link.uploaded = True
+        link.symlink_target = "/elsewhere"
+        failed = NFile(folder, "failed", STATS)
+        folder.children = [link, failed]
+        self.root.children = [folder]
+        self.root.generation = "gen1"
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        """Only uploaded nodes come back, with their stats"""
+        self.cache.store(self.root)
+        loaded = self.cache.load("gen1")
+        self.assertEqual(loaded.encodable(), self.root.encodable(only_uploaded=True))
+        self.assertEqual([c.name for c in loaded.children[0].children], ["link"])
+        self.assertEqual(loaded.children[0].children[0].symlink_target, "/elsewhere")
+
+    def test_stale_generation(self):
+        """A cache from another generation is ignored"""
+        self.cache.store(self.root)
+        self.assertIsNone(self.cache.load("gen2"))
+        self.assertIsNone(self.cache.load(None))
+
+    def test_targets_are_kept_apart(self):
+        """Each target/folder gets its own cache"""
+        self.cache.store(self.root)
+        self.assertIsNone(RemoteTreeCache(self.cache_dir, "t", "/y").load("gen1"))
+
+    def test_stale_cache_reads_root_once(self):
+        """Checking a cache that turns out to be stale doesn't cost a second download of the root metadata"""
+        self.cache.store(self.root)
+        self.root.generation = "gen2"
+        client = _StoreClient()
+        client.files["/t/data/x/.dropboxbackupmeta"] = json.dumps(self.root.encodable(max_recurse_depth=1, only_uploaded=True))
+        client.files["/t/data/x/a/.dropboxbackupmeta"] = json.dumps(self.root.children[0].encodable(max_recurse_depth=1, only_uploaded=True))
+
+        tree = get_remote_tree(client, "t", "/x", cache=self.cache)
+        self.assertEqual(tree.generation, "gen2")
+        self.assertEqual(tree.encodable()["children"], self.root.encodable(only_uploaded=True)["children"])
+        self.assertEqual([path for path, start in client.requests], ["/t/data/x/.dropboxbackupmeta", "/t/data/x/a/.dropboxbackupmeta"])
+
+if __name__ == '__main__':
+    unittest.main()
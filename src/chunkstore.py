@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.chunkstore
+    ~~~~~~~~~~~~~~
+
+    Stores files as a list of content-addressed blocks, so a file that
+    changes in place only needs its changed blocks uploaded, and identical
+    blocks are only ever stored once
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import dropbox
+import hashlib
+import logging
+import threading
+
+from hashing import HASH_BLOCK_SIZE
+
+
+# A store every target in the app folder can share
+SHARED_STORE = "/.dropbackstore/blocks"
+
+
+def target_store(target):
+    """Remote folder of a target's own block store"""
+    return "/{target}/blocks".format(target=target)
+
+
+def block_path(store, block_hash):
+    """Remote path of a block"""
+    # Fan out by the first two hex digits, so no folder gets too big to list
+    return "{store}/{prefix}/{block_hash}".format(store=store, prefix=block_hash[:2], block_hash=block_hash)
+
+
+def chunks_store(chunks, target):
+    """Which store a `chunks` record's blocks are in"""
+    # Records from before stores could be shared are always in the target's own
+    return chunks.get("store") or target_store(target)
+
+
+def iter_blocks(file_h, block_size):
+    """Yields (sha256 hex digest, data) for each block of an open file"""
+    while True:
+        block = file_h.read(block_size)
+        if not block:
+            break
+        yield hashlib.sha256(block).hexdigest(), block
+
+
+class ChunkStore(object):
+    """Uploads files as fixed size blocks named by their SHA-256
+
+    A stored NFile gets `chunks` of {"store", "block_size", "hashes"}. Blocks
+    we know Dropbox has, because a previous backup's metadata lists them, are
+    not uploaded again.
+
+    A shared store also holds blocks uploaded by other targets, which our
+    metadata knows nothing about. With `list_prefixes`, the first block
+    with a given two digit prefix lists that prefix's folder, so one request
+    tells us about every block in it.
+    """
+    # Dropbox refuses to list folders with more files than this
+    LISTING_LIMIT = 25000
+
+    def __init__(self, dropbox_client, store, threshold, block_size=HASH_BLOCK_SIZE, list_prefixes=False):
+        self.dropbox_client = dropbox_client
+        self.store = store
+        self.threshold = threshold
+        self.block_size = block_size
+        self.list_prefixes = list_prefixes
+
+        self.lock = threading.Lock()
+        self.known = set()
+        # Prefixes we've listed, or found too big to list
+        self.listed = set()
+        self.unlistable = set()
+        # Prefixes being listed right now, and a way to wait for them
+        self.listing = set()
+        self.prefix_listed = threading.Condition(self.lock)
+
+    def accepts(self, node):
+        """True if node is a regular file big enough to store as blocks"""
+        return not node.symlink_target and node.size is not None and node.size >= self.threshold
+
+    def seed(self, remote_tree, target):
+        """Remember the blocks in our store used by every file in a remote tree"""
+        stack = [remote_tree]
+        while stack:
+            node = stack.pop()
+            self.remember(node, target)
+            stack.extend(getattr(node, "children", None) or [])
+        logging.info("Backup already has {} blocks".format(len(self.known)))
+
+    def remember(self, node, target):
+        """Remember the blocks used by one remote node, if they're in our store"""
+        if node.chunks and chunks_store(node.chunks, target) == self.store:
+            with self.lock:
+                self.known.update(node.chunks["hashes"])
+
+    def has_block(self, block_hash):
+        """True if we know Dropbox already has a block"""
+        prefix = block_hash[:2]
+        with self.lock:
+            if block_hash in self.known:
+                return True
+            if not self.list_prefixes:
+                return False
+            while prefix in self.listing:
+                self.prefix_listed.wait()
+            list_it = prefix not in self.listed
+            if list_it:
+                self.listing.add(prefix)
+
+        if list_it:
+            # Listing is a request, so other blocks carry on without the lock meanwhile
+            try:
+                names = self._list_prefix(prefix)
+            except Exception:
+                # Let whoever is waiting try it themselves
+                with self.lock:
+                    self.listing.discard(prefix)
+                    self.prefix_listed.notify_all()
+                raise
+            with self.lock:
+                self.listing.discard(prefix)
+                self.listed.add(prefix)
+                if names is None:
+                    self.unlistable.add(prefix)
+                else:
+                    self.known.update(names)
+                self.prefix_listed.notify_all()
+
+        with self.lock:
+            if block_hash in self.known:
+                return True
+            if prefix not in self.unlistable:
+                return False
+
+        # Too many blocks to list, so ask about this one
+        try:
+            meta = self.dropbox_client.metadata(block_path(self.store, block_hash), list=False)
+            return not meta.get("is_deleted")
+        except dropbox.rest.ErrorResponse as e:
+            if e.status != 404:
+                raise
+            return False
+
+    def _list_prefix(self, prefix):
+        """Names of the blocks in a prefix's folder, or None if it's too big to list"""
+        folder = "{store}/{prefix}".format(store=self.store, prefix=prefix)
+        try:
+            listing = self.dropbox_client.metadata(folder, file_limit=self.LISTING_LIMIT)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status == 406:
+                logging.info("Block folder '{}' is too big to list; checking its blocks one by one".format(folder))
+                return None
+            if e.status != 404:
+                raise
+            return set()
+        return set(child["path"].split("/")[-1] for child in listing.get("contents", []) if not child.get("is_deleted"))
+
+    def upload(self, file_h):
+        """Upload the blocks of an open file that Dropbox doesn't have yet
+
+        Returns the file's `chunks` record.
+        """
+        hashes = []
+        sent = 0
+        for block_hash, block in iter_blocks(file_h, self.block_size):
+            hashes.append(block_hash)
+            if self.has_block(block_hash):
+                continue
+            # Content addressed, so overwriting a block that's already there is harmless
+            self.dropbox_client.put_file(block_path(self.store, block_hash), file_obj=block, overwrite=True)
+            with self.lock:
+                self.known.add(block_hash)
+            sent = sent + 1
+        logging.info("Uploaded {} of {} blocks".format(sent, len(hashes)))
+        return {"store": self.store, "block_size": self.block_size, "hashes": hashes}
+
+
+def content_hash(chunks):
+    """Whole file hash as hashing.hash_stream would give it, if the blocks line up"""
+    if chunks["block_size"] != HASH_BLOCK_SIZE:
+        return None
+    overall = hashlib.sha256()
+    for block_hash in chunks["hashes"]:
+        overall.update(block_hash.decode("hex"))
+    return overall.hexdigest()
+
+
+def fetch_block(dropbox_client, store, block_hash):
+    """Download a block, checking it's what we asked for"""
+    with dropbox_client.get_file(block_path(store, block_hash)) as f:
+        block = f.read()
+    if hashlib.sha256(block).hexdigest() != block_hash:
+        raise Exception("Block '{}' is corrupt".format(block_hash))
+    return block
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.compression
+    ~~~~~~~~~~~~~~
+
+    Optionally compresses file content on its way to Dropbox, and
+    decompresses it again on restore
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import os
+import tempfile
+import zlib
+
+
+# Files are compressed and decompressed this many bytes at a time
+COMPRESS_BLOCK_SIZE = 1024*1024
+
+# Formats that are already compressed, and won't get any smaller
+COMPRESSED_EXTENSIONS = frozenset([
+    ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".lz", ".lzma", ".lz4", ".zst", ".z",
+    ".zip", ".7z", ".rar", ".jar", ".war", ".apk", ".deb", ".rpm", ".dmg",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".aac", ".ogg", ".oga", ".opus", ".flac", ".m4a",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+])
+
+
+class Compressor(object):
+    """Decides which files are worth compressing, and compresses them
+
+    A compressed NFile records {"method", "length"} as its `compression`,
+    `length` being the size of what's actually in Dropbox.
+    """
+    METHOD = "zlib"
+
+    def __init__(self, min_size=1024*64, level=6, min_saving=0.1, spool_size=1024*1024*16):
+        self.min_size = min_size
+        self.level = level
+        # Upload as-is unless compressing saves at least this fraction
+        self.min_saving = min_saving
+        # Compressed data is kept in memory up to this size, then on disk
+        self.spool_size = spool_size
+
+    def accepts(self, node):
+        """True if node is a regular file worth trying to compress"""
+        if node.symlink_target or node.size is None or node.size < self.min_size:
+            return False
+        return os.path.splitext(node.name)[1].lower() not in COMPRESSED_EXTENSIONS
+
+    def compress(self, file_h):
+        """Compress an open file
+
+        Returns (compressed file, length) positioned at the start, or None if
+        compression didn't save enough to be worth it. Either way file_h is
+        left at its start.
+        """
+        compressor = zlib.compressobj(self.level)
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        read = 0
+        while True:
+            block = file_h.read(COMPRESS_BLOCK_SIZE)
+            if not block:
+                break
+            read = read + len(block)
+            spool.write(compressor.compress(block))
+        spool.write(compressor.flush())
+        length = spool.tell()
+        file_h.seek(0)
+
+        if length > read * (1 - self.min_saving):
+            spool.close()
+            return None
+        spool.seek(0)
+        return spool, length
+
+
+def decompress_file(source_path, target_path, method=Compressor.METHOD):
+    """Decompress the file at source_path into target_path, then remove source_path"""
+    if method != Compressor.METHOD:
+        raise Exception("Unknown compression method '{}'".format(method))
+
+    decompressor = zlib.decompressobj()
+    with open(source_path, "rb") as source_h:
+        with open(target_path, "wb") as target_h:
+            while True:
+                block = source_h.read(COMPRESS_BLOCK_SIZE)
+                if not block:
+                    break
+                target_h.write(decompressor.decompress(block))
+            target_h.write(decompressor.flush())
+    os.remove(source_path)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.fakeclient
+    ~~~~~~~~~~~~~~
+
+    A stand-in for dropbox.client.DropboxClient that keeps files in a local
+    folder, so backups, restores and rebuilds can be tested and benchmarked
+    offline, with latency, bandwidth limits and errors of our choosing
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import collections
+import email.utils
+import json
+import os
+import random
+import re
+import shutil
+import StringIO
+import threading
+import time
+import uuid
+
+import dropbox
+
+
+class _Response(object):
+    """Just enough of an HTTP response for ErrorResponse, and for get_file's callers"""
+
+    def __init__(self, status, reason, body="", headers=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+        self._body = StringIO.StringIO(body)
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        return self._body.read() if amt is None else self._body.read(amt)
+
+    def close(self):
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _error(status, reason, body=None, headers=None):
+    return dropbox.rest.ErrorResponse(_Response(status, reason, headers=headers), json.dumps(body or {"error": reason}))
+
+
+class _ChunkedUploader(object):
+    """Mirrors dropbox.client.ChunkedUploader"""
+
+    def __init__(self, client, file_obj, length):
+        self.client = client
+        self.offset = 0
+        self.upload_id = None
+        self.last_block = None
+        self.file_obj = file_obj
+        self.target_length = length
+
+    def upload_chunked(self, chunk_size=4 * 1024 * 1024):
+        while self.offset < self.target_length:
+            block = self.file_obj.read(min(chunk_size, self.target_length - self.offset))
+            self.offset, self.upload_id = self.client.upload_chunk(block, len(block), self.offset, self.upload_id)
+
+    def finish(self, path, overwrite=False, parent_rev=None):
+        return self.client.commit_chunked_upload(path, self.upload_id, overwrite, parent_rev)
+
+
+class FakeDropboxClient(object):
+    """Serves the DropboxClient calls dropback makes from a local folder
+
+    Every request waits `latency` seconds, and the bytes it sends or receives
+    share one link of `bandwidth` bytes a second, so parallel requests
+    compete for it as they would for a real uplink. A fraction
+    `error_rate` of requests fail with a 503, and `throttle_rate` with a 429
+    carrying a Retry-After header; `inject` fails chosen requests instead.
+
+    `requests` counts the requests made by method, and `bytes_sent` and
+    `bytes_received` what went over the link.
+
+    Unlike Dropbox, paths are case sensitive, and deleted files aren't kept.
+    """
+    # Dropbox refuses to list folders bigger than this, unless asked for fewer
+    FILE_LIMIT = 25000
+    # Entries in each page of delta results
+    DELTA_PAGE_SIZE = 1000
+
+    def __init__(self, root, latency=0.0, bandwidth=None, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.requests = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # When the simulated link is next free
+        self._link_free = 0
+        # Failures queued by inject(), as (method or None, status, headers)
+        self._injected = []
+
+        self._revs = {}
+        self._rev_counter = 0
+        self._uploads = {}
+        # Every change since we started, as delta entries
+        self._log = []
+        self._snapshot = None
+
+    # Simulated network
+
+    def inject(self, status, method=None, count=1, headers=None):
+        """Fail the next `count` requests (to `method`, if given) with `status`"""
+        with self.lock:
+            self._injected.extend([(method, status, headers or {})] * count)
+
+    def _request(self, method, sent=0, received=0):
+        with self.lock:
+            self.requests[method] += 1
+            failure = None
+            for i, (injected_method, status, headers) in enumerate(self._injected):
+                if injected_method in (None, method):
+                    failure = (status, headers)
+                    del self._injected[i]
+                    break
+            if failure is None and self.throttle_rate and self.random.random() < self.throttle_rate:
+                failure = (429, {"retry-after": str(self.retry_after)})
+            elif failure is None and self.error_rate and self.random.random() < self.error_rate:
+                failure = (503, {})
+
+            now = time.time()
+            done = now + self.latency
+            if self.bandwidth and failure is None and sent + received:
+                self._link_free = max(now, self._link_free) + float(sent + received) / self.bandwidth
+                done = max(done, self._link_free)
+            if failure is None:
+                self.bytes_sent = self.bytes_sent + sent
+                self.bytes_received = self.bytes_received + received
+
+        if done > now:
+            time.sleep(done - now)
+        if failure is not None:
+            status, headers = failure
+            raise _error(status, {429: "Too Many Requests", 503: "Service Unavailable"}.get(status, "Error"), headers=headers)
+
+    # Paths and metadata
+
+    def _normalise(self, path):
+        # Dropbox treats repeated and trailing slashes as one and none
+        return "/" + re.sub("/+", "/", path).strip("/")
+
+    def _local(self, path):
+        return os.path.join(self.root, self._normalise(path).lstrip("/"))
+
+    def _rev(self, path):
+        return self._revs.get(self._normalise(path).lower(), "0")
+
+    def _changed(self, path, deleted=False):
+        path = self._normalise(path)
+        if deleted:
+            for p in [p for p in self._revs if p == path.lower() or p.startswith(path.lower() + "/")]:
+                del self._revs[p]
+            self._log.append([path.lower(), None])
+            return
+        self._rev_counter = self._rev_counter + 1
+        self._revs[path.lower()] = "{:x}".format(self._rev_counter)
+        self._log.append([path.lower(), self._meta(path, False)])
+
+    def _meta(self, path, listing, file_limit=None):
+        path = self._normalise(path)
+        local = self._local(path)
+        if not os.path.lexists(local):
+            raise _error(404, "Not Found", {"error": "Path '{}' not found".format(path)})
+        stats = os.stat(local)
+        is_dir = os.path.isdir(local)
+        meta = {
+            "path": path,
+            "is_dir": is_dir,
+            "bytes": 0 if is_dir else stats.st_size,
+            "size": "{} bytes".format(0 if is_dir else stats.st_size),
+            "rev": self._rev(path),
+            "modified": email.utils.formatdate(stats.st_mtime),
+            "root": "app_folder",
+        }
+        if is_dir and listing:
+            names = sorted(os.listdir(local))
+            if len(names) > (self.FILE_LIMIT if file_limit is None else file_limit):
+                raise _error(406, "Not Acceptable", {"error": "Too many entries"})
+            meta["contents"] = [self._meta("{}/{}".format(path, name), False) for name in names]
+        return meta
+
+    def _make_parents(self, path):
+        # Dropbox creates missing parent folders, and they show up in delta like any other
+        missing = []
+        parent = self._normalise(path).rsplit("/", 1)[0] or "/"
+        while parent != "/" and not os.path.isdir(self._local(parent)):
+            if os.path.lexists(self._local(parent)):
+                raise _error(403, "Forbidden", {"error": "A file is in the way"})
+            missing.append(parent)
+            parent = parent.rsplit("/", 1)[0] or "/"
+        for folder in reversed(missing):
+            os.mkdir(self._local(folder))
+            self._changed(folder)
+
+    def _read(self, file_obj):
+        if isinstance(file_obj, basestring):
+            return file_obj
+        if hasattr(file_obj, "getvalue"):
+            # As the SDK does, send all of a StringIO wherever it's positioned
+            return file_obj.getvalue()
+        return file_obj.read()
+
+    def _write(self, path, data, overwrite):
+        path = self._normalise(path)
+        local = self._local(path)
+        if os.path.isdir(local):
+            raise _error(403, "Forbidden", {"error": "A folder is in the way"})
+        if os.path.exists(local) and not overwrite:
+            # Dropbox renames rather than overwriting
+            base, extension = os.path.splitext(path)
+            i = 1
+            while os.path.exists(self._local("{} ({}){}".format(base, i, extension))):
+                i = i + 1
+            path = "{} ({}){}".format(base, i, extension)
+            local = self._local(path)
+        self._make_parents(path)
+        with open(local, "wb") as f:
+            f.write(data)
+        self._changed(path)
+        return self._meta(path, False)
+
+    # DropboxClient
+
+    def account_info(self):
+        self._request("account_info")
+        return {"display_name": "Offline", "uid": 0}
+
+    def metadata(self, path, list=True, file_limit=FILE_LIMIT, hash=None, rev=None, include_deleted=False, include_media_info=False):
+        self._request("metadata")
+        with self.lock:
+            meta = self._meta(path, list, file_limit)
+        self._received(meta)
+        return meta
+
+    def _received(self, meta):
+        # Listings can be big, so count them as received, though we don't slow them down
+        with self.lock:
+            self.bytes_received = self.bytes_received + len(json.dumps(meta))
+
+    def get_file(self, from_path, rev=None, start=None, length=None):
+        with self.lock:
+            local = self._local(from_path)
+            if not os.path.isfile(local):
+                raise _error(404, "Not Found", {"error": "File not found"})
+            with open(local, "rb") as f:
+                if start is not None:
+                    f.seek(start)
+                    data = f.read(length) if length is not None else f.read()
+                elif length is not None:
+                    # Without a start, Dropbox sends the last `length` bytes
+                    f.seek(max(0, os.path.getsize(local) - length))
+                    data = f.read()
+                else:
+                    data = f.read()
+            meta = self._meta(from_path, False)
+        self._request("get_file", received=len(data))
+        ranged = start is not None or length is not None
+        return _Response(206 if ranged else 200, "Partial Content" if ranged else "OK", data, {"x-dropbox-metadata": json.dumps(meta)})
+
+    def put_file(self, full_path, file_obj, overwrite=False, parent_rev=None):
+        data = self._read(file_obj)
+        self._request("put_file", sent=len(data))
+        with self.lock:
+            return self._write(full_path, data, overwrite)
+
+    def get_chunked_uploader(self, file_obj, length):
+        return _ChunkedUploader(self, file_obj, length)
+
+    def upload_chunk(self, file_obj, length=None, offset=0, upload_id=None):
+        data = self._read(file_obj)
+        self._request("upload_chunk", sent=len(data))
+        with self.lock:
+            if upload_id is None:
+                upload_id = uuid.uuid4().hex
+                self._uploads[upload_id] = ""
+            elif upload_id not in self._uploads:
+                raise _error(404, "Not Found", {"error": "Unknown upload_id"})
+            received = self._uploads[upload_id]
+            if offset != len(received):
+                # Dropbox tells us where it's really up to
+                raise _error(400, "Bad Request", {"error": "Submitted input out of alignment", "upload_id": upload_id, "offset": len(received)})
+            self._uploads[upload_id] = received + data
+            return len(self._uploads[upload_id]), upload_id
+
+    def commit_chunked_upload(self, full_path, upload_id, overwrite=False, parent_rev=None):
+        self._request("commit_chunked_upload")
+        with self.lock:
+            if upload_id not in self._uploads:
+                raise _error(404, "Not Found", {"error": "Unknown upload_id"})
+            return self._write(full_path, self._uploads.pop(upload_id), overwrite)
+
+    def file_create_folder(self, path):
+        self._request("file_create_folder")
+        with self.lock:
+            local = self._local(path)
+            if os.path.lexists(local):
+                raise _error(403, "Forbidden", {"error": "Something already exists at '{}'".format(self._normalise(path))})
+            self._make_parents(path)
+            os.mkdir(local)
+            self._changed(path)
+            return self._meta(path, False)
+
+    def file_delete(self, path):
+        self._request("file_delete")
+        with self.lock:
+            meta = self._meta(path, False)
+            local = self._local(path)
+            if os.path.isdir(local):
+                shutil.rmtree(local)
+            else:
+                os.unlink(local)
+            self._changed(path, deleted=True)
+            meta["is_deleted"] = True
+            return meta
+
+    def file_copy(self, from_path, to_path):
+        self._request("file_copy")
+        with self.lock:
+            return self._copy(from_path, to_path, False)
+
+    def file_move(self, from_path, to_path):
+        self._request("file_move")
+        with self.lock:
+            return self._copy(from_path, to_path, True)
+
+    def _copy(self, from_path, to_path, move):
+        source, target = self._local(from_path), self._local(to_path)
+        if not os.path.lexists(source):
+            raise _error(404, "Not Found", {"error": "Path '{}' not found".format(self._normalise(from_path))})
+        if os.path.lexists(target):
+            raise _error(403, "Forbidden", {"error": "Something already exists at '{}'".format(self._normalise(to_path))})
+        self._make_parents(to_path)
+        if os.path.isdir(source):
+            shutil.copytree(source, target)
+        else:
+            shutil.copy2(source, target)
+        self._changed_tree(to_path)
+        if move:
+            if os.path.isdir(source):
+                shutil.rmtree(source)
+            else:
+                os.unlink(source)
+            self._changed(from_path, deleted=True)
+        return self._meta(to_path, False)
+
+    def _changed_tree(self, path):
+        self._changed(path)
+        local = self._local(path)
+        if os.path.isdir(local):
+            for name in sorted(os.listdir(local)):
+                self._changed_tree("{}/{}".format(self._normalise(path), name))
+
+    def delta(self, cursor=None, path_prefix=None, include_media_info=False):
+        """Pages through everything under path_prefix, then through what changed since
+
+        A cursor is either "s<log position>:<index>", part way through the
+        first listing, or "<log position>".
+        """
+        self._request("delta")
+        path = self._normalise(path_prefix or "/")
+        # Entries are keyed by lowercased path, but the files on disk keep their case
+        prefix = path.lower()
+
+        def under(lower_path):
+            return prefix == "/" or lower_path == prefix or lower_path.startswith(prefix + "/")
+
+        with self.lock:
+            if cursor is None or cursor.startswith("s"):
+                position, index = (len(self._log), 0) if cursor is None else [int(p) for p in cursor[1:].split(":")]
+                if self._snapshot is None or self._snapshot[:2] != (position, path):
+                    self._snapshot = (position, path, self._walk(path))
+                entries = self._snapshot[2][index:index + self.DELTA_PAGE_SIZE]
+                index = index + len(entries)
+                if index < len(self._snapshot[2]):
+                    next_cursor, has_more = "s{}:{}".format(position, index), True
+                else:
+                    next_cursor, has_more = str(position), position < len(self._log)
+                page = {"entries": entries, "reset": cursor is None, "cursor": next_cursor, "has_more": has_more}
+            else:
+                position = int(cursor)
+                entries = []
+                while position < len(self._log) and len(entries) < self.DELTA_PAGE_SIZE:
+                    if under(self._log[position][0]):
+                        entries.append(self._log[position])
+                    position = position + 1
+                page = {"entries": entries, "reset": False, "cursor": str(position), "has_more": position < len(self._log)}
+        self._received(page)
+        return page
+
+    def _walk(self, prefix):
+        entries = []
+        start = self._local(prefix)
+        if not os.path.lexists(start):
+            return entries
+        stack = [self._normalise(prefix)]
+        while stack:
+            path = stack.pop()
+            meta = self._meta(path, False)
+            if path != "/":
+                entries.append([path.lower(), meta])
+            if meta["is_dir"]:
+                for name in sorted(os.listdir(self._local(path)), reverse=True):
+                    stack.append("{}/{}".format(path.rstrip("/"), name))
+        return entries
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.fakeclient_test
+    ~~~~~~~~~~~~~~
+
+    Tests the offline Dropbox stand-in, and backs up and restores through it
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import dropbox
+from fakeclient import FakeDropboxClient
+from listing import RemoteListing, rebuild_index
+from node import NRootFolder, NFile
+
+
+class TestFakeDropboxClient(unittest.TestCase):
+    """Test FakeDropboxClient"""
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.source = tempfile.mkdtemp()
+        self.restored = tempfile.mkdtemp()
+        for folder in [self.remote, self.source, self.restored]:
+            self.addCleanup(shutil.rmtree, folder)
+        self.client = FakeDropboxClient(self.remote)
+
+    def test_files_and_folders(self):
+        """Uploads can be listed, read back whole or in part, and deleted"""
+        self.client.put_file("/t/data/a/f", "0123456789")
+        meta = self.client.metadata("/t/data/a")
+        self.assertTrue(meta["is_dir"])
+        self.assertEqual([c["path"] for c in meta["contents"]], ["/t/data/a/f"])
+        with self.client.get_file("/t/data/a/f", start=2, length=3) as f:
+            self.assertEqual(f.status, 206)
+            self.assertEqual(f.read(), "234")
+        with self.client.get_file("/t/data/a/f", length=3) as f:
+            # Like Dropbox, a length without a start is the end of the file
+            self.assertEqual(f.read(), "789")
+
+        with self.assertRaises(dropbox.rest.ErrorResponse) as raised:
+            self.client.file_create_folder("/t/data/a")
+        self.assertEqual(raised.exception.status, 403)
+        with self.assertRaises(dropbox.rest.ErrorResponse) as raised:
+            self.client.metadata("/t/data/a", file_limit=0)
+        self.assertEqual(raised.exception.status, 406)
+
+        self.client.file_delete("/t/data/a")
+        with self.assertRaises(dropbox.rest.ErrorResponse) as raised:
+            self.client.metadata("/t/data/a/f")
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_missing_root_is_created(self):
+        """A client on a folder that doesn't exist yet makes it, and files can go straight in its top level"""
+        client = FakeDropboxClient(os.path.join(self.remote, "new"))
+        client.put_file("/f", "top")
+        client.put_file("/a/b/g", "nested")
+        self.assertEqual(sorted(c["path"] for c in client.metadata("/")["contents"]), ["/a", "/f"])
+        with client.get_file("/a/b/g") as f:
+            self.assertEqual(f.read(), "nested")
+
+        # Looking for missing parents stops at the root, even if it's gone
+        shutil.rmtree(client.root)
+        self.assertRaises(IOError, client.put_file, "/f", "top")
+
+    def test_injected_errors(self):
+        """Injected failures raise ErrorResponse like Dropbox would, then requests work again"""
+        self.client.inject(429, "put_file", headers={"retry-after": "3"})
+        with self.assertRaises(dropbox.rest.ErrorResponse) as raised:
+            self.client.put_file("/f", "x")
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(raised.exception.headers["retry-after"], "3")
+        self.client.put_file("/f", "x")
+        self.assertEqual(self.client.requests["put_file"], 2)
+        self.assertEqual(self.client.bytes_sent, 1)
+
+    def test_latency_and_bandwidth(self):
+        """Requests take at least the latency, and bytes share the link"""
+        client = FakeDropboxClient(self.remote, latency=0.05, bandwidth=1000)
+        started = time.time()
+        client.put_file("/f", "x" * 100)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+    def test_delta(self):
+        """The first delta lists everything a page at a time; later ones only what changed"""
+        self.client.DELTA_PAGE_SIZE = 2
+        for name in ["a", "b", "c"]:
+            self.client.put_file("/t/data/{}".format(name), name)
+        self.client.put_file("/other/d", "d")
+
+        entries = []
+        cursor = None
+        while True:
+            page = self.client.delta(cursor, path_prefix="/t/data")
+            entries.extend(path for path, meta in page["entries"])
+            cursor = page["cursor"]
+            if not page["has_more"]:
+                break
+        self.assertEqual(entries, ["/t/data", "/t/data/a", "/t/data/b", "/t/data/c"])
+
+        self.client.file_delete("/t/data/b")
+        self.client.put_file("/t/data/e", "e")
+        page = self.client.delta(cursor, path_prefix="/t/data")
+        self.assertEqual([(path, meta is None) for path, meta in page["entries"]], [("/t/data/b", True), ("/t/data/e", False)])
+
+    def test_delta_keeps_case(self):
+        """A delta under a prefix with capitals lists it, keyed by lowercased path"""
+        self.client.put_file("/MyHost/data/F", "f")
+        self.client.put_file("/MyHost/data/g", "g")
+        page = self.client.delta(path_prefix="/MyHost/data")
+        self.assertEqual([path for path, meta in page["entries"]], ["/myhost/data", "/myhost/data/f", "/myhost/data/g"])
+        self.assertEqual(page["entries"][1][1]["path"], "/MyHost/data/F")
+
+        self.client.put_file("/MyHost/data/h", "h")
+        page = self.client.delta(page["cursor"], path_prefix="/MyHost/data")
+        self.assertEqual([path for path, meta in page["entries"]], ["/myhost/data/h"])
+
+    def test_backup_restore_rebuild(self):
+        """A backup through the fake restores intact, and rebuilds without changes"""
+        os.makedirs(os.path.join(self.source, "a"))
+        with open(os.path.join(self.source, "a", "big"), "wb") as f:
+            f.write(os.urandom(1000))
+        with open(os.path.join(self.source, "small"), "w") as f:
+            f.write("small")
+        os.symlink("small", os.path.join(self.source, "link"))
+        self.addCleanup(setattr, NFile, "CHUNKED_SIZE_LIMIT", NFile.CHUNKED_SIZE_LIMIT)
+        NFile.CHUNKED_SIZE_LIMIT = 100
+
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        local.upload(self.source, self.client, "t", "/", chunk_size=300)
+        # The big file went up in four chunks
+        self.assertEqual(self.client.requests["upload_chunk"], 4)
+
+        remote = NRootFolder()
+        remote.walk_remote_tree_r(self.client, "t", "/")
+        remote.restore(self.restored, self.client, "t", "/")
+        for name in [os.path.join("a", "big"), "small"]:
+            with open(os.path.join(self.source, name), "rb") as original:
+                with open(os.path.join(self.restored, name), "rb") as restored:
+                    self.assertEqual(original.read(), restored.read())
+        self.assertEqual(os.readlink(os.path.join(self.restored, "link")), "small")
+
+        listing = RemoteListing(None, "t", "/")
+        listing.update(self.client)
+        puts = self.client.requests["put_file"]
+        root, complete = rebuild_index(self.client, listing)
+        self.assertTrue(complete)
+        self.assertEqual(self.client.requests["put_file"], puts)
+        self.assertEqual(sorted(c.name for c in root.children), ["a", "link", "small"])
+
+
+if __name__ == '__main__':
+    unittest.main()
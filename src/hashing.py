@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.hashing
+    ~~~~~~~~~~~~~~
+
+    Block-wise content hashing of local files
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import hashlib
+
+# Files are hashed this many bytes at a time
+HASH_BLOCK_SIZE = 1024*1024*4
+
+
+def hash_stream(file_h, block_size=HASH_BLOCK_SIZE):
+    """Hash a file-like object one block at a time
+
+    The result is the SHA-256 of the concatenated SHA-256 digests of each
+    block (the same scheme as Dropbox's content_hash), so memory use is one
+    block however large the file is.
+    """
+    overall = hashlib.sha256()
+    while True:
+        block = file_h.read(block_size)
+        if not block:
+            break
+        overall.update(hashlib.sha256(block).digest())
+    return overall.hexdigest()
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    """Hash the local file at path"""
+    with open(path, "rb") as file_h:
+        return hash_stream(file_h, block_size)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.journal
+    ~~~~~~~~~~~~~~
+
+    Remembers chunked uploads that are in progress, so that a later backup
+    can carry on from the last chunk Dropbox acknowledged
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import logging
+import os
+import json
+import time
+import threading
+
+
+def file_identity(file_h):
+    """Describe an open local file well enough to spot if it changes"""
+    stats = os.fstat(file_h.fileno())
+    return {
+        "dev": stats.st_dev,
+        "ino": stats.st_ino,
+        "size": stats.st_size,
+        "mtime": stats.st_mtime,
+    }
+
+
+class UploadJournal(object):
+    """A JSON file of in-flight chunked uploads, keyed by remote path"""
+    # Dropbox forgets chunked uploads after 48 hours; give ourselves some slack
+    UPLOAD_ID_LIFETIME = 60*60*46
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uploads = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as journal_h:
+                    self.uploads = json.load(journal_h)
+            except Exception as e:
+                logging.warning("Could not read upload journal '{}', starting afresh".format(path))
+                logging.warning(e)
+
+    def get(self, remote_path, identity):
+        """Returns (upload_id, offset) of a resumable upload, or None"""
+        with self.lock:
+            entry = self.uploads.get(remote_path)
+            if not entry:
+                return None
+            if entry["identity"] != identity or time.time() - entry["started"] > self.UPLOAD_ID_LIFETIME:
+                # The file has changed, or Dropbox will have forgotten the upload
+                del self.uploads[remote_path]
+                self._save()
+                return None
+            return entry["upload_id"], entry["offset"]
+
+    def record(self, remote_path, identity, upload_id, offset):
+        """Note that Dropbox has acknowledged `offset` bytes of an upload"""
+        with self.lock:
+            entry = self.uploads.get(remote_path)
+            if not entry or entry["upload_id"] != upload_id:
+                entry = self.uploads[remote_path] = {"upload_id": upload_id, "started": time.time()}
+            entry["identity"] = identity
+            entry["offset"] = offset
+            self._save()
+
+    def finish(self, remote_path):
+        """Forget an upload that has been committed, or can't be resumed"""
+        with self.lock:
+            if self.uploads.pop(remote_path, None):
+                self._save()
+
+    def _save(self):
+        # Write then rename, so a crash mid-write can't lose the journal
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as journal_h:
+            json.dump(self.uploads, journal_h)
+        os.rename(temp_path, self.path)
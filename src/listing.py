@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.listing
+    ~~~~~~~~~~~~~~
+
+    Keeps a local listing of everything in a backup up to date with
+    Dropbox's delta API, and rebuilds the backup index from it
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import logging
+import os
+import gzip
+import json
+import hashlib
+import StringIO
+import traceback
+
+from node import NFolder, NRootFolder, node_from_encodable
+from cache import new_generation
+
+
+class RemoteListing(object):
+    """Every file and folder under a backup's data folder, by lowercased path
+
+    The first `update` pages through the whole backup with `delta`; later
+    ones pass the saved cursor and only get what changed since. Metadata
+    files are kept decoded alongside, with the rev we read them at, so they
+    only need downloading again when they change.
+    """
+    # Bump this if the saved layout changes; old listings are then ignored
+    VERSION = 1
+
+    def __init__(self, state_dir, target, target_folder):
+        self.prefix = "/{target}/data{target_folder}".format(target=target, target_folder=target_folder).rstrip("/")
+        key = hashlib.sha1("{}:{}".format(target, target_folder)).hexdigest()[:16]
+        self.path = os.path.join(state_dir, "dropbox_backup_listing_{}.json.gz".format(key)) if state_dir else None
+        self.cursor = None
+        # lowercased path: [path, is_dir, rev]
+        self.entries = {}
+        # lowercased folder path: [rev, decoded metadata file]
+        self.metadata = {}
+
+    def load(self):
+        """Pick up the listing saved by the last update, if there is one"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, "rb") as listing_h:
+                saved = json.load(listing_h)
+        except Exception as e:
+            logging.warning("Could not read remote listing '{}'".format(self.path))
+            logging.warning(e)
+            return
+        if saved.get("version") != self.VERSION or saved.get("prefix") != self.prefix:
+            logging.info("Saved remote listing is out of date")
+            return
+        self.cursor = saved["cursor"]
+        self.entries = saved["entries"]
+        self.metadata = saved["metadata"]
+
+    def save(self):
+        """Save the listing and cursor, so the next update only fetches changes"""
+        if not self.path:
+            return
+        saved = {
+            "version": self.VERSION,
+            "prefix": self.prefix,
+            "cursor": self.cursor,
+            "entries": self.entries,
+            "metadata": self.metadata,
+        }
+        # Write then rename, so a crash can't leave a half written listing behind
+        temp_path = "{}.tmp".format(self.path)
+        try:
+            with gzip.open(temp_path, "wb") as listing_h:
+                json.dump(saved, listing_h, separators=(",", ":"))
+            os.rename(temp_path, self.path)
+        except Exception as e:
+            logging.warning("Could not write remote listing '{}'".format(self.path))
+            logging.warning(e)
+
+    def update(self, dropbox_client):
+        """Bring the listing up to date, a page of changes at a time"""
+        pages = 0
+        changes = 0
+        while True:
+            page = dropbox_client.delta(self.cursor, path_prefix=self.prefix)
+            if page.get("reset"):
+                # Dropbox wants us to start again from nothing
+                self.entries = {}
+            for lower_path, meta in page["entries"]:
+                if meta is None or meta.get("is_deleted"):
+                    self._remove(lower_path)
+                else:
+                    self.entries[lower_path] = [meta["path"], bool(meta.get("is_dir")), meta.get("rev")]
+            self.cursor = page["cursor"]
+            pages = pages + 1
+            changes = changes + len(page["entries"])
+            if not page.get("has_more"):
+                break
+        logging.info("Listed {} changes in {} pages; backup has {} files and folders".format(changes, pages, len(self.entries)))
+
+    def _remove(self, lower_path):
+        # Everything beneath a removed folder goes with it
+        below = lower_path + "/"
+        for path in [p for p in self.entries if p == lower_path or p.startswith(below)]:
+            del self.entries[path]
+
+    def children(self):
+        """Lowercased paths of each folder's children, by the folder's lowercased path"""
+        children = {}
+        for lower_path in self.entries:
+            children.setdefault(lower_path.rsplit("/", 1)[0], []).append(lower_path)
+        return children
+
+
+def _fetch_metadata(dropbox_client, remote_path):
+    metadata_h = StringIO.StringIO()
+    with dropbox_client.get_file(remote_path) as f:
+        metadata_h.write(f.read())
+    metadata_h.seek(0)
+    remote_metadata = json.load(metadata_h)
+    metadata_h.close()
+    return remote_metadata
+
+
+def rebuild_index(dropbox_client, listing, pool=None, rewrite_index=True):
+    """Rebuild the backup index from an up to date RemoteListing
+
+    Builds the same tree as NFolder.rewrite_index_without_assumption_tree_r,
+    but from one listing of the whole backup rather than a listing per
+    folder. Metadata files that changed since the listing last read them are
+    downloaded together, in parallel if a WorkerPool is given, and only
+    folders whose rebuilt metadata differs from what's there are rewritten.
+
+    Returns the rebuilt NRootFolder, and whether every rewrite succeeded.
+    """
+    children = listing.children()
+    metadata_filename = NFolder.METADATA_FILENAME.lower()
+
+    # Download the metadata files we don't already have at their current rev
+    stale = []
+    present = set()
+    for lower_path, (path, is_dir, rev) in listing.entries.items():
+        if not is_dir and lower_path.rsplit("/", 1)[-1] == metadata_filename:
+            folder = lower_path.rsplit("/", 1)[0]
+            present.add(folder)
+            if listing.metadata.get(folder, [None])[0] != rev:
+                stale.append((folder, path, rev))
+    # Metadata files that have gone are no use any more
+    for folder in [f for f in listing.metadata if f not in present]:
+        del listing.metadata[folder]
+
+    def fetch(stale_entry):
+        folder, path, rev = stale_entry
+        try:
+            return _fetch_metadata(dropbox_client, path)
+        except Exception as e:
+            logging.warning("Could not get remote metadata '{}'".format(path))
+            logging.warning(e)
+            return None
+
+    logging.info("Downloading {} changed metadata files".format(len(stale)))
+    fetched = pool.map(fetch, stale) if pool is not None else [fetch(s) for s in stale]
+    for (folder, path, rev), remote_metadata in zip(stale, fetched):
+        if remote_metadata is not None:
+            listing.metadata[folder] = [rev, remote_metadata]
+        else:
+            listing.metadata.pop(folder, None)
+
+    root = NRootFolder()
+    root.uploaded = True
+    rewrites = []
+    _rebuild_folder(root, listing.prefix, listing.prefix.lower(), listing, children, rewrites)
+    if rewrites:
+        # Anything rewritten makes cached copies of the tree stale, so the root needs a new generation
+        root.generation = new_generation()
+        if rewrites[-1][0] is not root:
+            rewrites.append((root, listing.prefix))
+    logging.info("{} folders need their index rewritten".format(len(rewrites)))
+    if not rewrite_index:
+        return root, True
+
+    def write(rewrite):
+        folder, full_remote_path = rewrite
+        try:
+            response = folder.write_metadata(dropbox_client, full_remote_path)
+            logging.info("Rebuilt index for {}".format(full_remote_path))
+        except Exception as e:
+            logging.error("Could not rewrite index for NFolder '{remote_path}'".format(remote_path=full_remote_path))
+            logging.error("{}".format(e))
+            logging.error(traceback.format_exc())
+            return False
+        if response and response.get("rev"):
+            # We know what we wrote, so the next rebuild needn't download it
+            listing.metadata[full_remote_path.lower()] = [response["rev"], json.loads(json.dumps(folder.encodable(max_recurse_depth=1, only_uploaded=True)))]
+        return True
+
+    # The root goes last, so its new generation only lands once the rest are written
+    written = pool.map(write, rewrites[:-1]) if pool is not None else [write(r) for r in rewrites[:-1]]
+    complete = all(written)
+    if rewrites:
+        complete = write(rewrites[-1]) and complete
+    return root, complete
+
+
+def _rebuild_folder(folder, full_remote_path, lower_path, listing, children, rewrites):
+    """Fill in folder from the listing; returns True if it or anything beneath it has metadata"""
+    remote_metadata = listing.metadata.get(lower_path, [None, {}])[1]
+    someone_has_meta = lower_path in listing.metadata
+    metadata_children = {child["name"]: child for child in remote_metadata.get("children", [])}
+    stat_template = dict.fromkeys(["uid", "gid", "mode", "mtime", "ctime", "size"])
+    metadata_filename = NFolder.METADATA_FILENAME.lower()
+
+    for child_lower_path in sorted(children.get(lower_path, [])):
+        path, is_dir, rev = listing.entries[child_lower_path]
+        name = path.rsplit("/", 1)[-1]
+        try:
+            if is_dir:
+                stat_array = metadata_children[name]["stats"] if name in metadata_children else stat_template
+                new_folder = NFolder(folder, name, stat_array)
+                new_folder.uploaded = True
+                if _rebuild_folder(new_folder, path, child_lower_path, listing, children, rewrites):
+                    # Someone below us was a legit backup, so we need to include them!
+                    folder.children.append(new_folder)
+                    someone_has_meta = True
+            elif child_lower_path.rsplit("/", 1)[-1] != metadata_filename:
+                # Okay, it's a symlink, remove .symlink from the name
+                name = name[:-8] if name.endswith(".symlink") else name
+                if name in metadata_children:
+                    # An NFolder can happen if it's a symlink
+                    folder.children.append(node_from_encodable(folder, metadata_children[name]))
+                # Otherwise we don't know anything useful about this file, so have to skip it
+        except Exception as e:
+            logging.warning("Error verifying a child of '{full_remote_path}'".format(full_remote_path=full_remote_path))
+            logging.warning(e)
+
+    # Packed files and files stored as blocks don't have their own remote
+    # file, so won't be listed. We have to trust the metadata about them.
+    listed = set(c.name for c in folder.children)
+    for name, child_meta in metadata_children.items():
+        if (child_meta.get("pack") or child_meta.get("chunks")) and name not in listed:
+            folder.children.append(node_from_encodable(folder, child_meta))
+
+    if isinstance(folder, NRootFolder):
+        # Unless something changes, the cached copies of the tree still are
+        folder.generation = remote_metadata.get("generation")
+    if someone_has_meta and not _same_metadata(folder.encodable(max_recurse_depth=1, only_uploaded=True), remote_metadata):
+        rewrites.append((folder, full_remote_path))
+    return someone_has_meta
+
+
+def _same_metadata(rebuilt, remote_metadata):
+    def normalise(metadata):
+        # Round trip through JSON, so it compares like the metadata we read, in any order
+        metadata = json.loads(json.dumps(metadata))
+        metadata["children"] = sorted(metadata.get("children", []), key=lambda c: c["name"])
+        return metadata
+    return normalise(rebuilt) == normalise(remote_metadata)
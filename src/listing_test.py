@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.listing_test
+    ~~~~~~~~~~~~~~
+
+    Tests the delta listing and the rebuild engine built on it
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from listing import RemoteListing, rebuild_index
+from node import NRootFolder
+from workers import WorkerPool
+from node_test import _StoreClient
+
+
+class _DeltaClient(_StoreClient):
+    """Keeps a log of changes, served a page at a time by delta"""
+    PAGE_SIZE = 2
+
+    def __init__(self):
+        super(_DeltaClient, self).__init__()
+        self.log = []
+        self.revs = 0
+        self.gets = []
+        self.deltas = []
+
+    def put_file(self, path, file_obj, overwrite=False):
+        super(_DeltaClient, self).put_file(path, file_obj, overwrite)
+        path = self.puts[-1]
+        parts = path.split("/")
+        for i in range(2, len(parts)):
+            folder = "/".join(parts[:i])
+            if not any(p == folder.lower() for p, meta in self.log):
+                self.log.append((folder.lower(), {"path": folder, "is_dir": True}))
+        self.revs = self.revs + 1
+        self.log.append((path.lower(), {"path": path, "is_dir": False, "rev": "r{}".format(self.revs)}))
+        return {"path": path, "rev": "r{}".format(self.revs)}
+
+    def remove(self, path):
+        del self.files[path]
+        self.log.append((path.lower(), None))
+
+    def get_file(self, path, start=None, length=None):
+        self.gets.append(path)
+        return super(_DeltaClient, self).get_file(path, start, length)
+
+    def delta(self, cursor=None, path_prefix=None):
+        start = int(cursor or 0)
+        entries = [e for e in self.log[start:start + self.PAGE_SIZE] if e[0] == path_prefix.lower() or e[0].startswith(path_prefix.lower() + "/")]
+        end = min(start + self.PAGE_SIZE, len(self.log))
+        self.deltas.append(cursor)
+        return {"entries": entries, "reset": cursor is None, "cursor": str(end), "has_more": end < len(self.log)}
+
+
+class TestRemoteListing(unittest.TestCase):
+    """Test RemoteListing and rebuild_index"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.state = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        self.addCleanup(shutil.rmtree, self.state)
+        os.makedirs(os.path.join(self.source, "a", "b"))
+        for name in ["top", os.path.join("a", "x"), os.path.join("a", "b", "y"), os.path.join("a", "b", "z")]:
+            with open(os.path.join(self.source, name), "w") as f:
+                f.write(name)
+        self.client = _DeltaClient()
+        local = NRootFolder()
+        local.walk_local_tree_r(self.source)
+        local.upload(self.source, self.client, "t", "/x")
+
+    def _rebuild(self, pool=None):
+        listing = RemoteListing(self.state, "t", "/x")
+        listing.load()
+        listing.update(self.client)
+        root, complete = rebuild_index(self.client, listing, pool)
+        self.assertTrue(complete)
+        listing.save()
+        return root
+
+    def _listed(self, path):
+        return sorted(c["name"] for c in json.loads(self.client.files[path + "/.dropboxbackupmeta"])["children"])
+
+    def test_rebuild_drops_missing_files(self):
+        """Files gone from Dropbox are dropped from the index, everything else is kept"""
+        self.client.remove("/t/data/x/a/b/y")
+        with WorkerPool(2) as pool:
+            root = self._rebuild(pool)
+        self.assertEqual(self._listed("/t/data/x/a/b"), ["z"])
+        self.assertEqual(self._listed("/t/data/x/a"), ["b", "x"])
+        self.assertEqual(self._listed("/t/data/x"), ["a", "top"])
+        self.assertEqual(sorted(c.name for c in root.children), ["a", "top"])
+
+    def test_unchanged_backup_is_not_rewritten(self):
+        """Rebuilding an index that's already right writes nothing"""
+        del self.client.puts[:]
+        self._rebuild()
+        self.assertEqual(self.client.puts, [])
+
+    def test_second_rebuild_only_fetches_changes(self):
+        """The saved cursor means only changes are listed, and metadata we wrote isn't downloaded again"""
+        self.client.remove("/t/data/x/a/b/y")
+        self._rebuild()
+        self.assertEqual(len(self.client.gets), 3)
+        # Paged through the whole log from the start
+        self.assertEqual(self.client.deltas[0], None)
+
+        del self.client.gets[:]
+        del self.client.deltas[:]
+        del self.client.puts[:]
+        self._rebuild()
+        self.assertNotIn(None, self.client.deltas)
+        self.assertEqual(self.client.gets, [])
+        self.assertEqual(self.client.puts, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.metrics
+    ~~~~~~~~~~~~~~
+
+    Records where a run spent its time: each phase's wall time, and the
+    requests, bytes and latencies of the Dropbox calls made during it
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import bisect
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import dropbox
+
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Requests made outside of any phase are put down to this one
+NO_PHASE = "other"
+
+
+class _Phase(object):
+    """What happened during one phase"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def as_dict(self):
+        return {
+            "seconds": round(self.seconds, 3),
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total = self.total + seconds
+
+    def cumulative(self):
+        """(upper bound, requests that took at most that long), ending with +Inf"""
+        running = 0
+        buckets = []
+        for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], self.counts):
+            running = running + count
+            buckets.append((bound, running))
+        return buckets
+
+
+class Metrics(object):
+    """Everything recorded about one backup, restore or rebuild
+
+    Phases run one after another; wrap each in `phase`. Requests made by
+    worker threads during a phase count towards it.
+    """
+
+    def __init__(self, command, target):
+        self.command = command
+        self.target = target
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.success = None
+        self.phases = collections.OrderedDict()
+        self.current = NO_PHASE
+        self.files = collections.Counter()
+        self.latency = collections.defaultdict(_Histogram)
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = _Phase()
+        return self.phases[name]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase, and put the requests made during it down to it"""
+        with self.lock:
+            self._phase(name)
+            previous, self.current = self.current, name
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._phase(name).seconds += time.time() - started
+                self.current = previous
+
+    def record_request(self, method, seconds, sent=0, received=0, status=None):
+        """Record one Dropbox request; status is the HTTP status if it failed"""
+        with self.lock:
+            phase = self._phase(self.current)
+            phase.requests[method] += 1
+            phase.bytes_sent += sent
+            phase.bytes_received += received
+            if status is not None:
+                phase.errors["{}:{}".format(method, status)] += 1
+            self.latency[method].observe(seconds)
+
+    def record_received(self, received):
+        """Count bytes read from a response after its request was recorded"""
+        with self.lock:
+            self._phase(self.current).bytes_received += received
+
+    def record_files(self, uploaded=0, failed=0, skipped=0):
+        """Count files backed up, that failed to back up, and that didn't need backing up"""
+        with self.lock:
+            self.files["uploaded"] += uploaded
+            self.files["failed"] += failed
+            self.files["skipped"] += skipped
+
+    def finish(self, success):
+        """Mark the run as over"""
+        self.finished = time.time()
+        self.success = success
+
+    def report(self):
+        """The run as a JSON encodable dict"""
+        with self.lock:
+            return {
+                "command": self.command,
+                "target": self.target,
+                "started": self.started,
+                "seconds": round((self.finished or time.time()) - self.started, 3),
+                "success": self.success,
+                "phases": collections.OrderedDict((name, phase.as_dict()) for name, phase in self.phases.items()),
+                "files": dict(self.files),
+                "latency": dict((method, {"buckets": histogram.cumulative(), "sum": round(histogram.total, 3)})
+                                for method, histogram in self.latency.items()),
+            }
+
+    def write_json(self, path):
+        """Write the run report as JSON"""
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write the run in the Prometheus text format, for node_exporter's textfile collector"""
+        report = self.report()
+        base = {"command": self.command, "target": self.target}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP dropback_{} {}".format(name, help_text))
+            lines.append("# TYPE dropback_{} {}".format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append("dropback_{}{}{} {}".format(name, suffix, _labels(dict(base, **labels)), value))
+
+        metric("last_run_timestamp_seconds", "gauge", "When the last run started.", [("", {}, report["started"])])
+        metric("last_run_seconds", "gauge", "How long the last run took.", [("", {}, report["seconds"])])
+        metric("last_run_success", "gauge", "1 if the last run completed.", [("", {}, 1 if report["success"] else 0)])
+        phases = report["phases"].items()
+        metric("phase_seconds", "gauge", "Wall time of each phase of the last run.",
+               [("", {"phase": name}, phase["seconds"]) for name, phase in phases])
+        metric("requests", "gauge", "Dropbox requests made in each phase of the last run.",
+               [("", {"phase": name, "method": method}, count) for name, phase in phases for method, count in sorted(phase["requests"].items())])
+        metric("request_errors", "gauge", "Failed Dropbox requests in each phase of the last run.",
+               [("", {"phase": name, "method": key.split(":")[0], "status": key.split(":")[1]}, count)
+                for name, phase in phases for key, count in sorted(phase["errors"].items())])
+        metric("bytes_sent", "gauge", "Bytes sent to Dropbox in each phase of the last run.",
+               [("", {"phase": name}, phase["bytes_sent"]) for name, phase in phases])
+        metric("bytes_received", "gauge", "Bytes received from Dropbox in each phase of the last run.",
+               [("", {"phase": name}, phase["bytes_received"]) for name, phase in phases])
+        metric("files", "gauge", "Files by what happened to them in the last run.",
+               [("", {"outcome": outcome}, count) for outcome, count in sorted(report["files"].items())])
+        samples = []
+        for method, histogram in sorted(report["latency"].items()):
+            for bound, count in histogram["buckets"]:
+                samples.append(("_bucket", {"method": method, "le": bound}, count))
+            samples.append(("_sum", {"method": method}, histogram["sum"]))
+            samples.append(("_count", {"method": method}, histogram["buckets"][-1][1]))
+        metric("request_duration_seconds", "histogram", "Latency of Dropbox requests in the last run.", samples)
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+def _labels(labels):
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in sorted(labels.items())) + "}"
+
+
+def _write_atomically(path, data):
+    # The textfile collector may read at any time, so never let it see half a file
+    temp_path = "{}.tmp".format(path)
+    with open(temp_path, "w") as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+
+@contextlib.contextmanager
+def _both(first, second):
+    with first:
+        with second:
+            yield
+
+
+def phase(metrics, name, profiler=None):
+    """Enter a phase of the metrics and the profiler, whichever we have; nothing at all if neither"""
+    if profiler is None:
+        return metrics.phase(name) if metrics is not None else _NO_PHASE
+    if metrics is None:
+        return profiler.phase(name)
+    return _both(metrics.phase(name), profiler.phase(name))
+
+
+def _size(file_obj):
+    """How many bytes an upload will send"""
+    if isinstance(file_obj, basestring):
+        return len(file_obj)
+    if hasattr(file_obj, "getvalue"):
+        return len(file_obj.getvalue())
+    try:
+        position = file_obj.tell()
+        file_obj.seek(0, os.SEEK_END)
+        end = file_obj.tell()
+        file_obj.seek(position)
+        return end - position
+    except Exception:
+        return 0
+
+
+class _CountingResponse(object):
+    """Passes a get_file response through, counting the bytes read from it"""
+
+    def __init__(self, response, metrics):
+        self._response = response
+        self._metrics = metrics
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._metrics.record_received(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._response.close()
+
+
+class _ChunkRecordingClient(object):
+    """The client a ChunkedUploader sends its chunks through; records them, passes the rest"""
+
+    def __init__(self, client, instrumented):
+        self._client = client
+        self._instrumented = instrumented
+
+    def upload_chunk(self, *args, **kwargs):
+        return self._instrumented._call("upload_chunk", self._client.upload_chunk, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class _InstrumentedUploader(object):
+    """Passes a ChunkedUploader through, so its chunks and commit are recorded too"""
+
+    def __init__(self, uploader, client):
+        # The uploader calls its client directly, so its requests would otherwise go unseen
+        uploader.client = _ChunkRecordingClient(uploader.client, client)
+        self.__dict__["_uploader"] = uploader
+        self.__dict__["_client"] = client
+
+    def finish(self, *args, **kwargs):
+        return self._client._call("commit_chunked_upload", self._uploader.finish, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._uploader, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._uploader, name, value)
+
+
+class InstrumentedClient(object):
+    """Wraps a DropboxClient, recording every request it makes in a Metrics"""
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == "get_chunked_uploader":
+            # Doesn't make a request itself, but the uploader does
+            return lambda *args, **kwargs: _InstrumentedUploader(attr(*args, **kwargs), self)
+        return lambda *args, **kwargs: self._call(name, attr, args, kwargs)
+
+    def _call(self, method, fn, args, kwargs):
+        sent = 0
+        # put_file(full_path, file_obj, ...) and upload_chunk(file_obj, ...)
+        position = {"put_file": 1, "upload_chunk": 0}.get(method)
+        if position is not None:
+            sent = _size(args[position] if len(args) > position else kwargs.get("file_obj"))
+        started = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except dropbox.rest.ErrorResponse as e:
+            self._metrics.record_request(method, time.time() - started, sent, status=e.status)
+            raise
+        except Exception:
+            self._metrics.record_request(method, time.time() - started, sent, status="error")
+            raise
+        self._metrics.record_request(method, time.time() - started, sent)
+        if method == "get_file":
+            return _CountingResponse(result, self._metrics)
+        return result
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.metrics_test
+    ~~~~~~~~~~~~~~
+
+    Tests recording and reporting a run's metrics
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import json
+import shutil
+import StringIO
+import tempfile
+import dropbox
+import backup
+from fakeclient import FakeDropboxClient
+from metrics import Metrics, InstrumentedClient
+
+
+class TestMetrics(unittest.TestCase):
+    """Test Metrics and InstrumentedClient"""
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work)
+        self.fake = FakeDropboxClient(os.path.join(self.work, "dropbox"))
+        self.metrics = Metrics("backup", "t:/")
+        self.client = InstrumentedClient(self.fake, self.metrics)
+
+    def test_requests_are_put_down_to_their_phase(self):
+        """Requests, bytes and failures count towards the phase they were made in"""
+        with self.metrics.phase("upload"):
+            self.client.put_file("/t/f", "0123456789")
+            self.fake.inject(503, "put_file")
+            with self.assertRaises(dropbox.rest.ErrorResponse):
+                self.client.put_file("/t/g", "x")
+        with self.metrics.phase("restore"):
+            with self.client.get_file("/t/f") as f:
+                f.read()
+        self.client.metadata("/t")
+
+        report = self.metrics.report()
+        self.assertEqual(list(report["phases"]), ["upload", "restore", "other"])
+        upload = report["phases"]["upload"]
+        self.assertEqual(upload["requests"], {"put_file": 2})
+        self.assertEqual(upload["errors"], {"put_file:503": 1})
+        self.assertEqual(upload["bytes_sent"], 11)
+        self.assertEqual(report["phases"]["restore"]["bytes_received"], 10)
+        self.assertEqual(report["phases"]["other"]["requests"], {"metadata": 1})
+        self.assertEqual(report["latency"]["put_file"]["buckets"][-1], ("+Inf", 2))
+
+    def test_chunked_commit_is_recorded(self):
+        """Chunks are counted as they're sent, and the commit when the uploader finishes"""
+        uploader = self.client.get_chunked_uploader(StringIO.StringIO("x" * 10), 10)
+        uploader.upload_chunked(4)
+        uploader.finish("/t/big")
+        phase = self.metrics.report()["phases"]["other"]
+        self.assertEqual(phase["requests"], {"upload_chunk": 3, "commit_chunked_upload": 1})
+        self.assertEqual(phase["bytes_sent"], 10)
+        self.assertEqual(self.fake.requests["commit_chunked_upload"], 1)
+
+    def test_backup_report(self):
+        """A reported backup writes both reports, with every phase and the files it uploaded"""
+        source = os.path.join(self.work, "source")
+        os.makedirs(os.path.join(source, "a"))
+        for name in ["one", os.path.join("a", "two")]:
+            with open(os.path.join(source, name), "w") as f:
+                f.write(name)
+        saved_config = backup.CONFIG_SEARCH_PATHS
+        self.addCleanup(setattr, backup, "CONFIG_SEARCH_PATHS", saved_config)
+        backup.CONFIG_SEARCH_PATHS = [self.work]
+        report_path = os.path.join(self.work, "report.json")
+        prometheus_path = os.path.join(self.work, "dropback.prom")
+
+        argv = ["backup", source, "t:/", "--no-cache", "--report", report_path, "--prometheus", prometheus_path]
+        backup.run_command(backup.backup, backup.backup_parser().parse_args(argv), self.fake, "t:/")
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertTrue(report["success"])
+        # Creating the target folders comes before the first phase
+        self.assertEqual(sorted(report["phases"]), ["diff", "local_walk", "other", "remote_walk", "upload"])
+        self.assertEqual(report["files"], {"uploaded": 2, "failed": 0, "skipped": 0})
+        self.assertGreater(report["phases"]["upload"]["requests"]["put_file"], 2)
+
+        # Nothing changed, so the second run skips both files
+        backup.run_command(backup.backup, backup.backup_parser().parse_args(argv), self.fake, "t:/")
+        with open(report_path) as f:
+            self.assertEqual(json.load(f)["files"], {"uploaded": 0, "failed": 0, "skipped": 2})
+        with open(prometheus_path) as f:
+            prometheus = f.read()
+        self.assertIn('dropback_files{command="backup",outcome="skipped",target="t:/"} 2', prometheus)
+        self.assertIn('dropback_last_run_success{command="backup",target="t:/"} 1', prometheus)
+        self.assertIn('le="+Inf",method="get_file"', prometheus)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,13 +12,40 @@
     :license: See README.md and LICENSE for more details
 """
 import logging
+import collections
+import functools
 import os
+import stat
 import dropbox
 import StringIO
-import glob
 import json
+import hashlib
+import marshal
+import multiprocessing
 import traceback
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python2 needs the scandir backport
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from workers import wait_all
+from journal import file_identity
+from hashing import hash_file
+from packing import pack_path
+from compression import decompress_file
+from chunkstore import fetch_block, content_hash, chunks_store
+
+
+# What the backup has at a node's remote path; see NFile.remote_kind
+REMOTE_FILE = "file"
+REMOTE_FOLDER = "folder"
+REMOTE_ABSENT = "absent"
+
 
 class UnknownNodeTypeException(Exception):
     """Raised if an unknown node type is encountered in the metadata"""
@@ -26,28 +53,32 @@ class UnknownNodeTypeException(Exception):
 
 
 class NFile(object):
-    """Represents a file"""
+    """Represents a file
+
+    Backups can have millions of nodes, so nodes use __slots__ rather than a
+    __dict__ each, and share one copy of each distinct name.
+    """
+    __slots__ = (
+        "name", "uid", "gid", "mode", "mtime", "ctime", "size", "parent",
+        "symlink_target", "hash", "ino", "copy_source", "pack", "compression",
+        "chunks", "uploaded", "todelete",
+    )
+
     # 100 MB chunk limit. 
     # Dropbox actually states 120MB is the limit but this is lower to be safer
     CHUNKED_SIZE_LIMIT = 1024*1024*100
+    # Size of each chunk sent by a chunked upload
+    CHUNK_SIZE = 1024*1024*4
 
-    name   = None
-    uid    = None
-    gid    = None
-    mode   = None
-    mtime  = None
-    ctime  = None
-    size   = None
-
-    parent = None
-
-    symlink_target = None
-
-    uploaded = False
-    todelete = False
+    # Restores are streamed to disk this many bytes at a time
+    RESTORE_CHUNK_SIZE = 1024*1024*4
+    # Appended to the name of a file while it's being restored
+    PARTIAL_SUFFIX = ".dropbackpart"
+    # Appended to the partial file's name for a note of what it's a partial copy of
+    PARTIAL_SOURCE_SUFFIX = ".source"
 
     def __init__(self, parent, name, stats):
-        self.name  = name
+        self.name  = intern_name(name)
         self.parent = parent
         self.uid   = stats["uid"]
         self.gid   = stats["gid"]
@@ -56,6 +87,25 @@ class NFile(object):
         self.ctime = stats["ctime"]
         self.size  = stats["size"]
 
+        self.symlink_target = None
+
+        # Optional content hash; see hashing.hash_file
+        self.hash  = stats.get("hash")
+        # Local inode number, used to spot renamed files
+        self.ino   = stats.get("ino")
+
+        # Remote path of identical content to copy rather than upload
+        self.copy_source = None
+        # Where we are in a pack of small files, if we were packed; see packing.Packer
+        self.pack = None
+        # How our content was compressed on upload, if it was; see compression.Compressor
+        self.compression = None
+        # The blocks our content was stored as, if it was; see chunkstore.ChunkStore
+        self.chunks = None
+
+        self.uploaded = False
+        self.todelete = False
+
     def encodable(self, max_recurse_depth=-1, only_uploaded=True):
         """Returns an encodable representation of NFile"""
         # We accept extra parameters on encodable that NFile doesn't need
@@ -73,25 +123,54 @@ class NFile(object):
                 "size": self.size
             }
         }
+        if self.hash:
+            obj["stats"]["hash"] = self.hash
+        if self.ino:
+            obj["stats"]["ino"] = self.ino
         if self.symlink_target:
             obj["symlink_target"] = self.symlink_target
+        if self.pack:
+            obj["pack"] = self.pack
+        if self.compression:
+            obj["compression"] = self.compression
+        if self.chunks:
+            obj["chunks"] = self.chunks
 
         return obj
 
-    # Replace this with a more efficient approach
+    def reuse_remote_content(self, remote):
+        """Point this local node at content that's already in the backup"""
+        self.uploaded = True
+        self.pack = remote.pack
+        self.compression = remote.compression
+        self.chunks = remote.chunks
+
+    def compute_hash(self, source_base):
+        """Hash our local file's content, unless we're a symlink"""
+        if not self.symlink_target:
+            self.hash = hash_file(self.generate_full_path(source_base))
+        return self.hash
+
+    def compact(self):
+        """Returns a small, marshallable tuple form of this node and its children"""
+        return ("NFile", self.name, tuple(getattr(self, f) for f in STAT_FIELDS), self.symlink_target, None)
+
     def generate_path (self):
         """Generate the location from parent of this NFile"""
-        current_path = os.path.join(self.name)
-        node = self.parent
-        while node != None:
-            current_path = os.path.join(node.name, current_path)
-            node = node.parent
-        return current_path
+        # Folders remember their path, so this is one join however deep we are
+        if self.parent is None:
+            return self.name
+        return os.path.join(self.parent.generate_path(), self.name)
 
     def generate_full_path(self, source_base):
         """Generate the location of NFile, relative to source_base"""
         return os.path.join(source_base, self.generate_path())
 
+    def generate_remote_path(self, target, target_base="/"):
+        """Generate the location of this node in a Dropbox backup"""
+        target_path = "/".join([target_base, self.generate_path()])
+        return "/{target}/data{path}".format(target=target, path=target_path)
+
     def restore(self, local_base, dropbox_client, source, source_base="/", overwrite_mode=True, max_recurse_depth=-1):
         """Restore this file"""
         path = self.generate_path()
@@ -102,21 +181,13 @@ class NFile(object):
         try:
             if not os.path.exists(full_local_path) or overwrite_mode:
                 if not self.symlink_target:
-
-                    out = open(full_local_path, "wb")
-                    with dropbox_client.get_file(full_remote_path) as f:
-                        out.write(f.read())
-                    out.close()
-
-                    if self.mode:
-                        os.chmod(full_local_path, self.mode)
-                    
-                    if self.uid and self.gid:
-                        os.chown(full_local_path, self.uid, self.gid)
-
-                    if self.mtime:
-                        # Set atime to mtime as well
-                        os.utime(full_local_path,(self.mtime, self.mtime))
+                    if self.pack:
+                        self.download(dropbox_client, pack_path(source, self.pack["id"]), full_local_path, self.pack["offset"], self.pack["length"])
+                    elif self.chunks:
+                        self.download_blocks(dropbox_client, source, full_local_path)
+                    else:
+                        self.download(dropbox_client, full_remote_path, full_local_path)
+                    self.apply_local_stats(full_local_path)
                 else:
                     os.symlink(self.symlink_target, full_local_path)
                     # Symlink stats don't actually matter
@@ -129,8 +200,116 @@ class NFile(object):
             logging.error(traceback.format_exc())
             logging.error("Skipping NFile {remote_path}".format(remote_path=full_remote_path))
 
-    def upload(self, source_base, dropbox_client, target, target_base="/", overwrite_mode=True, max_recurse_depth=-1):
+    def apply_local_stats(self, full_local_path):
+        """Set the mode, ownership and mtime of a restored path"""
+        if self.mode:
+            os.chmod(full_local_path, self.mode)
+
+        if self.uid and self.gid:
+            os.chown(full_local_path, self.uid, self.gid)
+
+        if self.mtime:
+            # Set atime to mtime as well
+            os.utime(full_local_path, (self.mtime, self.mtime))
+
+    def download(self, dropbox_client, full_remote_path, full_local_path, start=0, length=None):
+        """Stream a remote file, or `length` bytes of it from `start`, to full_local_path
+
+        Data goes to a partial file beside the target, which is renamed into
+        place once complete, or decompressed into place if we were compressed.
+        A partial file left by an interrupted restore of the same version of
+        the file is resumed with a range request rather than downloaded again.
+        """
+        if length is not None:
+            expected = length
+        elif self.compression:
+            expected = self.compression["length"]
+        else:
+            expected = self.size
+        partial_path = "{}{}".format(full_local_path, self.PARTIAL_SUFFIX)
+        offset = self._resume_partial(partial_path, [full_remote_path, start, length])
+        if expected is None or offset >= expected:
+            # We can't tell how much of this partial file is any good, so start again
+            offset = 0
+
+        ranged = length is not None or start + offset > 0
+        with open(partial_path, "ab" if offset else "wb") as out:
+            if offset:
+                logging.info("Resuming restore of '{}' from byte {}".format(full_local_path, offset))
+            with dropbox_client.get_file(full_remote_path,
+                                         start=start + offset if ranged else None,
+                                         length=length - offset if length is not None else None) as f:
+                if ranged and getattr(f, "status", 206) != 206:
+                    # Range wasn't honoured, we've been sent the whole file
+                    if length is not None:
+                        raise Exception("Dropbox ignored the range request for '{}'".format(full_remote_path))
+                    out.seek(0)
+                    out.truncate()
+                while True:
+                    block = f.read(self.RESTORE_CHUNK_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+        if self.compression:
+            decompress_file(partial_path, full_local_path, self.compression["method"])
+        else:
+            os.rename(partial_path, full_local_path)
+        self._finish_partial(partial_path)
+
+    def download_blocks(self, dropbox_client, source, full_local_path):
+        """Reassemble a file stored as blocks into full_local_path
+
+        As with download, blocks go to a partial file that's renamed into
+        place; an interrupted restore carries on from the last whole block.
+        """
+        store = chunks_store(self.chunks, source)
+        block_size = self.chunks["block_size"]
+        hashes = self.chunks["hashes"]
+        partial_path = "{}{}".format(full_local_path, self.PARTIAL_SUFFIX)
+        # The block hashes say exactly what the file holds, but there can be a lot of them
+        done = self._resume_partial(partial_path, [store, block_size, hashlib.sha1("".join(hashes)).hexdigest()]) // block_size
+        done = min(done, len(hashes))
+
+        with open(partial_path, "r+b" if done else "wb") as out:
+            if done:
+                logging.info("Resuming restore of '{}' from block {}".format(full_local_path, done))
+                out.seek(done * block_size)
+                out.truncate()
+            for block_hash in hashes[done:]:
+                out.write(fetch_block(dropbox_client, store, block_hash))
+        os.rename(partial_path, full_local_path)
+        self._finish_partial(partial_path)
+
+    def _resume_partial(self, partial_path, source):
+        """How much of a partial file we can keep, noting what it's now a partial copy of
+
+        A partial file is only any good if it came from the same version of
+        this file, so we keep a note beside it of the file's stats and where
+        it was downloaded from. A partial file without a note, or with one
+        that doesn't match, is started again.
+        """
+        source = json.dumps([self.size, self.mtime, self.hash] + source)
+        source_path = "{}{}".format(partial_path, self.PARTIAL_SOURCE_SUFFIX)
+        try:
+            with open(source_path) as source_h:
+                if source_h.read() == source:
+                    return os.path.getsize(partial_path)
+        except (IOError, OSError):
+            pass
+        with open(source_path, "w") as source_h:
+            source_h.write(source)
+        return 0
+
+    def _finish_partial(self, partial_path):
+        """Remove the note beside a partial file, once it has been moved into place"""
+        try:
+            os.unlink("{}{}".format(partial_path, self.PARTIAL_SOURCE_SUFFIX))
+        except OSError:
+            pass
+
+    def upload(self, source_base, dropbox_client, target, target_base="/", overwrite_mode=True, max_recurse_depth=-1, pool=None, journal=None, chunk_size=None, packer=None, compressor=None, chunk_store=None, metadata_writes=None, remote_state=None, finished=None):
         """Upload this file to Dropbox"""
+        # We accept extra parameters that NFile doesn't need, as with encodable
         if not self.uploaded:
             path = self.generate_path()
             full_local_path = os.path.join(source_base, path)
@@ -138,25 +317,36 @@ class NFile(object):
             full_remote_path = "/{target}/data{path}".format(target=target, path=target_path)
 
             try:
+                if packer is not None and not self.copy_source and packer.accepts(self):
+                    logging.info("Packing NFile '{local_path}'".format(local_path=path))
+                    packer.add(self, full_local_path)
+                    return
+
+                if chunk_store is not None and not self.copy_source and chunk_store.accepts(self):
+                    logging.info("Backing up NFile '{local_path}' as blocks".format(local_path=path))
+                    with open(full_local_path, "rb") as file_h:
+                        self.chunks = chunk_store.upload(file_h)
+                    # The block hashes give us the content hash for free
+                    self.hash = self.hash or content_hash(self.chunks)
+                    self.uploaded = True
+                    return
+
                 # Let's start by confirming the remote file/folder
                 logging.info("Backing up NFile '{local_path}' to '{remote_path}'".format(local_path=path, remote_path=full_remote_path))
                 
                 if self.symlink_target:
                     full_remote_path = "{name}.symlink".format(name=full_remote_path)
 
-                meta = {}
-                try:
-                    meta = dropbox_client.metadata(full_remote_path)
-                except (dropbox.rest.ErrorResponse) as e:
-                    if e.status != 404:
-                        raise e
-
-                if not overwrite_mode and "is_dir" in meta and meta["is_dir"] is True:
+                if not overwrite_mode and self.remote_kind(dropbox_client, full_remote_path, remote_state) == REMOTE_FOLDER:
                     # We care if the remote path is a dir and we're a file, UNLESS we don't want to overwrite anyway.
                     logging.warning("Folder exists at remote location; attempting removal...")
                     dropbox_client.file_delete(full_remote_path)
 
-                if self.symlink_target:
+                if self.copy_source and self.copy_remote(dropbox_client, full_remote_path, overwrite_mode):
+                    # Same content is already in the backup elsewhere; Dropbox copied it for us
+                    # It's stored however the original was, which detect_renames gave us as our compression
+                    pass
+                elif self.symlink_target:
                     # If we're a symlink, upload as symlink
                     response = dropbox_client.put_file(
                                     "{path}".format(path=full_remote_path),
@@ -167,20 +357,18 @@ class NFile(object):
                     # Right, now to actually upload 
                     with open(full_local_path, "rb") as file_h:
                         # @TODO: Update the file size/stats incase they've changed since we enumerated the directories
-                        if self.size < self.CHUNKED_SIZE_LIMIT:
-                            response = dropbox_client.put_file(
-                                    "{path}".format(path=full_remote_path),
-                                    file_obj=file_h,
-                                    overwrite=overwrite_mode
-                                )
+                        self.compression = None
+                        compressed = compressor.compress(file_h) if compressor is not None and compressor.accepts(self) else None
+                        if compressed:
+                            compressed_h, length = compressed
+                            try:
+                                # A compressed copy differs every time, so can't be resumed from the journal
+                                self.upload_content(dropbox_client, compressed_h, length, full_remote_path, overwrite_mode, None, chunk_size)
+                            finally:
+                                compressed_h.close()
+                            self.compression = {"method": compressor.METHOD, "length": length}
                         else:
-                            uploader = dropbox_client.get_chunked_uploader(file_h, self.size)
-                            while uploader.offset < self.size:
-                                upload = uploader.upload_chunked()
-                            uploader.finish(
-                                "{path}".format(path=full_remote_path),
-                                overwrite=overwrite_mode
-                            )
+                            self.upload_content(dropbox_client, file_h, self.size, full_remote_path, overwrite_mode, journal, chunk_size)
                 self.uploaded = True
 
             except Exception as e:
@@ -190,6 +378,101 @@ class NFile(object):
         else:
             logging.debug("NFile `{}` already fully uploaded".format(self.generate_full_path(source_base)))
 
+    def remote_kind(self, dropbox_client, full_remote_path, remote_state=None):
+        """What the backup has at full_remote_path: REMOTE_FILE, REMOTE_FOLDER or REMOTE_ABSENT
+
+        Asks remote_state first, if we have one, and Dropbox only if it can't tell.
+        """
+        kind = remote_state.lookup(self) if remote_state is not None else None
+        if kind is not None:
+            return kind
+        try:
+            meta = dropbox_client.metadata(full_remote_path, list=False)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status != 404:
+                raise
+            return REMOTE_ABSENT
+        if meta.get("is_deleted"):
+            return REMOTE_ABSENT
+        return REMOTE_FOLDER if meta.get("is_dir") else REMOTE_FILE
+
+    def copy_remote(self, dropbox_client, full_remote_path, overwrite_mode=True):
+        """Server-side copy our content from copy_source; returns False if that failed"""
+        logging.info("Copying '{source}' to '{remote_path}' in Dropbox".format(source=self.copy_source, remote_path=full_remote_path))
+        try:
+            try:
+                dropbox_client.file_copy(self.copy_source, full_remote_path)
+            except dropbox.rest.ErrorResponse as e:
+                # Dropbox won't copy over an existing file
+                if e.status != 403 or not overwrite_mode:
+                    raise
+                dropbox_client.file_delete(full_remote_path)
+                dropbox_client.file_copy(self.copy_source, full_remote_path)
+            return True
+        except Exception as e:
+            logging.warning("Could not copy '{source}' to '{remote_path}'; uploading it instead".format(source=self.copy_source, remote_path=full_remote_path))
+            logging.warning(e)
+            return False
+
+    def upload_content(self, dropbox_client, file_h, length, full_remote_path, overwrite_mode=True, journal=None, chunk_size=None):
+        """Upload `length` bytes from an open file, in chunks if there's a lot of it"""
+        if length < self.CHUNKED_SIZE_LIMIT:
+            dropbox_client.put_file(
+                    "{path}".format(path=full_remote_path),
+                    file_obj=file_h,
+                    overwrite=overwrite_mode
+                )
+        else:
+            self.upload_chunked(dropbox_client, file_h, full_remote_path, overwrite_mode, journal, chunk_size, length)
+
+    def upload_chunked(self, dropbox_client, file_h, full_remote_path, overwrite_mode=True, journal=None, chunk_size=None, length=None):
+        """Upload an open file in chunks
+
+        With an UploadJournal, every acknowledged chunk is recorded so that
+        an interrupted upload of the same, unchanged file carries on from
+        where it stopped next time.
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        length = self.size if length is None else length
+        uploader = dropbox_client.get_chunked_uploader(file_h, length)
+        identity = file_identity(file_h) if journal else None
+        resumed = journal.get(full_remote_path, identity) if journal else None
+        if resumed:
+            uploader.upload_id, uploader.offset = resumed
+            file_h.seek(uploader.offset)
+            logging.info("Resuming upload of '{}' from byte {}".format(full_remote_path, uploader.offset))
+
+        while uploader.offset < length:
+            block = file_h.read(min(chunk_size, length - uploader.offset))
+            if not block:
+                raise Exception("File shrank while it was being uploaded")
+            try:
+                uploader.offset, uploader.upload_id = dropbox_client.upload_chunk(block, len(block), uploader.offset, uploader.upload_id)
+            except dropbox.rest.ErrorResponse as e:
+                reply = e.body if isinstance(e.body, dict) else {}
+                if e.status == 400 and reply.get("offset", 0) > uploader.offset:
+                    # Dropbox already has more than we thought; skip ahead like ChunkedUploader does
+                    uploader.offset = reply["offset"]
+                    file_h.seek(uploader.offset)
+                    continue
+                if resumed and e.status == 404:
+                    # Dropbox has forgotten the upload we were resuming; start again
+                    logging.warning("Could not resume upload of '{}', restarting it".format(full_remote_path))
+                    resumed = None
+                    uploader.offset, uploader.upload_id = 0, None
+                    file_h.seek(0)
+                    continue
+                raise
+            if journal:
+                journal.record(full_remote_path, identity, uploader.upload_id, uploader.offset)
+
+        uploader.finish(
+            "{path}".format(path=full_remote_path),
+            overwrite=overwrite_mode
+        )
+        if journal:
+            journal.finish(full_remote_path)
+
     def __repr__(self):
         return "<NFile (name={}, uploaded={}, parent_name={})>".format(self.name, self.uploaded, self.parent.name)
 
@@ -197,15 +480,28 @@ class NFile(object):
 class NFolder(NFile):
     """Represents a folder as a special case of NFile"""
     # Folder is a special type of file
-    children = None
+    __slots__ = ("children", "_path", "dirty")
 
     # We use JSON not Pickle for Metadata in case our class definition changes
     METADATA_FILENAME = ".dropboxbackupmeta"
     LASTUPLOAD_FILENAME = ".dropboxbackuplastupload"
 
+    # How many levels walk_local_tree_sharded may list before handing out work
+    SHARD_EXPAND_LEVELS = 3
+
     def __init__(self, parent, name, stats):
         super(NFolder, self).__init__(parent, name, stats)
         self.children = []
+        self._path = None
+        # False once a diff has found our metadata wouldn't change
+        self.dirty = True
+
+    def generate_path(self):
+        """Generate the location from parent of this NFolder, remembering it"""
+        # Names and parents don't change once a node is made, so neither does this
+        if self._path is None:
+            self._path = super(NFolder, self).generate_path()
+        return self._path
 
     def encodable(self, max_recurse_depth=-1, only_uploaded=False):
         """Returns an encodable representation of NFile"""
@@ -216,49 +512,114 @@ class NFolder(NFile):
         d["_type"] = "NFolder"
         return d
 
+    def compact(self):
+        """Returns a small, marshallable tuple form of this node and its children"""
+        _, name, stats, symlink_target, _ = super(NFolder, self).compact()
+        return ("NFolder", name, stats, symlink_target, tuple(c.compact() for c in self.children))
+
     def get_metadata_from_path(self, ff_path):
         """Loads metadata about the local path"""
-        stats = os.stat(ff_path)
-        return {
-            'uid': stats.st_uid,
-            'gid': stats.st_gid,
-            'mode': stats.st_mode,
-            'mtime': stats.st_mtime,
-            'ctime': stats.st_ctime,
-            'size': stats.st_size
-        }
+        return stats_from_stat_result(os.stat(ff_path))
+
+    def walk_local_tree_r (self, source_base, max_recurse_depth=-1, include_hidden=False):
+        """Walks the local file tree on the source system
 
-    def walk_local_tree_r (self, source_base, max_recurse_depth=-1):
-        """Walks the local file tree on the source system"""
+        Hidden files and folders (starting with '.') are skipped unless
+        include_hidden is set.
+        """
         logging.debug("Node.walk_local_tree_r: Recurse depth {}".format(max_recurse_depth))
         # Recursively construct a local node tree
         # We assume someone's already checked we're a directory
         path = self.generate_path()
         full_local_path = os.path.join(source_base, path)
-        logging.debug("Walking NFolder '{local_path}'".format(local_path=full_local_path))
 
         if os.path.islink(full_local_path):
             self.symlink_target = os.readlink(full_local_path)
             logging.debug("NFolder is symlink to {}".format(self.symlink_target))
-            
 
         if not self.symlink_target:
             # Don't want to follow symlinks
-            for g in glob.iglob(os.path.join(full_local_path, "*")):
-                name = os.path.basename(g)
-                stats = self.get_metadata_from_path(g)
+            self._walk_local_dir(full_local_path, max_recurse_depth, include_hidden)
 
-                if os.path.isdir(g):
-                    new_folder = NFolder(self, name, stats)
-                    if max_recurse_depth != 0:
-                        new_folder.walk_local_tree_r(source_base, max_recurse_depth-1)
-                    self.children.append(new_folder)
-                else:
-                    new_file = NFile(self, name, stats)
-                    logging.debug("Located NFile `{}`".format(name))
-                    if os.path.islink(g):
-                        new_file.symlink_target = os.readlink(g)
-                    self.children.append(new_file)
+    def _walk_local_dir(self, full_local_path, max_recurse_depth, include_hidden):
+        """Adds the entries of a local directory, which must not be a symlink"""
+        logging.debug("Walking NFolder '{local_path}'".format(local_path=full_local_path))
+        try:
+            entries = list_local_dir(full_local_path)
+        except OSError as e:
+            logging.warning("Could not list NFolder '{local_path}'".format(local_path=full_local_path))
+            logging.warning(e)
+            return
+
+        for name, entry_path, lstats in entries:
+            if not include_hidden and name.startswith("."):
+                continue
+            try:
+                symlink_target = None
+                is_dir = stat.S_ISDIR(lstats.st_mode)
+                if stat.S_ISLNK(lstats.st_mode):
+                    # Only symlinks need more than the one lstat; we record what they point at
+                    symlink_target = os.readlink(entry_path)
+                    try:
+                        lstats = os.stat(entry_path)
+                        is_dir = stat.S_ISDIR(lstats.st_mode)
+                    except OSError:
+                        # Dangling symlink; keep the link's own stats
+                        pass
+                stats = stats_from_stat_result(lstats)
+            except OSError as e:
+                logging.warning("Could not stat '{local_path}'".format(local_path=entry_path))
+                logging.warning(e)
+                continue
+
+            if is_dir:
+                new_folder = NFolder(self, name, stats)
+                new_folder.symlink_target = symlink_target
+                if max_recurse_depth != 0 and not symlink_target:
+                    new_folder._walk_local_dir(entry_path, max_recurse_depth-1, include_hidden)
+                self.children.append(new_folder)
+            else:
+                new_file = NFile(self, name, stats)
+                logging.debug("Located NFile `{}`".format(name))
+                new_file.symlink_target = symlink_target
+                self.children.append(new_file)
+
+    def walk_local_tree_sharded(self, source_base, processes, include_hidden=False):
+        """Walks the local file tree using a pool of processes
+
+        The top of the tree is listed here until there are enough folders to
+        share out; each worker then walks whole subtrees and sends them back
+        in compact form. Builds the same tree as walk_local_tree_r.
+        """
+        full_local_path = os.path.join(source_base, self.generate_path())
+        if os.path.islink(full_local_path):
+            self.symlink_target = os.readlink(full_local_path)
+            logging.debug("NFolder is symlink to {}".format(self.symlink_target))
+            return
+
+        shards = [(self, full_local_path)]
+        for level in range(self.SHARD_EXPAND_LEVELS):
+            if len(shards) >= processes * 2:
+                break
+            next_shards = []
+            for folder, folder_path in shards:
+                folder._walk_local_dir(folder_path, 0, include_hidden)
+                next_shards.extend((c, os.path.join(folder_path, c.name)) for c in folder.children if isinstance(c, NFolder) and not c.symlink_target)
+            shards = next_shards
+        logging.debug("Node.walk_local_tree_sharded: {} shards over {} processes".format(len(shards), processes))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            jobs = [(i, folder_path, include_hidden) for i, (folder, folder_path) in enumerate(shards)]
+            for i, compact_children in pool.imap_unordered(_walk_local_shard, jobs):
+                folder = shards[i][0]
+                folder.children.extend(node_from_compact(folder, c) for c in marshal.loads(compact_children))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def rewrite_index_without_assumption_tree_r(self, dropbox_client, target, target_base="/", rewrite_index=True, max_recurse_depth=-1):
         """Reconstruct an and index without assuming metadata exists"""
@@ -350,17 +711,8 @@ class NFolder(NFile):
 
                             if name in metadata_children:
                                 # Oh good, we know what to do with it
-                                child_meta = metadata_children[name]
-                                child_node = None
-                                if child_meta["_type"] == "NFolder":
-                                    # This can happen if it's a symlink
-                                    child_node = NFolder(self, name, child_meta["stats"])
-                                else:
-                                    child_node = NFile(self, name, child_meta["stats"])
-                                child_node.uploaded = True
-                                if "symlink_target" in child_meta:
-                                    child_node.symlink_target = child_meta["symlink_target"]
-                                self.children.append(child_node)
+                                # An NFolder can happen if it's a symlink
+                                self.children.append(node_from_encodable(self, metadata_children[name]))
                             else:
                                 # Oh dear, we don't know anything useful about this file. We have to skip it
                                 pass
@@ -368,6 +720,13 @@ class NFolder(NFile):
                     logging.warning("Error verifying a child of '{full_remote_path}'".format(full_remote_path=full_remote_path))
                     logging.warning(e)
 
+            # Packed files and files stored as blocks don't have their own remote
+            # file, so won't be listed. We have to trust the metadata about them.
+            listed = set(c.name for c in self.children)
+            for name, child_meta in metadata_children.items():
+                if (child_meta.get("pack") or child_meta.get("chunks")) and name not in listed:
+                    self.children.append(node_from_encodable(self, child_meta))
+
         except Exception as e:
             logging.warning("Error verifying '{full_remote_path}'".format(full_remote_path=full_remote_path))
             logging.warning(e)
@@ -393,61 +752,118 @@ class NFolder(NFile):
 
         return someone_has_meta
 
+    def fetch_remote_metadata(self, dropbox_client, full_remote_path):
+        """Download and decode the metadata file in a remote folder"""
+        remote_metadata = {}
+        try:
+            metadata_h = StringIO.StringIO()
+            with dropbox_client.get_file("{folder_path}/{metadata_filename}".format(folder_path=full_remote_path, metadata_filename=self.METADATA_FILENAME)) as f:
+                metadata_h.write(f.read())
+            metadata_h.seek(0)
+            remote_metadata = json.load(metadata_h)
+            metadata_h.close()
+        except Exception as e:
+            logging.warning("Could not get remote metadata for '{full_remote_path}'".format(full_remote_path=full_remote_path))
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+        return remote_metadata
+
+    def load_remote_children(self, remote_metadata, full_remote_path):
+        """Add children described by a folder's remote metadata; returns the new nodes"""
+        loaded = []
+        if isinstance(self, NRootFolder):
+            self.generation = remote_metadata.get("generation")
+            # Nothing lists the root, so its metadata being there is how we know it's in the backup
+            self.uploaded = bool(remote_metadata)
+        for child in (remote_metadata["children"] if remote_metadata else []):
+            try:
+                child_node = node_from_encodable(self, child)
+                self.children.append(child_node)
+                loaded.append(child_node)
+
+            except Exception as e:
+                name = child["name"] if "name" in child else "Unknown"
+                logging.warning("Error walking child <{child}> in '{full_remote_path}'".format(child=name, full_remote_path=full_remote_path))
+                logging.warning(e)
+                logging.warning(traceback.format_exc())
+        return loaded
+
+    def load_encodable_tree(self, encoded):
+        """Rebuild our subtree from a fully recursive encodable()"""
+        for child in encoded.get("children", []):
+            child_node = node_from_encodable(self, child)
+            self.children.append(child_node)
+            if isinstance(child_node, NFolder):
+                child_node.load_encodable_tree(child)
+
     def walk_remote_tree_r(self, dropbox_client, target, target_base="/", max_recurse_depth=-1):
         """Walks a remote dropbox tree"""
         logging.debug("Node.walk_remote_tree_r: Recurse depth {}".format(max_recurse_depth))
 
         # Recursively construct a remote node tree based on remote metadata
         if not self.symlink_target:
-            path = self.generate_path()
-            target_path = "/".join([target_base, path])
-            full_remote_path = "/{target}/data{path}".format(target=target, path=target_path)
+            full_remote_path = self.generate_remote_path(target, target_base)
 
             logging.debug("Walking remote NFolder '{full_remote_path}'".format(full_remote_path=full_remote_path))
 
             # We assume someone's already checked we're a directory
             # Also, our own stats are set by our parent. If we don't manage to process,
             # we end up with no children basically.
-            remote_metadata = {}
-            try:
-                metadata_h = StringIO.StringIO()
-                with dropbox_client.get_file("{folder_path}/{metadata_filename}".format(folder_path=full_remote_path, metadata_filename=self.METADATA_FILENAME)) as f:
-                    metadata_h.write(f.read())
-                metadata_h.seek(0)
-                remote_metadata = json.load(metadata_h)
-                metadata_h.close()
-            except Exception as e:
-                logging.warning("Could not get remote metadata for '{full_remote_path}'".format(full_remote_path=full_remote_path))
-                logging.warning(e)
-                logging.warning(traceback.format_exc())
-
-            if remote_metadata:
-                for child in remote_metadata["children"]:
-                    try:
-                        child_node = None
-                        if child["_type"] == "NFile":
-                            child_node = NFile(self, child["name"], child["stats"])
-                        elif child["_type"] == "NFolder":
-                            child_node = NFolder(self, child["name"], child["stats"])
-                            if max_recurse_depth != 0 and not "symlink_target" in child:
-                                child_node.walk_remote_tree_r(dropbox_client, target, target_base, max_recurse_depth-1)
-                        else:
-                            raise UnknownNodeTypeException()
-
-                        if child_node:
-                            child_node.uploaded = True
-                            if "symlink_target" in child:
-                                child_node.symlink_target = child["symlink_target"]
-                            self.children.append(child_node)
-
-                    except Exception as e:
-                        name = child["name"] if "name" in child else "Unknown"
-                        logging.warning("Error walking child <{child}> in '{full_remote_path}'".format(child=name, full_remote_path=full_remote_path))
-                        logging.warning(e)
-                        logging.warning(traceback.format_exc())
+            remote_metadata = self.fetch_remote_metadata(dropbox_client, full_remote_path)
+            for child_node in self.load_remote_children(remote_metadata, full_remote_path):
+                if isinstance(child_node, NFolder) and max_recurse_depth != 0 and not child_node.symlink_target:
+                    child_node.walk_remote_tree_r(dropbox_client, target, target_base, max_recurse_depth-1)
+
+    def walk_remote_tree(self, dropbox_client, target, target_base="/", pool=None, max_recurse_depth=-1, root_metadata=None):
+        """Walks a remote dropbox tree breadth-first
+
+        Builds the same tree as walk_remote_tree_r, but each level's metadata
+        files are fetched together, in parallel if a WorkerPool is given.
+        Our own metadata isn't fetched again if it's given as root_metadata.
+        """
+        def fetch(folder_and_path):
+            folder, full_remote_path = folder_and_path
+            logging.debug("Walking remote NFolder '{full_remote_path}'".format(full_remote_path=full_remote_path))
+            return folder.fetch_remote_metadata(dropbox_client, full_remote_path)
+
+        level = [self] if not self.symlink_target else []
+        while level:
+            logging.debug("Node.walk_remote_tree: {} folders at recurse depth {}".format(len(level), max_recurse_depth))
+            paths = [(folder, folder.generate_remote_path(target, target_base)) for folder in level]
+            if root_metadata is not None:
+                remote_metadatas = [root_metadata]
+                root_metadata = None
+            elif pool is not None:
+                remote_metadatas = pool.map(fetch, paths)
+            else:
+                remote_metadatas = [fetch(p) for p in paths]
+
+            next_level = []
+            for (folder, full_remote_path), remote_metadata in zip(paths, remote_metadatas):
+                for child_node in folder.load_remote_children(remote_metadata, full_remote_path):
+                    if isinstance(child_node, NFolder) and max_recurse_depth != 0 and not child_node.symlink_target:
+                        next_level.append(child_node)
+            level = next_level
+            max_recurse_depth = max_recurse_depth - 1
+
+    def restore(self, local_base, dropbox_client, source, source_base="/", overwrite_mode=True, max_recurse_depth=-1, pool=None):
+        """Restore a Dropbox folder
+
+        Our stats are applied after our children are restored, as writing
+        them would otherwise change our mtime again. If a WorkerPool is given
+        the whole tree is restored in three passes instead: every folder is
+        created first, then files are downloaded in parallel, then folder
+        stats are applied from the bottom up.
+        """
+        if pool is not None:
+            files = []
+            folders = []
+            self._restore_skeleton(local_base, source, source_base, overwrite_mode, max_recurse_depth, files, folders)
+            wait_all([pool.submit(f.restore, local_base, dropbox_client, source, source_base, overwrite_mode) for f in files])
+            for folder, full_local_path in reversed(folders):
+                folder._restore_local_stats(full_local_path)
+            return
 
-    def restore(self, local_base, dropbox_client, source, source_base="/", overwrite_mode=True, max_recurse_depth=-1):
-        """Restore a Dropbox folder"""
         path = self.generate_path()
         full_local_path = os.path.join(local_base, path)
         source_path = "/".join([source_base, path])
@@ -457,25 +873,11 @@ class NFolder(NFile):
             if not os.path.exists(full_local_path) or overwrite_mode:
                 if not self.symlink_target:
                     # Opposite of upload - restore us first *then* walk the children
-                    try:
-                        os.mkdir(full_local_path)
-                    except OSError as e:
-                        # Check if it's an already exists error
-                        if e.args[0] != 17:
-                            raise
-                    
-                    if self.mode:
-                        os.chmod(full_local_path, self.mode)
-
-                    if self.uid and self.gid:
-                        os.chown(full_local_path, self.uid, self.gid)
-
-                    if self.mtime:
-                        # Set atime to mtime as well
-                        os.utime(full_local_path, (self.mtime, self.mtime))
+                    self._restore_directory(full_local_path)
                     if max_recurse_depth != 0:
                         for c in self.children:
                             c.restore(local_base, dropbox_client, source, source_base, overwrite_mode, max_recurse_depth-1)
+                    self.apply_local_stats(full_local_path)
                 else:
                     os.symlink(self.symlink_target, full_local_path)
                     # Symlink stats don't actually matter
@@ -487,8 +889,66 @@ class NFolder(NFile):
             logging.error(traceback.format_exc())
             logging.error("Skipping NFolder {remote_path}".format(remote_path=full_remote_path))
 
-    def upload(self, source_base, dropbox_client, target, target_base="/", overwrite_mode=True, max_recurse_depth=-1):
-        """Upload a local folder to Dropbox"""
+    def _restore_directory(self, full_local_path):
+        """Create a restored folder, if it isn't there already"""
+        try:
+            os.mkdir(full_local_path)
+        except OSError as e:
+            # Check if it's an already exists error
+            if e.args[0] != 17:
+                raise
+
+    def _restore_skeleton(self, local_base, source, source_base, overwrite_mode, max_recurse_depth, files, folders):
+        """Create our folder tree, collecting the files and folders still to restore"""
+        path = self.generate_path()
+        full_local_path = os.path.join(local_base, path)
+
+        try:
+            if not os.path.exists(full_local_path) or overwrite_mode:
+                if not self.symlink_target:
+                    self._restore_directory(full_local_path)
+                    folders.append((self, full_local_path))
+                    if max_recurse_depth != 0:
+                        for c in self.children:
+                            if isinstance(c, NFolder):
+                                c._restore_skeleton(local_base, source, source_base, overwrite_mode, max_recurse_depth-1, files, folders)
+                            else:
+                                files.append(c)
+                else:
+                    os.symlink(self.symlink_target, full_local_path)
+                    # Symlink stats don't actually matter
+            else:
+                logging.info("Path {} already exists, not overwriting it or its children".format(full_local_path))
+        except Exception as e:
+            source_path = "/".join([source_base, path])
+            logging.error("Could not restore NFolder {remote_path}' to '{local_path}'".format(local_path=path, remote_path="/{source}/data{path}".format(source=source, path=source_path)))
+            logging.error("{}".format(e))
+            logging.error(traceback.format_exc())
+            logging.error("Skipping NFolder {local_path}".format(local_path=path))
+
+    def _restore_local_stats(self, full_local_path):
+        """Apply our stats once everything beneath us has been restored"""
+        try:
+            self.apply_local_stats(full_local_path)
+        except Exception as e:
+            logging.error("Could not set stats on restored NFolder '{local_path}'".format(local_path=full_local_path))
+            logging.error("{}".format(e))
+
+    def upload(self, source_base, dropbox_client, target, target_base="/", overwrite_mode=True, max_recurse_depth=-1, pool=None, journal=None, chunk_size=None, packer=None, compressor=None, chunk_store=None, metadata_writes=None, remote_state=None, finished=None):
+        """Upload a local folder to Dropbox
+
+        If a WorkerPool is given, file children are uploaded on its workers.
+        Either way, our metadata is only written once every child is done,
+        and only if we're dirty.
+
+        With a WorkerPool, the folders beneath us don't wait for their files.
+        They queue up in finished, so the walk carries on handing out
+        uploads, and each one's metadata is written on the pool once its
+        files are done. We wait for all of it before writing our own.
+
+        Returns False if the metadata of this folder or any folder beneath it
+        could not be written.
+        """
         path = self.generate_path()
         full_local_path = os.path.join(source_base, path)
         target_path = "/".join([target_base, path])
@@ -503,14 +963,7 @@ class NFolder(NFile):
             if self.symlink_target:
                 full_remote_path = "{name}.symlink".format(name=full_remote_path)
 
-            meta = {}
-            try:
-                meta = dropbox_client.metadata(full_remote_path)
-            except (dropbox.rest.ErrorResponse) as e:
-                if e.status != 404:
-                    raise e
-
-            if not self.symlink_target and "is_dir" in meta and meta["is_dir"] is not True:
+            if not self.symlink_target and self.remote_kind(dropbox_client, full_remote_path, remote_state) == REMOTE_FILE:
                 # We care if the remote path is a dir and we're a folder, unless we're a symlink
                 logging.warning("File exists at remote location; attempting removal...")
                 dropbox_client.file_delete(full_remote_path)
@@ -540,27 +993,73 @@ class NFolder(NFile):
                         # Ignore already created folder
                         if e.status != 403:
                             raise
+                    else:
+                        if remote_state is not None:
+                            remote_state.folder_created(path)
                     self.uploaded = True
                 else:
                     logging.debug("{} Already uploaded".format(full_remote_path))
 
+                complete = True
+                # The folder we were called on waits for everyone's metadata writes
+                own_writes = pool is not None and metadata_writes is None
+                if own_writes:
+                    metadata_writes = []
+                    # Folders beneath us waiting on their files, oldest first
+                    finished = collections.deque()
+                tasks = []
                 if max_recurse_depth != 0:
                     for c in self.children:
                         # max_recurse_depth of -1 gives us an infinite recurse depth
-                        c.upload(source_base, dropbox_client, target, target_base, overwrite_mode=overwrite_mode, max_recurse_depth=max_recurse_depth-1)
-
-                # Right now generate the final metadata structure for this folder
-                metadata_h = StringIO.StringIO()
-                json.dump(self.encodable(max_recurse_depth=1, only_uploaded=True), metadata_h)
-                dropbox_client.put_file("{folder_path}/{metadata_filename}".format(folder_path=full_remote_path, metadata_filename=self.METADATA_FILENAME), file_obj=metadata_h, overwrite=True)
-                metadata_h.close()
-
+                        if pool is not None and not isinstance(c, NFolder):
+                            tasks.append(pool.submit(c.upload, source_base, dropbox_client, target, target_base, overwrite_mode=overwrite_mode, max_recurse_depth=max_recurse_depth-1, journal=journal, chunk_size=chunk_size, packer=packer, compressor=compressor, chunk_store=chunk_store, remote_state=remote_state))
+                        else:
+                            # Folders are walked here so their files keep feeding the pool
+                            if c.upload(source_base, dropbox_client, target, target_base, overwrite_mode=overwrite_mode, max_recurse_depth=max_recurse_depth-1, pool=pool, journal=journal, chunk_size=chunk_size, packer=packer, compressor=compressor, chunk_store=chunk_store, metadata_writes=metadata_writes, remote_state=remote_state, finished=finished) is False:
+                                complete = False
+
+                if pool is not None and not own_writes:
+                    finished.append((tasks, functools.partial(self._finish_upload, dropbox_client, full_remote_path, packer, pool, metadata_writes)))
+                    _write_finished(finished, False)
+                    return complete
+                wait_all(tasks)
+                if own_writes:
+                    _write_finished(finished, True)
+                    wait_all(metadata_writes)
+                    if any(t.exception for t in metadata_writes):
+                        complete = False
+
+                self._finish_upload(dropbox_client, full_remote_path, packer)
+                return complete
 
         except Exception as e:
             logging.error("Could not back up NFolder '{local_path}' to '{remote_path}'".format(local_path=path, remote_path=full_remote_path))
             logging.error("{}".format(e))
             logging.error(traceback.format_exc())
             logging.error("Skipping NFolder {local_path}".format(local_path=path))
+            return False
+        return True
+
+    def _finish_upload(self, dropbox_client, full_remote_path, packer=None, pool=None, metadata_writes=None):
+        """Write our metadata, once every child is done, if anything in us changed"""
+        if not self.dirty:
+            logging.debug("Nothing in '{}' changed, so not rewriting its metadata".format(full_remote_path))
+        elif packer is not None:
+            # Packed children only count as uploaded once their pack is
+            packer.when_packed(self, lambda: self.write_metadata(dropbox_client, full_remote_path))
+        elif metadata_writes is not None:
+            metadata_writes.append(pool.submit(self.write_metadata, dropbox_client, full_remote_path))
+        else:
+            self.write_metadata(dropbox_client, full_remote_path)
+
+    def write_metadata(self, dropbox_client, full_remote_path):
+        """Upload the metadata file describing this folder's uploaded children; returns its new metadata"""
+        # Right now generate the final metadata structure for this folder
+        metadata_h = StringIO.StringIO()
+        json.dump(self.encodable(max_recurse_depth=1, only_uploaded=True), metadata_h)
+        response = dropbox_client.put_file("{folder_path}/{metadata_filename}".format(folder_path=full_remote_path, metadata_filename=self.METADATA_FILENAME), file_obj=metadata_h, overwrite=True)
+        metadata_h.close()
+        return response
 
     def __repr__(self):
         return "<NFolder (name={}, uploaded={}, parent_name={}, len(children)={})>".format(self.name, self.uploaded, self.parent.name, len(self.children))
@@ -568,16 +1067,128 @@ class NFolder(NFile):
 
 class NRootFolder(NFolder):
     """Represents the folder at the top of the backup"""
-    
+    __slots__ = ("generation",)
+
     def __init__(self):
-        self.children = []
-        self.name=""
-        self.parent=None
+        super(NRootFolder, self).__init__(None, "", dict.fromkeys(STAT_FIELDS))
+        # Stamped into the root metadata on each backup, so a local copy of the
+        # remote tree can tell whether it is still current
+        self.generation = None
+
+    def encodable(self, max_recurse_depth=-1, only_uploaded=False):
+        """Returns an encodable representation of NRootFolder"""
+        d = super(NRootFolder, self).encodable(max_recurse_depth, only_uploaded)
+        if self.generation:
+            d["generation"] = self.generation
+        return d
 
     def __repr__(self):
         return "<NRootFolder (len(children)={})>".format(len(self.children))
 
 
+# The order of stats in NFile.compact()
+STAT_FIELDS = ('uid', 'gid', 'mode', 'mtime', 'ctime', 'size', 'ino')
+
+
+def stats_from_stat_result(stats):
+    """Converts an os.stat() result into node stats"""
+    return {
+        'uid': stats.st_uid,
+        'gid': stats.st_gid,
+        'mode': stats.st_mode,
+        'mtime': stats.st_mtime,
+        'ctime': stats.st_ctime,
+        'size': stats.st_size,
+        'ino': stats.st_ino
+    }
+
+
+def list_local_dir(path):
+    """Returns (name, path, lstat result) for each entry in a local directory
+
+    Uses scandir where available, so we pay for exactly one lstat per entry
+    """
+    if scandir is not None:
+        entries = [(entry.name, entry.path, entry.stat) for entry in scandir(path)]
+    else:
+        entries = [(name, os.path.join(path, name), None) for name in os.listdir(path)]
+
+    listing = []
+    for name, entry_path, entry_stat in entries:
+        try:
+            lstats = entry_stat(follow_symlinks=False) if entry_stat else os.lstat(entry_path)
+        except OSError as e:
+            # Most likely removed since we listed the directory
+            logging.warning("Could not stat '{local_path}'".format(local_path=entry_path))
+            logging.warning(e)
+            continue
+        listing.append((name, entry_path, lstats))
+    return listing
+
+
+def _write_finished(finished, block):
+    """Write the metadata of queued folders whose files are done, in the order they were queued
+
+    With block, wait for every folder's files and write them all.
+    """
+    while finished and (block or all(t.done() for t in finished[0][0])):
+        tasks, finish = finished.popleft()
+        wait_all(tasks)
+        finish()
+
+
+def unicode_name(name):
+    """A name as unicode, so local (bytes) and remote (unicode) names compare"""
+    # @TODO support UTF-8 correctly
+    return name.decode('utf-8') if isinstance(name, str) else name
+
+
+def intern_name(name):
+    """Returns the single shared copy of a node name, as UTF-8 if it was unicode"""
+    # intern() only takes str, and interned strings are freed once no node uses them
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return intern(name) if type(name) is str else name
+
+
+def node_from_encodable(parent, child):
+    """Create an uploaded node from its encodable() representation"""
+    if child["_type"] == "NFile":
+        child_node = NFile(parent, child["name"], child["stats"])
+    elif child["_type"] == "NFolder":
+        child_node = NFolder(parent, child["name"], child["stats"])
+    else:
+        raise UnknownNodeTypeException()
+
+    child_node.uploaded = True
+    if "symlink_target" in child:
+        child_node.symlink_target = child["symlink_target"]
+    child_node.pack = child.get("pack")
+    child_node.compression = child.get("compression")
+    child_node.chunks = child.get("chunks")
+    return child_node
+
+
+def node_from_compact(parent, compact):
+    """Create a node tree from NFile.compact()"""
+    _type, name, stats, symlink_target, children = compact
+    node_class = NFolder if _type == "NFolder" else NFile
+    node = node_class(parent, name, dict(zip(STAT_FIELDS, stats)))
+    node.symlink_target = symlink_target
+    if children:
+        node.children = [node_from_compact(node, c) for c in children]
+    return node
+
+
+def _walk_local_shard(job):
+    """Worker for walk_local_tree_sharded; walks one folder in another process"""
+    i, full_local_path, include_hidden = job
+    folder = NRootFolder()
+    folder._walk_local_dir(full_local_path, -1, include_hidden)
+    # marshal is much quicker than pickle for plain nested tuples
+    return i, marshal.dumps(tuple(c.compact() for c in folder.children))
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
     import pprint
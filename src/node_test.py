@@ -11,7 +11,178 @@
 """
 
 import unittest
+import collections
+import dropbox
+import os
+import copy
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+import StringIO
 import node
+import backup
+from workers import WorkerPool
+from journal import UploadJournal
+from packing import Packer
+from compression import Compressor
+from chunkstore import ChunkStore, SHARED_STORE, target_store
+
+
+class _FilesClient(object):
+    """Serves file contents from a dict keyed by remote path"""
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+        # Drop the connection after sending this many bytes of a file
+        self.break_after = None
+
+    def get_file(self, path, start=None, length=None):
+        # Dropbox treats repeated slashes as one
+        path = re.sub("/+", "/", path)
+        self.requests.append((path, start))
+        data = self.files[path]
+        if start is not None:
+            data = data[start:start + length] if length else data[start:]
+        if self.break_after is not None:
+            return _Closing(_Breaking(data, self.break_after))
+        return _Closing(StringIO.StringIO(data))
+
+
+class _Breaking(object):
+    """Reads like a file until `cut` bytes in, then fails"""
+
+    def __init__(self, data, cut):
+        self.data = data
+        self.cut = cut
+        self.position = 0
+
+    def read(self, size):
+        if self.position >= self.cut:
+            raise IOError("Connection reset by peer")
+        block = self.data[self.position:min(self.position + size, self.cut)]
+        self.position = self.position + len(block)
+        return block
+
+    def close(self):
+        pass
+
+
+class _MetadataClient(_FilesClient):
+    """Serves folder metadata files from a dict keyed by remote path"""
+
+    def __init__(self, files):
+        super(_MetadataClient, self).__init__({path: json.dumps(meta) for path, meta in files.items()})
+
+
+class _Closing(object):
+    def __init__(self, f):
+        self.f = f
+        self.status = 206
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+class _ChunkClient(object):
+    """Accepts chunked uploads, optionally failing after a number of chunks"""
+
+    def __init__(self):
+        self.chunks = []
+        self.committed = {}
+        self.fail_after = None
+
+    def get_chunked_uploader(self, file_h, length):
+        return _Uploader(self)
+
+    def upload_chunk(self, block, length, offset, upload_id):
+        if self.fail_after is not None and len(self.chunks) >= self.fail_after:
+            raise IOError("Network went away")
+        self.chunks.append((offset, block))
+        return offset + len(block), upload_id or "upload1"
+
+
+class _Uploader(object):
+    def __init__(self, client):
+        self.client = client
+        self.offset = 0
+        self.upload_id = None
+
+    def finish(self, path, overwrite=False):
+        self.client.committed[path] = "".join(block for offset, block in sorted(self.client.chunks))
+
+
+class _StoreClient(_FilesClient):
+    """Keeps whatever is uploaded, in order, and serves it back"""
+
+    def __init__(self):
+        super(_StoreClient, self).__init__({})
+        self.puts = []
+
+    def metadata(self, path, list=True, file_limit=None):
+        contents = [{"path": p} for p in self.files if p.rsplit("/", 1)[0] == path]
+        return {"is_dir": True, "contents": contents}
+
+    def file_create_folder(self, path):
+        pass
+
+    def put_file(self, path, file_obj, overwrite=False):
+        path = re.sub("/+", "/", path)
+        self.puts.append(path)
+        if isinstance(file_obj, str):
+            self.files[path] = file_obj
+        else:
+            self.files[path] = file_obj.getvalue() if hasattr(file_obj, "getvalue") else file_obj.read()
+
+
+class _ErrorResponse(object):
+    """Just enough of an HTTP response for dropbox.rest.ErrorResponse"""
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = str(status)
+
+    def getheaders(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class _ListingClient(_StoreClient):
+    """Counts requests, and refuses to list folders that are missing or too big like Dropbox does"""
+
+    def __init__(self):
+        super(_ListingClient, self).__init__()
+        self.calls = collections.Counter()
+
+    def metadata(self, path, list=True, file_limit=None):
+        self.calls["metadata"] += 1
+        if not list:
+            if path in self.files:
+                return {"path": path}
+            raise dropbox.rest.ErrorResponse(_ErrorResponse(404), "{}")
+        listing = super(_ListingClient, self).metadata(path)
+        if not listing["contents"]:
+            raise dropbox.rest.ErrorResponse(_ErrorResponse(404), "{}")
+        if file_limit is not None and len(listing["contents"]) > file_limit:
+            raise dropbox.rest.ErrorResponse(_ErrorResponse(406), "{}")
+        return listing
+
+    def put_file(self, path, file_obj, overwrite=False):
+        self.calls["put_file"] += 1
+        super(_ListingClient, self).put_file(path, file_obj, overwrite)
+
+
+def _meta(name, children, _type="NFolder"):
+    stats = {"uid": 0, "gid": 0, "mode": 0o644, "mtime": 1, "ctime": 1, "size": 1}
+    return {"_type": _type, "name": name, "uploaded": True, "stats": stats, "children": children}
 
 
 class TestNFile(unittest.TestCase):
@@ -21,6 +192,91 @@ class TestNFile(unittest.TestCase):
         """Dummy test to check Test is run"""
         return True
 
+    def _restore(self, data, partial=None):
+        """Restore `data`, after a restore of `partial` (its data, mtime, and bytes sent before failing)"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        root = node.NRootFolder()
+        self.addCleanup(setattr, node.NFile, "RESTORE_CHUNK_SIZE", node.NFile.RESTORE_CHUNK_SIZE)
+        node.NFile.RESTORE_CHUNK_SIZE = 3
+        local_path = os.path.join(base, "f")
+        if partial is not None:
+            partial_data, partial_mtime, cut = partial
+            f = node.NFile(root, "f", {"uid": None, "gid": None, "mode": 0o600, "mtime": partial_mtime, "ctime": 5, "size": len(partial_data)})
+            client = _FilesClient({"/t/data/x/f": partial_data})
+            client.break_after = cut
+            f.restore(base, client, "t", "/x")
+            self.assertEqual(os.path.getsize(local_path + f.PARTIAL_SUFFIX), cut)
+        f = node.NFile(root, "f", {"uid": None, "gid": None, "mode": 0o600, "mtime": 5, "ctime": 5, "size": len(data)})
+        client = _FilesClient({"/t/data/x/f": data})
+        f.restore(base, client, "t", "/x")
+        with open(local_path) as restored:
+            return restored.read(), client.requests, os.listdir(base), os.stat(local_path)
+
+    def test_chunked_upload_resumes_from_journal(self):
+        """A chunked upload interrupted part way carries on from the journal"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        local_path = os.path.join(base, "big")
+        with open(local_path, "w") as big:
+            big.write("0123456789")
+        f = node.NFile(node.NRootFolder(), "big", node.stats_from_stat_result(os.stat(local_path)))
+        journal = UploadJournal(os.path.join(base, "journal"))
+        client = _ChunkClient()
+        client.fail_after = 2
+
+        with open(local_path, "rb") as file_h:
+            self.assertRaises(IOError, f.upload_chunked, client, file_h, "/t/data/big", journal=journal, chunk_size=3)
+        self.assertEqual(UploadJournal(journal.path).uploads["/t/data/big"]["offset"], 6)
+
+        client.fail_after = None
+        with open(local_path, "rb") as file_h:
+            f.upload_chunked(client, file_h, "/t/data/big", journal=UploadJournal(journal.path), chunk_size=3)
+        self.assertEqual([offset for offset, block in client.chunks], [0, 3, 6, 9])
+        self.assertEqual(client.committed["/t/data/big"], "0123456789")
+        self.assertEqual(UploadJournal(journal.path).uploads, {})
+
+    def test_restore_streams_into_place(self):
+        """Restored files are written via a partial file and get their stats"""
+        content, requests, listing, stats = self._restore("0123456789")
+        self.assertEqual(content, "0123456789")
+        self.assertEqual(requests, [("/t/data/x/f", None)])
+        self.assertEqual(listing, ["f"])
+        self.assertEqual(stats.st_mtime, 5)
+
+    def test_restore_resumes_partial_file(self):
+        """An interrupted restore continues where it stopped"""
+        content, requests, listing, stats = self._restore("0123456789", partial=("0123456789", 5, 4))
+        self.assertEqual(content, "0123456789")
+        self.assertEqual(requests, [("/t/data/x/f", 4)])
+        self.assertEqual(listing, ["f"])
+
+    def test_restore_discards_partial_file_of_another_version(self):
+        """A partial file of a version of the file that's since changed is downloaded again"""
+        content, requests, listing, stats = self._restore("abcdefghij", partial=("0123456789", 4, 4))
+        self.assertEqual(content, "abcdefghij")
+        self.assertEqual(requests, [("/t/data/x/f", None)])
+        self.assertEqual(listing, ["f"])
+
+    def test_restore_discards_unknown_partial_file(self):
+        """A partial file we can't say the source of is downloaded again"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        f = node.NFile(node.NRootFolder(), "f", {"uid": None, "gid": None, "mode": 0o600, "mtime": 5, "ctime": 5, "size": 10})
+        with open(os.path.join(base, "f" + f.PARTIAL_SUFFIX), "w") as partial_h:
+            partial_h.write("abcd")
+        client = _FilesClient({"/t/data/x/f": "0123456789"})
+        f.restore(base, client, "t", "/x")
+        with open(os.path.join(base, "f")) as restored:
+            self.assertEqual(restored.read(), "0123456789")
+        self.assertEqual(client.requests, [("/t/data/x/f", None)])
+
+    def test_restore_discards_oversized_partial_file(self):
+        """A partial file longer than the backup can't be resumed"""
+        content, requests, listing, stats = self._restore("0123", partial=("0123456789", 5, 6))
+        self.assertEqual(content, "0123")
+        self.assertEqual(requests, [("/t/data/x/f", None)])
+
 class TestNFolder(unittest.TestCase):
     """Test NFolder class"""
 
@@ -28,5 +284,524 @@ class TestNFolder(unittest.TestCase):
         """Dummy test to check Test is run"""
         return True
 
+    def test_nodes_are_slotted(self):
+        """Nodes have no __dict__, so a misspelt attribute is an error rather than a new field"""
+        stats = {"uid": None, "gid": None, "mode": None, "mtime": 1, "ctime": 1, "size": 1}
+        root = node.NRootFolder()
+        for n in [root, node.NFolder(root, "d", stats), node.NFile(root, "f", stats)]:
+            self.assertFalse(hasattr(n, "__dict__"))
+            with self.assertRaises(AttributeError):
+                n.uplaoded = True
+
+    def test_names_are_shared(self):
+        """Equal names, local or remote, are one object however many nodes have them"""
+        stats = {"uid": None, "gid": None, "mode": None, "mtime": 1, "ctime": 1, "size": 1}
+        root = node.NRootFolder()
+        # Built at runtime, so they aren't already the same object
+        local = [node.NFile(root, "".join(["na", "me"]), stats) for i in range(2)]
+        remote = [node.NFile(root, u"".join([u"n\xe4", u"me"]), stats) for i in range(2)]
+        self.assertIs(local[0].name, local[1].name)
+        self.assertIs(remote[0].name, remote[1].name)
+        self.assertEqual(remote[0].name, u"n\xe4me".encode("utf-8"))
+
+    def test_paths_are_remembered(self):
+        """A folder's path is worked out once, and copies of it, as diffs make, keep it"""
+        stats = {"uid": None, "gid": None, "mode": None, "mtime": 1, "ctime": 1, "size": 1}
+        root = node.NRootFolder()
+        a = node.NFolder(root, "a", stats)
+        b = node.NFolder(a, "b", stats)
+        f = node.NFile(b, "f", stats)
+        self.assertEqual(root.generate_path(), "")
+        self.assertEqual(f.generate_path(), os.path.join("a", "b", "f"))
+        self.assertEqual(f.generate_remote_path("t", "/x"), "/t/data/x/a/b/f")
+        self.assertIs(b.generate_path(), b.generate_path())
+
+        copied = copy.copy(b)
+        copied.children = [f]
+        self.assertEqual(copied.generate_path(), os.path.join("a", "b"))
+        self.assertEqual(b.children, [])
+
+    def _restore_tree(self, pool):
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        stats = lambda mtime, size: {"uid": None, "gid": None, "mode": None, "mtime": mtime, "ctime": mtime, "size": size}
+        root = node.NRootFolder()
+        folder = node.NFolder(root, "d", stats(7, 0))
+        sub = node.NFolder(folder, "e", stats(8, 0))
+        folder.children = [sub] + [node.NFile(folder, "f{}".format(i), stats(9, 1)) for i in range(5)]
+        sub.children = [node.NFile(sub, "g", stats(9, 1))]
+        root.children = [folder]
+        files = {"/t/data/x/d/f{}".format(i): str(i) for i in range(5)}
+        files["/t/data/x/d/e/g"] = "g"
+        root.restore(base, _FilesClient(files), "t", "/x", pool=pool)
+        return base
+
+    def test_restore_sets_folder_mtime_after_children(self):
+        """Restoring children doesn't disturb a folder's restored mtime"""
+        base = self._restore_tree(None)
+        self.assertEqual(os.stat(os.path.join(base, "d")).st_mtime, 7)
+        self.assertEqual(os.stat(os.path.join(base, "d", "e")).st_mtime, 8)
+
+    def test_restore_concurrently(self):
+        """A parallel restore writes every file, then the folder stats"""
+        with WorkerPool(3) as pool:
+            base = self._restore_tree(pool)
+        self.assertEqual(sorted(os.listdir(os.path.join(base, "d"))), ["e", "f0", "f1", "f2", "f3", "f4"])
+        with open(os.path.join(base, "d", "e", "g")) as g:
+            self.assertEqual(g.read(), "g")
+        self.assertEqual(os.stat(os.path.join(base, "d")).st_mtime, 7)
+        self.assertEqual(os.stat(os.path.join(base, "d", "e")).st_mtime, 8)
+
+    def test_upload_concurrently(self):
+        """A parallel upload carries on into the next folder while files upload, and writes each folder's metadata after its files"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        for name in ["a1", "a2", "b1"]:
+            os.makedirs(os.path.join(base, name[0], name))
+            with open(os.path.join(base, name[0], name, "f"), "w") as f:
+                f.write(name)
+        client = _StoreClient()
+        events = []
+        files_started = []
+        lock = threading.Lock()
+        another_started = threading.Event()
+        put_file = client.put_file
+        def ordered_put(path, file_obj, overwrite=False):
+            path = re.sub("/+", "/", path)
+            events.append(("start", path))
+            if not path.endswith(".dropboxbackupmeta"):
+                with lock:
+                    files_started.append(path)
+                    first = len(files_started) == 1
+                if first:
+                    # Only gets the event if the walk went on to another folder without waiting for us
+                    events.append(("overlapped", another_started.wait(5)))
+                else:
+                    another_started.set()
+            put_file(path, file_obj, overwrite)
+            events.append(("end", path))
+        client.put_file = ordered_put
+
+        local = node.NRootFolder()
+        local.walk_local_tree_r(base)
+        with WorkerPool(3) as pool:
+            self.assertTrue(local.upload(base, client, "t", "/", pool=pool))
+
+        self.assertIn(("overlapped", True), events)
+        def written(path):
+            return events.index(("start", re.sub("/+", "/", "/t/data/{}/.dropboxbackupmeta".format(path))))
+        for name in ["a1", "a2", "b1"]:
+            self.assertGreater(written("{}/{}".format(name[0], name)), events.index(("end", "/t/data/{}/{}/f".format(name[0], name))))
+        # The folder we started from goes last
+        self.assertEqual(written(""), len(events) - 2)
+
+    def _local_tree(self):
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        os.makedirs(os.path.join(base, "dir", "sub"))
+        os.makedirs(os.path.join(base, ".hidden_dir"))
+        for name in ["file", ".hidden", os.path.join("dir", "sub", "deep"), os.path.join(".hidden_dir", "inner")]:
+            with open(os.path.join(base, name), "w") as f:
+                f.write(name)
+        os.symlink("dir", os.path.join(base, "dir_link"))
+        os.symlink("file", os.path.join(base, "file_link"))
+        os.symlink("missing", os.path.join(base, "dangling"))
+        return base
+
+    def test_walk_local_tree(self):
+        """Local walk records files, folders and symlinks without following them"""
+        base = self._local_tree()
+        root = node.NRootFolder()
+        root.walk_local_tree_r(base)
+        children = {c.name: c for c in root.children}
+        self.assertEqual(sorted(children), ["dangling", "dir", "dir_link", "file", "file_link"])
+        self.assertIsInstance(children["dir"], node.NFolder)
+        self.assertEqual([c.name for c in children["dir"].children[0].children], ["deep"])
+        self.assertEqual(children["file"].size, 4)
+        # Symlinks keep the type and stats of what they point at
+        self.assertIsInstance(children["dir_link"], node.NFolder)
+        self.assertEqual(children["dir_link"].symlink_target, "dir")
+        self.assertEqual(children["dir_link"].children, [])
+        self.assertNotIsInstance(children["file_link"], node.NFolder)
+        self.assertEqual(children["file_link"].size, 4)
+        self.assertEqual(children["dangling"].symlink_target, "missing")
+
+    def test_walk_local_tree_hidden(self):
+        """Hidden files are only walked when asked for"""
+        base = self._local_tree()
+        root = node.NRootFolder()
+        root.walk_local_tree_r(base, include_hidden=True)
+        children = {c.name: c for c in root.children}
+        self.assertIn(".hidden", children)
+        self.assertEqual([c.name for c in children[".hidden_dir"].children], ["inner"])
+
+    def test_walk_local_tree_sharded(self):
+        """Sharded local walk builds the same tree as the single process walk"""
+        base = self._local_tree()
+        for i in range(6):
+            os.makedirs(os.path.join(base, "dir", "sub", "more{}".format(i), "deeper"))
+            with open(os.path.join(base, "dir", "sub", "more{}".format(i), "deeper", "f"), "w") as f:
+                f.write("f")
+        walked = node.NRootFolder()
+        walked.walk_local_tree_r(base, include_hidden=True)
+        sharded = node.NRootFolder()
+        sharded.walk_local_tree_sharded(base, 2, include_hidden=True)
+        by_name = lambda e: sorted(e.get("children", []), key=lambda c: c["name"])
+        def normalise(e):
+            e["children"] = [normalise(c) for c in by_name(e)]
+            return e
+        self.assertEqual(normalise(walked.encodable()), normalise(sharded.encodable()))
+
+    def test_packed_upload_and_restore(self):
+        """Small files go up in a single pack, before the metadata describing them"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        os.makedirs(os.path.join(base, "dir", "sub"))
+        for name in ["top", os.path.join("dir", "sub", "nested")]:
+            with open(os.path.join(base, name), "w") as f:
+                f.write(os.path.basename(name))
+        local = node.NRootFolder()
+        local.walk_local_tree_r(base)
+        client = _StoreClient()
+        packer = Packer(client, "t", 1024)
+        local.upload(base, client, "t", "/", packer=packer)
+        self.assertTrue(packer.close())
+
+        packs = [p for p in client.puts if p.endswith(".pack")]
+        self.assertEqual(len(packs), 1)
+        self.assertLess(client.puts.index(packs[0]), client.puts.index("/t/data/dir/sub/.dropboxbackupmeta"))
+        self.assertEqual(client.puts[-1], "/t/data/.dropboxbackupmeta")
+        root_meta = json.loads(client.files["/t/data/.dropboxbackupmeta"])
+        self.assertEqual([c["pack"]["id"] for c in root_meta["children"] if c["name"] == "top"], [packs[0][-37:-5]])
+
+        remote = node.NRootFolder()
+        remote.walk_remote_tree_r(client, "t", "/")
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        remote.restore(restore_base, client, "t", "/")
+        with open(os.path.join(restore_base, "dir", "sub", "nested")) as f:
+            self.assertEqual(f.read(), "nested")
+
+    def test_compressed_upload_and_restore(self):
+        """Compressible files are stored compressed, and restored to their original content"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        contents = {"dump.sql": "INSERT INTO t VALUES (1);\n" * 4000, "photo.jpg": "x" * 100000, "small.txt": "tiny"}
+        for name, data in contents.items():
+            with open(os.path.join(base, name), "w") as f:
+                f.write(data)
+        local = node.NRootFolder()
+        local.walk_local_tree_r(base)
+        client = _StoreClient()
+        local.upload(base, client, "t", "/", compressor=Compressor(min_size=1024))
+
+        self.assertLess(len(client.files["/t/data/dump.sql"]), len(contents["dump.sql"]) / 10)
+        self.assertEqual(client.files["/t/data/photo.jpg"], contents["photo.jpg"])
+        root_meta = json.loads(client.files["/t/data/.dropboxbackupmeta"])
+        compression = {c["name"]: c.get("compression") for c in root_meta["children"]}
+        self.assertEqual(compression["dump.sql"], {"method": "zlib", "length": len(client.files["/t/data/dump.sql"])})
+        self.assertEqual(compression["photo.jpg"], None)
+        self.assertEqual(compression["small.txt"], None)
+
+        remote = node.NRootFolder()
+        remote.walk_remote_tree_r(client, "t", "/")
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        remote.restore(restore_base, client, "t", "/")
+        self.assertEqual(sorted(os.listdir(restore_base)), sorted(contents))
+        for name, data in contents.items():
+            with open(os.path.join(restore_base, name)) as f:
+                self.assertEqual(f.read(), data)
+
+    def test_compression_falls_back_to_uploading_as_is(self):
+        """A file that doesn't compress goes up as it is, and one that stops compressing loses its record"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        path = os.path.join(base, "data.bin")
+        rng = random.Random(1)
+        noise = "".join(chr(rng.getrandbits(8)) for i in range(4096))
+        client = _StoreClient()
+
+        def backup_with(content, mtime):
+            with open(path, "w") as f:
+                f.write(content)
+            os.utime(path, (mtime, mtime))
+            local = node.NRootFolder()
+            local.walk_local_tree_r(base)
+            remote = node.NRootFolder()
+            if client.files:
+                remote.walk_remote_tree_r(client, "t", "/")
+            del client.puts[:]
+            backup.diff_trees(local, remote).upload(base, client, "t", "/", compressor=Compressor(min_size=1024))
+            return json.loads(client.files["/t/data/.dropboxbackupmeta"])["children"][0].get("compression")
+
+        self.assertIsNotNone(backup_with("a" * 4096, 1))
+        self.assertIsNone(backup_with(noise, 2))
+        self.assertEqual(client.files["/t/data/data.bin"], noise)
+        # Nothing changed, so nothing is compressed or sent again
+        self.assertIsNone(backup_with(noise, 2))
+        self.assertNotIn("/t/data/data.bin", client.puts)
+
+        remote = node.NRootFolder()
+        remote.walk_remote_tree_r(client, "t", "/")
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        remote.restore(restore_base, client, "t", "/")
+        with open(os.path.join(restore_base, "data.bin")) as f:
+            self.assertEqual(f.read(), noise)
+
+    def test_unknown_compression_is_not_restored(self):
+        """A file compressed some way we don't know isn't restored as garbage"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        f = node.NFile(node.NRootFolder(), "f", {"uid": None, "gid": None, "mode": 0o600, "mtime": 5, "ctime": 5, "size": 10})
+        f.compression = {"method": "lzma", "length": 4}
+        f.restore(base, _FilesClient({"/t/data/x/f": "abcd"}), "t", "/x")
+        self.assertFalse(os.path.exists(os.path.join(base, "f")))
+
+    def test_block_upload_sends_only_changed_blocks(self):
+        """A large file changed in place only uploads its changed blocks, and restores whole"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        local_path = os.path.join(base, "disk.img")
+        with open(local_path, "w") as f:
+            f.write("".join(chr(ord("a") + i) * 10 for i in range(10)))
+        client = _StoreClient()
+
+        def backup():
+            local = node.NRootFolder()
+            local.walk_local_tree_r(base)
+            remote = node.NRootFolder()
+            if client.files:
+                remote.walk_remote_tree_r(client, "t", "/")
+            chunk_store = ChunkStore(client, target_store("t"), 50, block_size=10)
+            chunk_store.seed(remote, "t")
+            del client.puts[:]
+            local.upload(base, client, "t", "/", chunk_store=chunk_store)
+            return [p for p in client.puts if p.startswith("/t/blocks/")]
+
+        self.assertEqual(len(backup()), 10)
+        with open(local_path, "r+") as f:
+            f.seek(35)
+            f.write("CHANGED")
+        self.assertEqual(len(backup()), 2)
+        self.assertNotIn("/t/data/disk.img", client.files)
+
+        remote = node.NRootFolder()
+        remote.walk_remote_tree_r(client, "t", "/")
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        remote.restore(restore_base, client, "t", "/")
+        with open(local_path) as original:
+            with open(os.path.join(restore_base, "disk.img")) as restored:
+                self.assertEqual(restored.read(), original.read())
+
+    def _block_backup(self, base, client):
+        local = node.NRootFolder()
+        local.walk_local_tree_r(base)
+        remote = node.NRootFolder()
+        if client.files:
+            remote.walk_remote_tree_r(client, "t", "/")
+        chunk_store = ChunkStore(client, target_store("t"), 50, block_size=10)
+        chunk_store.seed(remote, "t")
+        del client.puts[:]
+        backup.diff_trees(local, remote).upload(base, client, "t", "/", chunk_store=chunk_store)
+        return json.loads(client.files["/t/data/.dropboxbackupmeta"])["children"][0].get("chunks")
+
+    def test_block_store_edge_cases(self):
+        """Unchanged files send nothing, and a file that shrinks below the threshold goes up whole"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        local_path = os.path.join(base, "disk.img")
+        with open(local_path, "w") as f:
+            f.write("0123456789" * 6)
+        client = _StoreClient()
+
+        self.assertEqual(len(self._block_backup(base, client)["hashes"]), 6)
+        self.assertIsNotNone(self._block_backup(base, client))
+        self.assertEqual([p for p in client.puts if p.startswith("/t/blocks/")], [])
+
+        with open(local_path, "w") as f:
+            f.write("small")
+        self.assertIsNone(self._block_backup(base, client))
+        self.assertEqual(client.files["/t/data/disk.img"], "small")
+
+    def test_block_restore_checks_and_resumes(self):
+        """A corrupt block fails the restore, and a restore cut short carries on from the last whole block"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        content = "".join(chr(ord("a") + i) * 10 for i in range(6))
+        with open(os.path.join(base, "disk.img"), "w") as f:
+            f.write(content)
+        client = _StoreClient()
+        chunks = self._block_backup(base, client)
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        restored_path = os.path.join(restore_base, "disk.img")
+
+        def restore():
+            remote = node.NRootFolder()
+            remote.walk_remote_tree_r(client, "t", "/")
+            del client.requests[:]
+            remote.restore(restore_base, client, "t", "/")
+            return [path.rsplit("/", 1)[-1] for path, start in client.requests if path.startswith("/t/blocks/")]
+
+        third = "/t/blocks/{}/{}".format(chunks["hashes"][2][:2], chunks["hashes"][2])
+        good = client.files[third]
+        client.files[third] = "corrupt!!!"
+        self.assertEqual(restore(), chunks["hashes"][:3])
+        self.assertFalse(os.path.exists(restored_path))
+
+        client.files[third] = good
+        self.assertEqual(restore(), chunks["hashes"][2:])
+        with open(restored_path) as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(restore_base), ["disk.img"])
+
+    def test_shared_store_deduplicates_across_targets(self):
+        """A second target backing up the same data uploads no blocks, and restores from the shared store"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        with open(os.path.join(base, "same"), "w") as f:
+            f.write("shared data " * 10)
+        client = _StoreClient()
+
+        sent = {}
+        for target in ["host1", "host2"]:
+            local = node.NRootFolder()
+            local.walk_local_tree_r(base)
+            chunk_store = ChunkStore(client, SHARED_STORE, 0, block_size=16, list_prefixes=True)
+            del client.puts[:]
+            local.upload(base, client, target, "/", chunk_store=chunk_store)
+            sent[target] = [p for p in client.puts if p.startswith(SHARED_STORE)]
+        # 8 blocks, but the data repeats every 3, so only those plus the short last block go up
+        self.assertEqual(len(sent["host1"]), 4)
+        self.assertEqual(sent["host2"], [])
+
+        remote = node.NRootFolder()
+        remote.walk_remote_tree_r(client, "host2", "/")
+        restore_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_base)
+        remote.restore(restore_base, client, "host2", "/")
+        with open(os.path.join(restore_base, "same")) as f:
+            self.assertEqual(f.read(), "shared data " * 10)
+
+    def test_shared_store_listing_fallbacks(self):
+        """Blocks in a prefix too big to list are asked about one by one, and a prefix not there yet means a new block"""
+        client = _ListingClient()
+        ChunkStore(client, SHARED_STORE, 0, block_size=4, list_prefixes=True).upload(StringIO.StringIO("aaaabbbb"))
+
+        def upload(data, listing_limit=ChunkStore.LISTING_LIMIT):
+            store = ChunkStore(client, SHARED_STORE, 0, block_size=4, list_prefixes=True)
+            store.LISTING_LIMIT = listing_limit
+            before = dict(client.calls)
+            store.upload(StringIO.StringIO(data))
+            return dict((method, count - before.get(method, 0)) for method, count in client.calls.items() if count > before.get(method, 0))
+
+        # Each prefix is listed once, however many of its blocks the file has
+        self.assertEqual(upload("aaaabbbbaaaa"), {"metadata": 2})
+        # aaaa's prefix is too big to list, so it's asked about on its own. cccc's
+        # prefix folder isn't there yet, so cccc is new without asking
+        self.assertEqual(upload("aaaacccc", listing_limit=0), {"metadata": 3, "put_file": 1})
+        self.assertEqual(upload("aaaacccc"), {"metadata": 2})
+
+    def test_shared_store_lists_outside_the_lock(self):
+        """Other prefixes carry on while one is being listed, and a block in that prefix waits for its listing"""
+        client = _ListingClient()
+        store = ChunkStore(client, SHARED_STORE, 0, block_size=4, list_prefixes=True)
+        listing = threading.Event()
+        release = threading.Event()
+        metadata = client.metadata
+        def slow_metadata(path, list=True, file_limit=None):
+            if path.endswith("/aa"):
+                listing.set()
+                release.wait(5)
+            return metadata(path, list, file_limit)
+        client.metadata = slow_metadata
+
+        found = []
+        threads = [threading.Thread(target=lambda name=name: found.append(store.has_block(name))) for name in ["aa1", "aa2"]]
+        threads[0].start()
+        self.assertTrue(listing.wait(5))
+        threads[1].start()
+        self.assertFalse(store.has_block("bb1"))
+        self.assertTrue(threads[0].is_alive())
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(found, [False, False])
+        # aa was only listed once, and bb once
+        self.assertEqual(client.calls["metadata"], 2)
+
+    def _remote_client(self):
+        f = lambda name: _meta(name, [], "NFile")
+        return _MetadataClient({
+            "/t/data/.dropboxbackupmeta": _meta("", [_meta("a", []), _meta("b", []), f("top")]),
+            "/t/data/a/.dropboxbackupmeta": _meta("a", [_meta("c", []), f("a1")]),
+            "/t/data/b/.dropboxbackupmeta": _meta("b", [f("b1"), f("b2")]),
+            "/t/data/a/c/.dropboxbackupmeta": _meta("c", [f("c1")]),
+        })
+
+    def _packed_backup(self, base, client, packer):
+        local = node.NRootFolder()
+        local.walk_local_tree_r(base)
+        remote = node.NRootFolder()
+        if client.files:
+            remote.walk_remote_tree_r(client, "t", "/")
+        diff = backup.diff_trees(local, remote)
+        del client.puts[:]
+        diff.upload(base, client, "t", "/", packer=packer)
+        self.assertTrue(packer.close())
+        return [c["name"] for c in json.loads(client.files["/t/data/.dropboxbackupmeta"])["children"]]
+
+    def test_packing_skips_what_it_should(self):
+        """Files at the threshold and symlinks go up on their own, and unchanged packed files aren't packed again"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        for name, size in [("small", 10), ("threshold", 16)]:
+            with open(os.path.join(base, name), "w") as f:
+                f.write("x" * size)
+        os.symlink("small", os.path.join(base, "link"))
+        client = _StoreClient()
+
+        self._packed_backup(base, client, Packer(client, "t", 16))
+        self.assertEqual(len([p for p in client.puts if p.endswith(".pack")]), 1)
+        self.assertIn("/t/data/threshold", client.puts)
+        self.assertIn("/t/data/link.symlink", client.puts)
+        self.assertNotIn("/t/data/small", client.puts)
+
+        self._packed_backup(base, client, Packer(client, "t", 16))
+        self.assertEqual([p for p in client.puts if not p.endswith(".dropboxbackupmeta")], [])
+
+    def test_failed_pack_is_sent_again(self):
+        """Files in a pack that failed to upload aren't listed, and go up with the next backup"""
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        with open(os.path.join(base, "small"), "w") as f:
+            f.write("small")
+        client = _StoreClient()
+        put_file = client.put_file
+        def fail_packs(path, file_obj, overwrite=False):
+            if path.endswith(".pack"):
+                raise IOError("Network went away")
+            return put_file(path, file_obj, overwrite)
+        client.put_file = fail_packs
+
+        self.assertEqual(self._packed_backup(base, client, Packer(client, "t", 1024)), [])
+        client.put_file = put_file
+        self.assertEqual(self._packed_backup(base, client, Packer(client, "t", 1024)), ["small"])
+        self.assertEqual(len([p for p in client.puts if p.endswith(".pack")]), 1)
+
+    def test_walk_remote_tree_matches_recursive_walk(self):
+        """Breadth-first remote walk builds the same tree as the recursive walk"""
+        client = self._remote_client()
+        recursive = node.NRootFolder()
+        recursive.walk_remote_tree_r(client, "t", "/")
+        with WorkerPool(3) as pool:
+            breadth_first = node.NRootFolder()
+            breadth_first.walk_remote_tree(client, "t", "/", pool=pool)
+        self.assertEqual(recursive.encodable(), breadth_first.encodable())
+        self.assertEqual([c.name for c in breadth_first.children[0].children], ["c", "a1"])
+
 if __name__ == '__main__':
     unittest.main()
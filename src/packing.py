@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.packing
+    ~~~~~~~~~~~~~~
+
+    Packs small files together so each one doesn't cost a request of its own
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import logging
+import threading
+import traceback
+import uuid
+
+
+# Packs live in this folder under the target's data folder
+PACK_FOLDER = ".dropboxbackuppacks"
+
+
+def pack_path(target, pack_id):
+    """Remote path of a pack"""
+    return "/{target}/data/{folder}/{pack_id}.pack".format(target=target, folder=PACK_FOLDER, pack_id=pack_id)
+
+
+class Packer(object):
+    """Collects small files into pack objects and uploads them
+
+    Each packed NFile gets a `pack` of {"id", "offset", "length"}, and is
+    only marked uploaded once its pack is in Dropbox. A folder's metadata
+    must wait for that, so folders hand their metadata write to `when_packed`.
+    A folder waits on every file packed beneath it, not just its own, and
+    callbacks ready at the same time run in the order they were registered,
+    so folder metadata still goes up children first and the root last.
+    Folders are known by their path, as the folder uploading its metadata
+    can be a diff's copy of the one its files hang from.
+    """
+
+    def __init__(self, dropbox_client, target, threshold, pack_size=1024*1024*8):
+        self.dropbox_client = dropbox_client
+        self.target = target
+        self.threshold = threshold
+        self.pack_size = pack_size
+        # Becomes False if any deferred metadata write fails
+        self.complete = True
+
+        self.lock = threading.Lock()
+        self._start_pack()
+        # Packed files not yet uploaded, and callbacks waiting on them, per folder path
+        self.pending = {}
+        self.callbacks = {}
+        self.registered = 0
+
+    def _start_pack(self):
+        self.pack_id = uuid.uuid4().hex
+        self.blocks = []
+        self.members = []
+        self.length = 0
+
+    def accepts(self, node):
+        """True if node is a small regular file"""
+        return not node.symlink_target and node.size is not None and node.size < self.threshold
+
+    def add(self, node, full_local_path):
+        """Add a small file's content to the current pack"""
+        with open(full_local_path, "rb") as file_h:
+            data = file_h.read()
+
+        with self.lock:
+            node.pack = {"id": self.pack_id, "offset": self.length, "length": len(data)}
+            self.blocks.append(data)
+            self.members.append(node)
+            self.length = self.length + len(data)
+            for path in _ancestors(node):
+                self.pending[path] = self.pending.get(path, 0) + 1
+            full = self.length >= self.pack_size
+        if full:
+            self.flush()
+
+    def when_packed(self, folder, callback):
+        """Call callback once every file packed from folder is uploaded"""
+        path = folder.generate_path()
+        with self.lock:
+            if self.pending.get(path):
+                self.registered = self.registered + 1
+                self.callbacks.setdefault(path, []).append((self.registered, callback))
+                return
+        self._run(callback)
+
+    def flush(self):
+        """Upload the current pack"""
+        with self.lock:
+            if not self.members:
+                return
+            pack_id, blocks, members = self.pack_id, self.blocks, self.members
+            self._start_pack()
+
+        remote_path = pack_path(self.target, pack_id)
+        logging.info("Uploading pack of {} files to '{}'".format(len(members), remote_path))
+        try:
+            self.dropbox_client.put_file(remote_path, file_obj="".join(blocks), overwrite=True)
+            for node in members:
+                node.uploaded = True
+        except Exception as e:
+            logging.error("Could not upload pack '{}'".format(remote_path))
+            logging.error("{}".format(e))
+            for node in members:
+                logging.error("Skipping NFile {local_path}".format(local_path=node.generate_path()))
+                node.pack = None
+
+        ready = []
+        with self.lock:
+            for node in members:
+                for path in _ancestors(node):
+                    self.pending[path] = self.pending[path] - 1
+                    if not self.pending[path]:
+                        del self.pending[path]
+                        ready.extend(self.callbacks.pop(path, []))
+        for _, callback in sorted(ready):
+            self._run(callback)
+
+    def close(self):
+        """Upload anything left; returns False if a deferred callback failed"""
+        self.flush()
+        return self.complete
+
+    def _run(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            self.complete = False
+            logging.error("{}".format(e))
+            logging.error(traceback.format_exc())
+
+
+def _ancestors(node):
+    folder = node.parent
+    while folder is not None:
+        yield folder.generate_path()
+        folder = folder.parent
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.profiling
+    ~~~~~~~~~~~~~~
+
+    Profiles each phase of a run separately, either with cProfile or by
+    sampling every thread's stack
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+import workers
+
+
+class Profiler(object):
+    """Profiles the phases of a run, writing stats for each when closed
+
+    By default every phase gets its own cProfile, covering the thread that
+    runs the phase and every task submitted to a WorkerPool during it; they
+    are written to <prefix>-<phase>.prof, which pstats or snakeviz can
+    load, with the slowest calls summarised in <prefix>-<phase>.txt.
+
+    cProfile slows down a run with a lot of small calls. For long runs,
+    pass sample_interval to instead sample the stack of every thread that
+    often, in seconds, and write <prefix>-<phase>.folded, the collapsed
+    stack format flame graph tools take.
+    """
+
+    def __init__(self, directory, prefix, sample_interval=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.current = None
+        # Phase names, in the order they were first entered
+        self.phases = []
+        # (phase, thread ident): cProfile.Profile
+        self.profiles = {}
+        # phase: Counter of collapsed stacks
+        self.samples = collections.defaultdict(collections.Counter)
+        self.sampling = False
+        self.sampler = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if sample_interval:
+            self.sampling = True
+            self.sampler = threading.Thread(target=self._sample, name="dropback-profiler")
+            self.sampler.daemon = True
+            self.sampler.start()
+        else:
+            # Tasks run on worker threads, which our cProfile wouldn't see
+            workers.set_task_wrapper(self._wrap)
+
+    def _profile(self, phase):
+        key = (phase, thread.get_ident())
+        with self.lock:
+            if key not in self.profiles:
+                self.profiles[key] = cProfile.Profile()
+            return self.profiles[key]
+
+    def _wrap(self, fn):
+        phase = self.current
+        if phase is None:
+            return fn
+
+        def profiled(*args, **kwargs):
+            return self._profile(phase).runcall(fn, *args, **kwargs)
+        return profiled
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Profile everything done during a phase"""
+        with self.lock:
+            if name not in self.phases:
+                self.phases.append(name)
+            previous, self.current = self.current, name
+        profile = None if self.sampling else self._profile(name)
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            with self.lock:
+                self.current = previous
+
+    def _sample(self):
+        own = thread.get_ident()
+        while self.sampling:
+            time.sleep(self.sample_interval)
+            phase = self.current
+            if phase is None:
+                continue
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                self.samples[phase][";".join(reversed(stack))] += 1
+
+    def close(self):
+        """Stop profiling, and write each phase's stats; returns the files written"""
+        written = []
+        if self.sampler is not None:
+            self.sampling = False
+            self.sampler.join()
+            for phase in self.phases:
+                path = self._path(phase, "folded")
+                with open(path, "w") as folded:
+                    for stack, count in sorted(self.samples[phase].items()):
+                        folded.write("{} {}\n".format(stack, count))
+                written.append(path)
+        else:
+            workers.set_task_wrapper(None)
+            for phase in self.phases:
+                profiles = [p for (p_phase, ident), p in sorted(self.profiles.items()) if p_phase == phase]
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                path = self._path(phase, "prof")
+                stats.dump_stats(path)
+                with open(self._path(phase, "txt"), "w") as summary:
+                    stats.stream = summary
+                    stats.sort_stats("cumulative").print_stats(40)
+                written.append(path)
+        for path in written:
+            logging.info("Wrote profile '{}'".format(path))
+        return written
+
+    def _path(self, phase, extension):
+        return os.path.join(self.directory, "{}-{}.{}".format(self.prefix, phase, extension))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.profiling_test
+    ~~~~~~~~~~~~~~
+
+    Tests profiling the phases of a run
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import workers
+from metrics import phase
+from profiling import Profiler
+from workers import WorkerPool
+
+
+def _walk_work():
+    return sum(range(1000))
+
+
+def _upload_work():
+    time.sleep(0.1)
+
+
+class TestProfiler(unittest.TestCase):
+    """Test Profiler"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _functions(self, path):
+        return set(name for filename, line, name in pstats.Stats(path).stats)
+
+    def test_phases_are_profiled_separately(self):
+        """Each phase gets its own stats, including the tasks it ran on workers"""
+        profiler = Profiler(os.path.join(self.directory, "profiles"), "backup")
+        with WorkerPool(2) as pool:
+            with phase(None, "walk", profiler):
+                _walk_work()
+            with phase(None, "upload", profiler):
+                pool.submit(_upload_work).wait()
+        written = profiler.close()
+
+        self.assertEqual([os.path.basename(p) for p in written], ["backup-walk.prof", "backup-upload.prof"])
+        self.assertIn("_walk_work", self._functions(written[0]))
+        self.assertNotIn("_upload_work", self._functions(written[0]))
+        self.assertIn("_upload_work", self._functions(written[1]))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "profiles", "backup-upload.txt")))
+        # Once closed, tasks are left alone
+        self.assertIsNone(workers._task_wrapper)
+
+    def test_sampling(self):
+        """Sampling records the stacks of every thread, by phase"""
+        profiler = Profiler(self.directory, "restore", sample_interval=0.005)
+        with WorkerPool(1) as pool:
+            with phase(None, "restore", profiler):
+                pool.submit(_upload_work).wait()
+        written = profiler.close()
+
+        self.assertEqual([os.path.basename(p) for p in written], ["restore-restore.folded"])
+        with open(written[0]) as folded:
+            stacks = folded.read()
+        self.assertIn(":_upload_work", stacks)
+        self.assertIsNone(workers._task_wrapper)
+
+    def test_off_does_nothing(self):
+        """Without metrics or a profiler, a phase is the same do-nothing object every time"""
+        self.assertIs(phase(None, "walk"), phase(None, "upload", None))
+        self.assertIsNone(workers._task_wrapper)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.remotestate
+    ~~~~~~~~~~~~~~
+
+    Answers what's already in the backup at a path from what we've listed,
+    rather than asking Dropbox about every node we upload
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import os
+import threading
+
+from node import NFolder, unicode_name, REMOTE_FILE, REMOTE_FOLDER, REMOTE_ABSENT
+
+
+# A symlink is stored as a file next to where its target would be
+_SYMLINK = "symlink"
+
+
+def _kind(remote):
+    if remote.symlink_target:
+        return _SYMLINK
+    return REMOTE_FOLDER if isinstance(remote, NFolder) else REMOTE_FILE
+
+
+def _index(children):
+    # Only what made it into Dropbox; a cached tree can list nodes that failed to upload
+    return dict((unicode_name(c.name), _kind(c)) for c in children if c.uploaded)
+
+
+class RemoteState(object):
+    """What the backup has where a local node would be uploaded
+
+    Built from the remote tree walked at the start of a backup, or fed one
+    folder's listing at a time with `add_listing`. Anything a folder's
+    metadata lists is known; anything it doesn't list is not, as a file can
+    be in Dropbox without having made it into the metadata. A folder we
+    created this run is known to be empty. The root is known to be a folder
+    once we've read its metadata, which `root_found` records when there's
+    no remote tree to tell us.
+
+    `lookup` returns None for anything we can't tell, and the caller should
+    ask Dropbox.
+    """
+
+    def __init__(self, remote_tree=None):
+        self.remote_tree = remote_tree
+        self.lock = threading.Lock()
+        # {name: kind} for each folder we've looked in, by local path
+        self.listings = {}
+        self.created = set()
+        self.root_listed = remote_tree is not None and remote_tree.uploaded
+
+    def add_listing(self, folder_path, children):
+        """Remember the children a folder's metadata lists"""
+        listing = _index(children)
+        with self.lock:
+            self.listings[folder_path] = listing
+
+    def root_found(self):
+        """Record that the root's metadata is in the backup, so the root folder is too"""
+        with self.lock:
+            self.root_listed = True
+
+    def forget(self, folder_path):
+        """Let go of a folder's listing once nothing else will be uploaded into it"""
+        with self.lock:
+            self.listings.pop(folder_path, None)
+            self.created.discard(folder_path)
+
+    def folder_created(self, folder_path):
+        """Record that we created a folder, so there's nothing in it yet"""
+        with self.lock:
+            self.created.add(folder_path)
+
+    def lookup(self, node):
+        """REMOTE_FOLDER, REMOTE_FILE or REMOTE_ABSENT for where node would go, or None if we can't tell"""
+        if node.parent is None:
+            with self.lock:
+                return REMOTE_FOLDER if self.root_listed else None
+        folder_path = node.parent.generate_path()
+        with self.lock:
+            if folder_path in self.created:
+                return REMOTE_ABSENT
+            listing = self._listing(folder_path)
+        if listing is None:
+            return None
+
+        kind = listing.get(unicode_name(node.name))
+        if kind is None:
+            return None
+        if (kind == _SYMLINK) != bool(node.symlink_target):
+            # One of us is stored at "<name>.symlink", so we don't know about the other's path
+            return None
+        return REMOTE_FILE if kind == _SYMLINK else kind
+
+    def _listing(self, folder_path):
+        if folder_path in self.listings:
+            return self.listings[folder_path]
+        if self.remote_tree is None:
+            return None
+
+        folder = self.remote_tree
+        for part in folder_path.split(os.sep) if folder_path else []:
+            key = unicode_name(part)
+            folder = next((c for c in folder.children if isinstance(c, NFolder) and not c.symlink_target and unicode_name(c.name) == key), None)
+            if folder is None:
+                return None
+        listing = self.listings[folder_path] = _index(folder.children)
+        return listing
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.remotestate_test
+    ~~~~~~~~~~~~~~
+
+    Tests answering what's in the backup from what we've listed
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+from node import NRootFolder, NFolder, NFile, REMOTE_FILE, REMOTE_FOLDER, REMOTE_ABSENT
+from remotestate import RemoteState
+
+STATS = {"uid": None, "gid": None, "mode": None, "mtime": 1, "ctime": 1, "size": 1}
+
+
+def _uploaded(node):
+    node.uploaded = True
+    return node
+
+
+class TestRemoteState(unittest.TestCase):
+    """Test RemoteState"""
+
+    def setUp(self):
+        # What the backup has: a folder, a file, a symlink and a file that failed to upload
+        self.remote = _uploaded(NRootFolder())
+        folder = _uploaded(NFolder(self.remote, "d", STATS))
+        link = _uploaded(NFile(self.remote, "link", STATS))
+        link.symlink_target = "d"
+        self.remote.children = [folder, _uploaded(NFile(self.remote, "f", STATS)), link, NFile(self.remote, "failed", STATS)]
+        folder.children = [_uploaded(NFile(folder, "g", STATS))]
+
+        # Where the local nodes would go
+        self.local = NRootFolder()
+        self.d = NFolder(self.local, "d", STATS)
+        self.local.children = [self.d]
+
+    def test_lookup_from_remote_tree(self):
+        """Anything the remote tree lists is known, down to nested folders"""
+        state = RemoteState(self.remote)
+        self.assertEqual(state.lookup(self.local), REMOTE_FOLDER)
+        self.assertEqual(state.lookup(self.d), REMOTE_FOLDER)
+        self.assertEqual(state.lookup(NFile(self.local, "f", STATS)), REMOTE_FILE)
+        self.assertEqual(state.lookup(NFile(self.d, "g", STATS)), REMOTE_FILE)
+
+    def test_unknowns_are_left_to_dropbox(self):
+        """Unlisted names, failed uploads and symlinks that used to be otherwise can't be answered"""
+        state = RemoteState(self.remote)
+        self.assertIsNone(state.lookup(NFile(self.local, "new", STATS)))
+        self.assertIsNone(state.lookup(NFile(self.local, "failed", STATS)))
+        # A symlink is stored at "link.symlink", so the backup says nothing about "link" itself
+        self.assertIsNone(state.lookup(NFile(self.local, "link", STATS)))
+        symlink = NFile(self.local, "f", STATS)
+        symlink.symlink_target = "d"
+        self.assertIsNone(state.lookup(symlink))
+        self.assertIsNone(state.lookup(NFile(NFolder(self.d, "missing", STATS), "h", STATS)))
+
+    def test_root_without_metadata(self):
+        """A backup whose root metadata couldn't be read leaves the root to Dropbox"""
+        self.assertIsNone(RemoteState(NRootFolder()).lookup(self.local))
+        self.assertIsNone(RemoteState().lookup(self.local))
+
+    def test_listings_one_folder_at_a_time(self):
+        """Without a remote tree, we know what we've been given listings for, and folders we made are empty"""
+        state = RemoteState()
+        state.root_found()
+        state.add_listing("", self.remote.children)
+        self.assertEqual(state.lookup(self.local), REMOTE_FOLDER)
+        self.assertEqual(state.lookup(self.d), REMOTE_FOLDER)
+        self.assertIsNone(state.lookup(NFile(self.d, "g", STATS)))
+
+        state.folder_created("d")
+        self.assertEqual(state.lookup(NFile(self.d, "g", STATS)), REMOTE_ABSENT)
+        state.forget("d")
+        state.forget("")
+        self.assertIsNone(state.lookup(NFile(self.d, "g", STATS)))
+        self.assertIsNone(state.lookup(self.d))
+        self.assertEqual(state.listings, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,16 @@
 
 import unittest
 from node_test import TestNFile, TestNFolder
+from workers_test import TestWorkerPool, TestBackground
+from cache_test import TestRemoteTreeCache
+from backup_test import TestDiffTrees, TestDetectRenames, TestDirtyTracking, TestStreamDiff
+from listing_test import TestRemoteListing
+from fakeclient_test import TestFakeDropboxClient
+from metrics_test import TestMetrics
+from profiling_test import TestProfiler
+from transport_test import TestRetryingClient
+from benchmark_test import TestBenchmark
+from remotestate_test import TestRemoteState
 
 class TestOther(unittest.TestCase):
     """Tests bits that don't belong in *_test files"""
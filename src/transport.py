@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.transport
+    ~~~~~~~~~~~~~~
+
+    Retries Dropbox requests that fail for reasons that pass, and keeps the
+    number of requests in flight to what Dropbox will take
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+
+import dropbox
+
+
+# Statuses worth trying again: throttled, or Dropbox having a bad moment
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses that mean we're sending too much, too fast
+THROTTLE_STATUSES = (429, 503)
+
+
+def retry_after(error):
+    """Seconds an ErrorResponse's Retry-After header asks us to wait, or None"""
+    headers = getattr(error, "headers", None) or {}
+    items = headers.items() if hasattr(headers, "items") else headers
+    for name, value in items:
+        if name.lower() == "retry-after":
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                # An HTTP date; rare enough from Dropbox to treat like no header
+                return None
+    return None
+
+
+class AdaptiveLimit(object):
+    """Bounds the requests in flight across every worker, adjusting to Dropbox
+
+    The limit grows by about one for each limit's worth of requests that
+    succeed, and halves when Dropbox throttles us (additive increase,
+    multiplicative decrease), so it settles just under what Dropbox will
+    take. It only halves once for a burst of throttled requests that were
+    all in flight together. A Retry-After holds every worker, not just the
+    one that was told.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.limit = float(initial or maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # Requests are numbered as they start; one started before the last
+        # decrease was already counted in it
+        self.started = 0
+        self.decreased_at = 0
+        self.resume_at = 0
+
+    def acquire(self):
+        """Wait for a free slot; returns a token to pass to release"""
+        with self.condition:
+            while True:
+                wait = self.resume_at - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                # Waiting with a timeout keeps Ctrl+C working under Python2
+                self.condition.wait(min(wait, 0.5) if wait > 0 else 0.5)
+            self.in_flight = self.in_flight + 1
+            self.started = self.started + 1
+            return self.started
+
+    def release(self, token, throttled=False, hold=None):
+        """Give a slot back, saying whether Dropbox throttled the request, and for how long to hold off"""
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            if throttled:
+                if token > self.decreased_at:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.decreased_at = self.started
+                    logging.info("Dropbox is throttling us; down to {} requests at a time".format(int(self.limit)))
+                if hold:
+                    self.resume_at = max(self.resume_at, time.time() + hold)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class _RetryingUploader(object):
+    """Passes a ChunkedUploader through, retrying its commit"""
+
+    def __init__(self, uploader, client):
+        self.__dict__["_uploader"] = uploader
+        self.__dict__["_client"] = client
+
+    def finish(self, *args, **kwargs):
+        return self._client._call("commit_chunked_upload", self._uploader.finish, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._uploader, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._uploader, name, value)
+
+
+class RetryingClient(object):
+    """Wraps a DropboxClient, retrying requests that fail for reasons that pass
+
+    Throttled (429, 503) and server (5xx) errors, and dropped connections,
+    are retried up to `retries` times. A Retry-After from Dropbox is waited
+    out; otherwise we back off exponentially from `base_delay` up to
+    `max_delay` seconds, picking a random point in that range so that
+    workers that failed together don't all retry together. Any other error
+    is raised straight away, as is the last one once we run out of retries.
+
+    With an AdaptiveLimit, every request waits for a slot in it.
+    """
+
+    def __init__(self, client, retries=5, base_delay=0.5, max_delay=60, limit=None, sleep=time.sleep):
+        self._client = client
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit = limit
+        self._sleep = sleep
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == "get_chunked_uploader":
+            # Doesn't make a request itself, but the uploader's finish does
+            return lambda *args, **kwargs: _RetryingUploader(attr(*args, **kwargs), self)
+        return lambda *args, **kwargs: self._call(name, attr, args, kwargs)
+
+    def _call(self, method, fn, args, kwargs):
+        # put_file(full_path, file_obj, ...) and upload_chunk(file_obj, ...) read
+        # what they send, so a retry has to start it from the same place again
+        payload = None
+        position = {"put_file": 1, "upload_chunk": 0}.get(method)
+        if position is not None:
+            payload = args[position] if len(args) > position else kwargs.get("file_obj")
+        start = payload.tell() if hasattr(payload, "seek") else None
+
+        attempt = 0
+        while True:
+            token = self.limit.acquire() if self.limit is not None else None
+            try:
+                result = fn(*args, **kwargs)
+            except dropbox.rest.ErrorResponse as e:
+                retryable = e.status in RETRY_STATUSES
+                hold = retry_after(e) if e.status in THROTTLE_STATUSES else None
+                if self.limit is not None:
+                    self.limit.release(token, throttled=e.status in THROTTLE_STATUSES, hold=hold)
+                if not retryable or attempt >= self.retries:
+                    raise
+                reason = "[{}] {}".format(e.status, e.reason)
+            except (socket.error, httplib.HTTPException) as e:
+                # Includes dropbox.rest.RESTSocketError; the connection dropped or timed out
+                if self.limit is not None:
+                    self.limit.release(token)
+                if attempt >= self.retries:
+                    raise
+                hold = None
+                reason = "{}".format(e)
+            except Exception:
+                if self.limit is not None:
+                    self.limit.release(token)
+                raise
+            else:
+                if self.limit is not None:
+                    self.limit.release(token)
+                return result
+
+            delay = hold if hold is not None else random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            attempt = attempt + 1
+            logging.warning("{} failed ({}); retry {} of {} in {:.1f}s".format(method, reason, attempt, self.retries, delay))
+            self._sleep(delay)
+            if start is not None:
+                payload.seek(start)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.transport_test
+    ~~~~~~~~~~~~~~
+
+    Tests retrying Dropbox requests and adapting how many run at once
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import dropbox
+from fakeclient import FakeDropboxClient
+from node import NRootFolder
+from transport import RetryingClient, AdaptiveLimit
+from workers import WorkerPool
+
+
+class _DroppingClient(object):
+    """Loses the connection on the first `drops` requests"""
+
+    def __init__(self, drops):
+        self.drops = drops
+
+    def account_info(self):
+        if self.drops:
+            self.drops = self.drops - 1
+            raise dropbox.rest.RESTSocketError("api.dropbox.com", socket.error("Connection reset by peer"))
+        return {"display_name": "Someone"}
+
+
+class TestRetryingClient(unittest.TestCase):
+    """Test RetryingClient and AdaptiveLimit"""
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.remote)
+        self.fake = FakeDropboxClient(self.remote)
+        self.sleeps = []
+        self.client = RetryingClient(self.fake, retries=3, base_delay=1, max_delay=3, sleep=self.sleeps.append)
+
+    def test_transient_errors_are_retried(self):
+        """Server errors and dropped connections are retried, backing off a random amount up to a cap"""
+        self.fake.inject(503, "put_file")
+        self.fake.inject(500, "put_file", count=2)
+        self.client.put_file("/t/f", "data")
+        self.assertEqual(self.fake.requests["put_file"], 4)
+        self.assertEqual(self.fake.bytes_sent, 4)
+        for sleep, most in zip(self.sleeps, [1, 2, 3]):
+            self.assertTrue(0 <= sleep <= most)
+
+        client = RetryingClient(_DroppingClient(1), sleep=self.sleeps.append)
+        self.assertEqual(client.account_info()["display_name"], "Someone")
+
+    def test_retry_after_is_respected(self):
+        """A throttled request waits as long as Dropbox asks before trying again"""
+        self.fake.inject(429, "metadata", headers={"Retry-After": "7"})
+        self.fake.put_file("/t/f", "data")
+        self.assertEqual(self.client.metadata("/t/f")["bytes"], 4)
+        self.assertEqual(self.sleeps, [7.0])
+
+    def test_other_errors_are_not_retried(self):
+        """Errors that would only happen again are raised straight away, and the rest once retries run out"""
+        with self.assertRaises(dropbox.rest.ErrorResponse) as raised:
+            self.client.metadata("/missing")
+        self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(self.fake.requests["metadata"], 1)
+
+        self.fake.inject(503, "file_create_folder", count=4)
+        with self.assertRaises(dropbox.rest.ErrorResponse):
+            self.client.file_create_folder("/t")
+        self.assertEqual(self.fake.requests["file_create_folder"], 4)
+
+    def test_uploads_are_sent_whole_again(self):
+        """A retried upload sends the file from where it started, and retries its commit"""
+        with tempfile.TemporaryFile() as file_h:
+            file_h.write("0123456789")
+            file_h.seek(2)
+            self.fake.inject(503, "put_file")
+            self.client.put_file("/t/f", file_h)
+        with self.fake.get_file("/t/f") as f:
+            self.assertEqual(f.read(), "23456789")
+
+        uploader = self.client.get_chunked_uploader(StringIO.StringIO("x" * 10), 10)
+        uploader.upload_chunked(4)
+        self.fake.inject(502, "commit_chunked_upload")
+        uploader.finish("/t/big")
+        self.assertEqual(self.fake.requests["commit_chunked_upload"], 2)
+        self.assertEqual(self.fake.metadata("/t/big")["bytes"], 10)
+
+    def test_adaptive_limit(self):
+        """Throttling halves the limit once per burst, and successes win it back gradually"""
+        limit = AdaptiveLimit(8)
+        tokens = [limit.acquire() for i in range(8)]
+        for token in tokens:
+            limit.release(token, throttled=True)
+        self.assertEqual(limit.limit, 4)
+
+        # Started after the decrease, so it's a new sign of too much
+        limit.release(limit.acquire(), throttled=True)
+        self.assertEqual(limit.limit, 2)
+        for i in range(10):
+            limit.release(limit.acquire())
+        self.assertTrue(4 < limit.limit < 6)
+        for i in range(100):
+            limit.release(limit.acquire())
+        self.assertEqual(limit.limit, 8)
+
+    def test_backup_survives_throttling(self):
+        """A backup through a throttling Dropbox still backs up every file"""
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        for i in range(20):
+            with open(os.path.join(source, "f{}".format(i)), "w") as f:
+                f.write("file {}".format(i))
+        fake = FakeDropboxClient(self.remote, throttle_rate=0.2, retry_after=0, seed=1)
+        client = RetryingClient(fake, retries=10, base_delay=0, limit=AdaptiveLimit(4))
+
+        local = NRootFolder()
+        local.walk_local_tree_r(source)
+        with WorkerPool(4) as pool:
+            self.assertTrue(local.upload(source, client, "t", "/", pool=pool) is not False)
+        self.assertGreater(fake.requests["put_file"], 21)
+        self.assertEqual(len(os.listdir(os.path.join(self.remote, "t", "data"))), 21)
+
+
+if __name__ == '__main__':
+    unittest.main()
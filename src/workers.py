@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.workers
+    ~~~~~~~~~~~~~~
+
+    A small bounded thread pool used to run Dropbox requests in parallel
+
+    Must be run as Python2, as Dropbox Library doesn't support Python3 yet
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+import logging
+import threading
+import traceback
+import Queue
+
+
+# Wraps every function submitted to a WorkerPool, while something (e.g. a
+# Profiler) needs to see the tasks; None the rest of the time
+_task_wrapper = None
+
+
+def set_task_wrapper(wrapper):
+    """Have every function submitted to a WorkerPool from now on passed through wrapper(fn)"""
+    global _task_wrapper
+    _task_wrapper = wrapper
+
+
+class Task(object):
+    """A unit of work submitted to a WorkerPool"""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        """Run the task, capturing its result or exception"""
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+            logging.error("Worker task {} failed".format(self.fn))
+            logging.error("{}".format(e))
+            logging.error(traceback.format_exc())
+        finally:
+            self._done.set()
+
+    def done(self):
+        """Returns True once the task has finished running"""
+        return self._done.is_set()
+
+    def wait(self):
+        """Block until the task has finished"""
+        # Waiting with a timeout keeps Ctrl+C working under Python2
+        while not self._done.wait(0.5):
+            pass
+        return self.result
+
+
+class WorkerPool(object):
+    """A fixed number of worker threads fed from a bounded queue
+
+    `submit` blocks once `queue_size` tasks are waiting, so a producer can
+    never get more than a queue's worth of work ahead of the workers.
+    """
+
+    def __init__(self, jobs, queue_size=None):
+        if jobs < 1:
+            raise ValueError("A WorkerPool needs at least one job")
+        self.jobs = jobs
+        self.queue = Queue.Queue(maxsize=queue_size or jobs * 4)
+        self.threads = []
+        for i in range(jobs):
+            thread = threading.Thread(target=self._work, name="dropback-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                task.run()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to run on a worker; returns its Task"""
+        if _task_wrapper is not None:
+            fn = _task_wrapper(fn)
+        task = Task(fn, args, kwargs)
+        self.queue.put(task)
+        return task
+
+    def map(self, fn, items):
+        """Run fn over every item in parallel, returning results in order"""
+        return [t.wait() for t in [self.submit(fn, item) for item in items]]
+
+    def close(self):
+        """Let queued tasks finish, then stop the workers"""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def wait_all(tasks):
+    """Wait for every task in tasks to finish"""
+    for task in tasks:
+        task.wait()
+
+
+class _Failed(object):
+    """Carries an exception from a background iterator to its consumer"""
+
+    def __init__(self, exception, tb):
+        self.exception = exception
+        self.tb = tb
+
+
+def background(iterable, queue_size):
+    """Run an iterator on its own thread, yielding its items as they're ready
+
+    Items pass through a queue of at most queue_size, so the iterator can
+    only get that far ahead of whoever is consuming them. An exception in
+    the iterator is raised again in the consumer. If the consumer stops
+    early, the iterator is closed rather than left waiting on the queue.
+    """
+    done = object()
+    queue = Queue.Queue(maxsize=queue_size)
+    # Set once the consumer has stopped taking items
+    stopped = threading.Event()
+
+    def put(item):
+        """Queue an item; False if the consumer stopped before taking it"""
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    # Let go of whatever the iterator was holding on to
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+                    return
+        except Exception as e:
+            put(_Failed(e, traceback.format_exc()))
+        put(done)
+
+    thread = threading.Thread(target=_task_wrapper(produce) if _task_wrapper is not None else produce, name="dropback-producer")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            # Waiting with a timeout keeps Ctrl+C working under Python2
+            try:
+                item = queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if item is done:
+                return
+            if isinstance(item, _Failed):
+                logging.error(item.tb)
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
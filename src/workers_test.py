@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    dropback.workers_test
+    ~~~~~~~~~~~~~~
+
+    Tests the worker pool
+
+    :author: Jonathan Love
+    :copyright: (c) 2015 by Doubledot Media Ltd.
+    :license: See README.md and LICENSE for more details
+"""
+
+import unittest
+import threading
+import time
+from workers import WorkerPool, wait_all, background
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Test WorkerPool class"""
+
+    def test_map_keeps_order(self):
+        """Results come back in submission order"""
+        with WorkerPool(4) as pool:
+            self.assertEqual(pool.map(lambda x: x * 2, range(50)), [x * 2 for x in range(50)])
+
+    def test_failures_are_captured(self):
+        """A failing task records its exception rather than killing the worker"""
+        def fail():
+            raise ValueError("nope")
+        with WorkerPool(2) as pool:
+            bad = pool.submit(fail)
+            good = pool.submit(lambda: 1)
+            wait_all([bad, good])
+        self.assertIsInstance(bad.exception, ValueError)
+        self.assertEqual(good.result, 1)
+
+    def test_runs_in_parallel(self):
+        """Two tasks can be running at the same time"""
+        arrived = []
+        both_here = threading.Event()
+        def meet():
+            arrived.append(True)
+            if len(arrived) == 2:
+                both_here.set()
+            # Would time out with a single worker
+            return both_here.wait(5)
+        with WorkerPool(2) as pool:
+            tasks = [pool.submit(meet), pool.submit(meet)]
+            wait_all(tasks)
+        self.assertTrue(all(t.result for t in tasks))
+
+
+
+class TestBackground(unittest.TestCase):
+    """Test background"""
+
+    def test_producer_is_held_back(self):
+        """The iterator only gets a queue's worth ahead of the consumer"""
+        produced = []
+        def produce():
+            for i in range(20):
+                produced.append(i)
+                yield i
+        items = background(produce(), 3)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.2)
+        # One handed over, three queued, and one waiting to be queued
+        self.assertEqual(len(produced), 5)
+        self.assertEqual(list(items), range(1, 20))
+
+    def test_exceptions_reach_the_consumer(self):
+        """An exception in the iterator is raised where it's consumed"""
+        def produce():
+            yield 1
+            raise ValueError("nope")
+        items = background(produce(), 3)
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+
+    def test_producer_stops_with_the_consumer(self):
+        """The iterator is closed, not left waiting on a full queue, once the consumer stops"""
+        closed = threading.Event()
+        def produce():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.set()
+        items = background(produce(), 1)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertTrue(closed.wait(5))
+
+if __name__ == '__main__':
+    unittest.main()